@@ -15,9 +15,20 @@ from tensorpack.tfutils import symbolic_functions as symbf
 
 class Model(ModelDesc):
     def __init__(self, image_shape, channel, method, num_actions, gamma,
-                lr=1e-3, lamb=1.0, h_size=512, update_step=1, multi_task=False, num_agents=1, reg=False, mt_type='all'):
+                lr=1e-3, lamb=1.0, h_size=512, update_step=1, multi_task=False, num_agents=1, reg=False, mt_type='all',
+                obs_channels=1, prioritized=False, share_features=False, rnn_state_size=0):
         self.image_shape = image_shape
         self.channel = channel
+        # number of channels of each frame, e.g. >1 for the grid observation
+        self.obs_channels = obs_channels
+        # take importance-sampling weights and report the TD error for prioritized replay
+        self.prioritized = prioritized
+        # in training, evaluate the online network on state and next_state together
+        self.share_features = share_features
+        # size of the recurrent state kept in the replay memory, 0 to start every window from zero
+        self.rnn_state_size = rnn_state_size
+        # the initial recurrent state of the window being built, None for the zero state
+        self.rnn_state_in = None
         self.method = method
         self.num_actions = num_actions
         self.gamma = gamma
@@ -34,21 +45,59 @@ class Model(ModelDesc):
 
     def _get_inputs(self):
         # Use a combined state for efficiency.
-        # The first h channels are the current state, and the last h channels are the next state.
-        return [InputDesc(tf.uint8,
-                    (None,) + self.image_shape + (self.channel + 1,),
+        # The first h frames are the current state, and the last h frames are the next state.
+        inputs = [InputDesc(tf.uint8,
+                    (None,) + self.image_shape + ((self.channel + 1) * self.obs_channels,),
                     'comb_state'),
                 InputDesc(tf.int64, (None, self.channel + 1), 'action'),
                 InputDesc(tf.float32, (None, self.channel + 1), 'reward'),
                 InputDesc(tf.bool, (None, self.channel + 1), 'isOver'),
                 InputDesc(tf.int64, (None, self.channel + 1, self.num_agents), 'action_o')]
+        if self.rnn_state_size:
+            # before the first frames of the current and the next state
+            inputs.append(InputDesc(tf.float16, (None, 2, self.rnn_state_size), 'rnn_state'))
+        if self.prioritized:
+            inputs += [InputDesc(tf.float32, (None,), 'is_weight'),
+                       InputDesc(tf.int64, (None,), 'sample_row')]
+        return inputs
 
     @abc.abstractmethod
     def _get_DQN_prediction(self, image):
         pass
 
+    def _get_online_predictions(self, comb_state):
+        """
+        The outputs of :meth:`_get_DQN_prediction` on state and on next_state,
+        by default from one forward pass over both stacked on the batch axis.
+
+        Args:
+            comb_state: the float combined state.
+        """
+        state = comb_state[:, :, :, :self.channel * self.obs_channels]
+        next_state = comb_state[:, :, :, self.obs_channels:]
+        Q, pis, _, _ = self._get_DQN_prediction(tf.concat([state, next_state], 0))
+        return self._split_predictions(Q, pis)
+
+    @abc.abstractmethod
+    def _get_DQN_step(self, frame, rnn_state):
+        """
+        Advance the recurrent network by one frame from `rnn_state`, for the
+        actors of a model with `rnn_state_size`.
+
+        Returns:
+            the Q values and the next recurrent state.
+        """
+        pass
+
+    @staticmethod
+    def _split_predictions(Q, pis):
+        """ the outputs of a pass over a stacked (state, next_state) batch, for each of them """
+        Q, next_Q = tf.split(Q, 2)
+        pis, next_pis = zip(*[tf.split(pi, 2) for pi in pis])
+        return (Q, list(pis), None, None), (next_Q, list(next_pis), None, None)
+
     def _build_graph(self, inputs):
-        comb_state, action, reward, isOver, action_o = inputs
+        comb_state, action, reward, isOver, action_o = inputs[:5]
         self.batch_size = tf.shape(comb_state)[0]
 
         backward_offset = ((self.channel) - self.update_step)
@@ -63,14 +112,40 @@ class Model(ModelDesc):
         action_o = tf.reshape(action_o, (self.batch_size * self.update_step, self.num_agents))
 
         comb_state = tf.cast(comb_state, tf.float32)
-        state = tf.slice(comb_state, [0, 0, 0, 0], [-1, -1, -1, self.channel], name='state')
+        state = tf.slice(comb_state, [0, 0, 0, 0], [-1, -1, -1, self.channel * self.obs_channels], name='state')
 
-        self.predict_value, pi_value, self.q_rnn_state_out, self.pi_rnn_state_out = self._get_DQN_prediction(state)
+        self.rnn_state_in = None
         if not get_current_tower_context().is_training:
+            # the predictors only feed the state
+            self.predict_value, pi_value, self.q_rnn_state_out, self.pi_rnn_state_out = \
+                self._get_DQN_prediction(state)
+            if self.rnn_state_size:
+                # the actors feed one frame and their recurrent state, to the same variables
+                frame = tf.slice(comb_state, [0, 0, 0, 0], [-1, -1, -1, self.obs_channels], name='frame')
+                rnn_state_in = tf.cast(inputs[5][:, 0], tf.float32, name='rnn_state_in')
+                with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+                    Q, rnn_state_out = self._get_DQN_step(frame, rnn_state_in)
+                tf.identity(Q, name='step_Qvalue')
+                tf.identity(rnn_state_out, name='rnn_state_out')
             return
+        rnn_state = tf.cast(inputs[5], tf.float32) if self.rnn_state_size else None
+        # only Double-DQN needs the online network on next_state
+        share_features = self.share_features and self.method == 'Double'
+        if share_features:
+            if rnn_state is not None:
+                self.rnn_state_in = tf.concat([rnn_state[:, 0], rnn_state[:, 1]], 0)
+            online, next_online = self._get_online_predictions(comb_state)
+            # a shared pass may have been over a larger batch
+            self.batch_size = tf.shape(comb_state)[0]
+        else:
+            if rnn_state is not None:
+                self.rnn_state_in = rnn_state[:, 0]
+            online = self._get_DQN_prediction(state)
+        self.predict_value, pi_value, self.q_rnn_state_out, self.pi_rnn_state_out = online
 
         reward = tf.clip_by_value(reward, -1, 1)
-        next_state = tf.slice(comb_state, [0, 0, 0, 1], [-1, -1, -1, self.channel], name='next_state')
+        next_state = tf.slice(comb_state, [0, 0, 0, self.obs_channels],
+                              [-1, -1, -1, self.channel * self.obs_channels], name='next_state')
         action_onehot = tf.one_hot(action, self.num_actions, 1.0, 0.0)
 
         pred_action_value = tf.reduce_sum(self.predict_value * action_onehot, 1)  # N,
@@ -78,6 +153,8 @@ class Model(ModelDesc):
             self.predict_value, 1), name='predict_reward')
         summary.add_moving_summary(max_pred_reward)
 
+        if rnn_state is not None:
+            self.rnn_state_in = rnn_state[:, 1]
         with tf.variable_scope('target'), \
                 collection.freeze_collection([tf.GraphKeys.TRAINABLE_VARIABLES]):
             targetQ_predict_value, target_pi_value, _, _ = self._get_DQN_prediction(next_state)    # NxA
@@ -87,9 +164,12 @@ class Model(ModelDesc):
             best_v = tf.reduce_max(targetQ_predict_value, 1)    # N,
         else:
             # Double-DQN
-            sc = tf.get_variable_scope()
-            with tf.variable_scope(sc, reuse=True):
-                next_predict_value, next_pi_value, _, _ = self._get_DQN_prediction(next_state)
+            if share_features:
+                next_predict_value, next_pi_value, _, _ = next_online
+            else:
+                sc = tf.get_variable_scope()
+                with tf.variable_scope(sc, reuse=True):
+                    next_predict_value, next_pi_value, _, _ = self._get_DQN_prediction(next_state)
             self.greedy_choice = tf.argmax(next_predict_value, 1)   # N,
             predict_onehot = tf.one_hot(self.greedy_choice, self.num_actions, 1.0, 0.0)
             best_v = tf.reduce_sum(targetQ_predict_value * predict_onehot, 1)
@@ -98,6 +178,14 @@ class Model(ModelDesc):
 
         # q cost
         q_cost = (symbf.huber_loss(target - pred_action_value))
+        if self.prioritized:
+            is_weight, sample_row = inputs[-2:]
+            # the priority of a sample is its largest TD error over the update steps
+            td_error = tf.reshape(tf.abs(target - pred_action_value), (self.batch_size, self.update_step))
+            tf.reduce_max(tf.stop_gradient(td_error), axis=1, name='td_error')
+            tf.identity(sample_row, name='prioritized_rows')
+            q_cost = q_cost * tf.reshape(
+                tf.tile(tf.expand_dims(is_weight, 1), [1, self.update_step]), [-1])
         # pi cost
         action_os = tf.unstack(action_o, self.num_agents, axis=1)
         action_o_one_hots = []
@@ -3,61 +3,86 @@
 # modified from the work of Yuxin Wu <ppwwyyxxc@gmail.com>
 
 import numpy as np
-import copy
 from collections import deque, namedtuple
 import threading
+import abc
 import six
 from six.moves import queue, range
 
+import tensorflow as tf
 from tensorpack.dataflow import DataFlow
 from tensorpack.utils import logger, get_tqdm, get_rng
 from tensorpack.utils.concurrency import LoopThread, ShareSessionThread
 from tensorpack.callbacks.base import Callback
 
-from expreplay import ReplayMemory, ExpReplay
+from expreplay import ReplayMemory, ExpReplay, stack_history
 
 __all__ = ['AugmentExpReplay']
 
 AugmentExperience = namedtuple('AugmentExperience',
-                        ['state', 'action', 'reward', 'isOver', 'action_o'])
+                        ['state', 'action', 'reward', 'isOver', 'action_o', 'rnn_state'])
+# the recurrent state of the actor before the state, only kept with rnn_state_size
+AugmentExperience.__new__.__defaults__ = (None,)
 
 
 class AugmentReplayMemory(ReplayMemory):
-    def __init__(self, max_size, state_shape, history_len, num_agents):
-        super(AugmentReplayMemory, self).__init__(max_size, state_shape, history_len)
+    def __init__(self, max_size, state_shape, history_len, num_agents, storage_dir=None, num_streams=1,
+                 renderer=None, rnn_state_size=0):
+        """
+        Args:
+            rnn_state_size (int): if positive, also keep the float16 recurrent
+                state of the actor before each state. The batches then have the
+                states before the first frames of the current and the next
+                state, zero where the window starts in a previous episode.
+        """
+        super(AugmentReplayMemory, self).__init__(max_size, state_shape, history_len, storage_dir, num_streams,
+                                                  renderer)
         self.num_agents = num_agents
-        self.action_o = np.zeros((self.max_size, num_agents), dtype='int32')
+        self.action_o = self._alloc('action_o', (self.max_size, num_agents), 'int32')
+        self._columns.append('action_o')
+        self.rnn_state_size = int(rnn_state_size)
+        if self.rnn_state_size:
+            self.rnn_state = self._alloc('rnn_state', (self.max_size, self.rnn_state_size), 'float16')
+            self._columns.append('rnn_state')
+
+    def sample_batch(self, idx, buffers=None):
+        """ same as :meth:`ReplayMemory.sample_batch`.
 
-    def sample(self, idx):
-        """ return a tuple of (s,r,a,o,a_o),
-            where s is of shape STATE_SIZE + (hist_len+1,)"""
-        idx = (self._curr_pos + idx) % self._curr_size
+        Returns:
+            list: [state, action, reward, isOver, action_o], where all but
+            the state keep the whole (hist_len+1) window, and the
+            (batch, 2, rnn_state_size) rnn_state if it's kept.
+        """
+        bufs = self._get_batch_buffers(len(idx), buffers)
+        self._fill_batch(self._window_rows(idx), bufs)
+        return bufs[1:]
+
+    def _fill_batch(self, rows, bufs):
+        """ gather the (batch, hist_len+1) windows of memory `rows` into the buffers """
+        frames, state, action, reward, isOver, action_o = bufs[:6]
+        isOver[...] = self._gather_state(rows, state, frames)
+        np.take(self.action, rows, out=action, mode='clip')
+        np.take(self.reward, rows, out=reward, mode='clip')
+        np.take(self.action_o, rows, axis=0, out=action_o, mode='clip')
+        if self.rnn_state_size:
+            rnn_state = bufs[6]
+            np.take(self.rnn_state, rows[:, :2], axis=0, out=rnn_state, mode='clip')
+            # like the frames, the states of a previous episode are cleared
+            rnn_state[:, 0][isOver[:, :self.history_len - 1].any(axis=1)] = 0
+            rnn_state[:, 1][isOver[:, 1:self.history_len - 1].any(axis=1)] = 0
+
+    def _batch_spec(self, batch_size):
         k = self.history_len + 1
-        if idx + k <= self._curr_size:
-            state = self.state[idx: idx + k]
-            reward = self.reward[idx: idx + k]
-            action = self.action[idx: idx + k]
-            isOver = self.isOver[idx: idx + k]
-            action_o = self.action_o[idx: idx + k]
-        else:
-            end = idx + k - self._curr_size
-            state = self._slice(self.state, idx, end)
-            reward = self._slice(self.reward, idx, end)
-            action = self._slice(self.action, idx, end)
-            isOver = self._slice(self.isOver, idx, end)
-            action_o = self._slice(self.action_o, idx, end)
-        ret = self._pad_sample(state, reward, action, isOver, action_o)
-        return ret
-
-    # the next_state is a different episode if current_state.isOver==True
-    def _pad_sample(self, state, reward, action, isOver, action_o):
-        for k in range(self.history_len - 2, -1, -1):
-            if isOver[k]:
-                state = copy.deepcopy(state)
-                state[:k + 1].fill(0)
-                break
-        state = state.transpose(1, 2, 0)
-        return (state, reward, action, isOver, action_o)
+        spec = [((batch_size, k), 'int8'), ((batch_size, k), 'float32'),
+                ((batch_size, k), 'bool'), ((batch_size, k, self.num_agents), 'int8')]
+        if self.rnn_state_size:
+            spec.append(((batch_size, 2, self.rnn_state_size), 'float16'))
+        return spec
+
+    def _get_exp(self, pos):
+        return AugmentExperience(self.state[pos], self.action[pos], self.reward[pos],
+                                 self.isOver[pos], self.action_o[pos],
+                                 self.rnn_state[pos] if self.rnn_state_size else None)
 
     def _assign(self, pos, exp):
         self.state[pos] = exp.state
@@ -65,6 +90,184 @@ class AugmentReplayMemory(ReplayMemory):
         self.action[pos] = exp.action
         self.isOver[pos] = exp.isOver
         self.action_o[pos] = exp.action_o
+        if self.rnn_state_size:
+            self.rnn_state[pos] = exp.rnn_state
+
+
+@six.add_metaclass(abc.ABCMeta)
+class SegmentTree(object):
+    """
+    An array-based segment tree over `size` leaves, reduced with `_op`.
+    Updates take arrays of leaves and cost O(batch * log(size)) numpy work,
+    or a plain walk up the tree for a few leaves.
+    """
+    neutral = 0.0
+    # the per-append updates of one or two leaves are cheaper in Python than with np.unique
+    scalar_update = 2
+
+    def __init__(self, size):
+        self.capacity = 1
+        while self.capacity < size:
+            self.capacity *= 2
+        # node i has children 2i and 2i+1, the leaves are [capacity, 2 * capacity)
+        self._tree = np.full(2 * self.capacity, self.neutral, dtype='float64')
+
+    @abc.abstractmethod
+    def _op(self, a, b):
+        pass
+
+    def _scalar_op(self, a, b):
+        return self._op(a, b)
+
+    def __getitem__(self, idx):
+        return self._tree[np.asarray(idx) + self.capacity]
+
+    def __setitem__(self, idx, values):
+        leaves = np.asarray(idx) + self.capacity
+        values = np.broadcast_to(np.asarray(values, dtype='float64'), leaves.shape)
+        if leaves.size <= self.scalar_update:
+            tree = self._tree
+            for node, v in zip(leaves.ravel().tolist(), values.ravel().tolist()):
+                tree[node] = v
+                node //= 2
+                while node >= 1:
+                    tree[node] = self._scalar_op(tree[2 * node], tree[2 * node + 1])
+                    node //= 2
+            return
+        nodes = np.unique(leaves)
+        self._tree[leaves] = values
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self._tree[nodes] = self._op(self._tree[2 * nodes], self._tree[2 * nodes + 1])
+
+    def reduce(self):
+        """ the reduction of all leaves """
+        return self._tree[1]
+
+
+class SumTree(SegmentTree):
+    neutral = 0.0
+
+    def _op(self, a, b):
+        return a + b
+
+    def find(self, values):
+        """ for each value in [0, sum), the leaf whose prefix sum range contains it """
+        values = np.array(values, dtype='float64')
+        nodes = np.ones(len(values), dtype='int64')
+        while nodes[0] < self.capacity:
+            left = self._tree[2 * nodes]
+            right = values > left
+            values -= left * right
+            nodes = 2 * nodes + right
+        return nodes - self.capacity
+
+
+class MinTree(SegmentTree):
+    neutral = np.inf
+
+    def _op(self, a, b):
+        return np.minimum(a, b)
+
+    def _scalar_op(self, a, b):
+        return min(a, b)
+
+
+class PrioritizedReplayMemory(AugmentReplayMemory):
+    """
+    :class:`AugmentReplayMemory` with proportional prioritized sampling, from
+    `Prioritized Experience Replay <https://arxiv.org/abs/1511.05952>`_.
+    A transition is keyed by the memory row of its current frame.
+    It can only be sampled once its next frame is in the memory, and stops
+    being sampled `guard` rows before it gets overwritten.
+    """
+
+    def __init__(self, max_size, state_shape, history_len, num_agents, storage_dir=None, num_streams=1,
+                 renderer=None, alpha=0.6, guard=0, eps=1e-6, rnn_state_size=0):
+        """
+        Args:
+            alpha (float): priority exponent, 0 for uniform sampling.
+            guard (int): number of oldest rows not to sample, in addition to
+                the history of the oldest transition.
+        """
+        super(PrioritizedReplayMemory, self).__init__(max_size, state_shape, history_len, num_agents,
+                                                      storage_dir, num_streams, renderer, rnn_state_size)
+        self.alpha = alpha
+        self.eps = eps
+        self.guard = int(guard) + (self.history_len - 1) * self.num_streams
+        self._sum_tree = SumTree(self.max_size)
+        self._min_tree = MinTree(self.max_size)
+        self._max_priority = 1.0
+        self._lock = threading.Lock()
+
+    def _set_priority(self, rows, priority):
+        """ priority 0 means not to be sampled """
+        self._sum_tree[rows] = priority
+        self._min_tree[rows] = np.where(priority > 0, priority, np.inf)
+
+    def _on_appended(self, n):
+        """ update the priorities after appending `n` rows """
+        end = self._num_appended
+        with self._lock:
+            # the rows about to be overwritten
+            stale = np.arange(end - n + self.guard, end + self.guard) % self.max_size
+            self._set_priority(stale, np.zeros(n))
+            # the transitions whose next frame just arrived
+            ready = np.arange(max(end - n - self.num_streams, self.guard), end - self.num_streams)
+            if len(ready):
+                self._set_priority(ready % self.max_size, np.full(len(ready), self._max_priority))
+
+    def append(self, exp):
+        super(PrioritizedReplayMemory, self).append(exp)
+        self._on_appended(1)
+
+    def append_batch(self, exps):
+        super(PrioritizedReplayMemory, self).append_batch(exps)
+        self._on_appended(len(exps))
+
+    def load_snapshot(self, path):
+        super(PrioritizedReplayMemory, self).load_snapshot(path)
+        # priorities are not saved, restart from uniform
+        self._max_priority = 1.0
+        end = self._num_appended
+        with self._lock:
+            self._set_priority(np.arange(self.max_size), np.zeros(self.max_size))
+            valid = np.arange(max(end - self._curr_size + self.guard, self.guard), end - self.num_streams)
+            if len(valid):
+                self._set_priority(valid % self.max_size, np.ones(len(valid)))
+
+    def sample_prioritized(self, batch_size, beta, rng, buffers=None):
+        """
+        Sample a batch with probability proportional to the priorities,
+        into `buffers` as in :meth:`sample_batch`.
+
+        Returns:
+            list: the :meth:`sample_batch` datapoint, followed by the
+            importance-sampling weights and the rows of the transitions.
+        """
+        with self._lock:
+            total = self._sum_tree.reduce()
+            # one sample from each of `batch_size` equal ranges
+            values = (np.arange(batch_size) + rng.uniform(size=batch_size)) * (total / batch_size)
+            rows = self._sum_tree.find(np.minimum(values, np.nextafter(total, 0)))
+            prob = self._sum_tree[rows] / total
+            min_prob = self._min_tree.reduce() / total
+        # (N * prob) ** -beta, normalized by the largest possible weight
+        weight = ((prob / min_prob) ** -beta).astype('float32')
+        # the window of a transition starts hist_len-1 frames before it
+        idx = (rows - (self.history_len - 1) * self.num_streams - self._curr_pos) % self._curr_size
+        return self.sample_batch(idx, buffers) + [weight, rows]
+
+    def update_priorities(self, rows, td_error):
+        """ set the priorities of sampled transitions from their absolute TD error """
+        priority = (np.abs(td_error) + self.eps) ** self.alpha
+        with self._lock:
+            # the transitions overwritten since they were sampled keep priority 0
+            keep = self._sum_tree[rows] > 0
+            rows, priority = rows[keep], priority[keep]
+            if len(rows):
+                self._set_priority(rows, priority)
+                self._max_priority = max(self._max_priority, priority.max())
 
 
 class AugmentExpReplay(ExpReplay, Callback):
@@ -87,7 +290,9 @@ class AugmentExpReplay(ExpReplay, Callback):
                  batch_size,
                  memory_size, init_memory_size,
                  init_exploration,
-                 update_frequency, history_len, h_size=512, num_agents=1):
+                 update_frequency, history_len, h_size=512, num_agents=1, memory_dir=None,
+                 predictor_broker=None, prioritized=False, alpha=0.6, beta=0.4, symbolic_renderer=None,
+                 nr_sampler=0, prefetch=4, rnn_state_size=0):
         """
         Args:
             predictor_io_names (tuple of list of str): input/output names to
@@ -97,7 +302,33 @@ class AugmentExpReplay(ExpReplay, Callback):
                 initial frames.
             update_frequency (int): number of new transitions to add to memory
                 after sampling a batch of transitions for training.
+            memory_dir (str or None): keep the replay memory in memory-mapped
+                files under this directory.
+            predictor_broker (dict or None): arguments of a shared
+                :class:`PredictorBroker` to predict through.
+            prioritized (bool): sample with :class:`PrioritizedReplayMemory`.
+                The datapoints then also have the importance-sampling weights
+                and the sampled rows, and the model has to output a 'td_error'
+                tensor and a 'prioritized_rows' tensor of the rows it trained on.
+            alpha (float): priority exponent.
+            beta (float): importance-sampling exponent, usually annealed to 1.
+            symbolic_renderer (FastRenderer or None): store symbolic states and
+                render the frames when they are needed.
+            nr_sampler (int): number of threads assembling batches in the background.
+            prefetch (int): number of assembled batches kept ready.
+            rnn_state_size (int): if positive, the predictor takes a batch of
+                single frames and the recurrent states before them, and
+                returns the Q values and the next recurrent states. It is
+                called on every step, and the states are kept in the memory.
         """
+        self.num_agents = num_agents
+        self.rnn_state_size = rnn_state_size
+        # of the actor in each environment, before its current state
+        self._rnn_state = None
+        self.h_size = h_size
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
         super(AugmentExpReplay, self).__init__(predictor_io_names,
                 player,
                 state_shape,
@@ -106,39 +337,142 @@ class AugmentExpReplay(ExpReplay, Callback):
                 init_memory_size,
                 init_exploration,
                 update_frequency,
-                history_len)
-        self.num_agents = num_agents
-        self.h_size = h_size
-        self.mem = AugmentReplayMemory(memory_size, state_shape, history_len, num_agents)
+                history_len,
+                memory_dir,
+                predictor_broker,
+                symbolic_renderer,
+                nr_sampler,
+                prefetch)
+
+    def _get_memory(self):
+        if self.prioritized:
+            # don't sample what the queued populate jobs will overwrite
+            return PrioritizedReplayMemory(self.memory_size, self.state_shape, self.history_len,
+                                           self.num_agents, self.memory_dir, self.num_envs,
+                                           self.symbolic_renderer, self.alpha,
+                                           guard=self._sample_guard, rnn_state_size=self.rnn_state_size)
+        return AugmentReplayMemory(self.memory_size, self.state_shape, self.history_len,
+                                   self.num_agents, self.memory_dir, self.num_envs, self.symbolic_renderer,
+                                   self.rnn_state_size)
+
+    def _sample_batch(self, buffers=None):
+        if self.prioritized:
+            return self.mem.sample_prioritized(self.batch_size, self.beta, self.rng, buffers)
+        return super(AugmentExpReplay, self)._sample_batch(buffers)
+
+    def _setup_graph(self):
+        super(AugmentExpReplay, self)._setup_graph()
+        if self.prioritized:
+            G = tf.get_default_graph()
+            self._priority_fetches = [G.get_tensor_by_name('prioritized_rows:0'),
+                                      G.get_tensor_by_name('td_error:0')]
+
+    def _before_run(self, _):
+        if self.prioritized:
+            return tf.train.SessionRunArgs(fetches=self._priority_fetches)
+
+    def _after_run(self, _, run_values):
+        if self.prioritized:
+            rows, td_error = run_values.results
+            self.mem.update_priorities(rows, td_error)
 
     def _populate_exp(self):
         """ populate a transition by epsilon-greedy"""
-        old_s = self.player.current_state()
+        if self.rnn_state_size:
+            self._populate_exp_recurrent()
+            return
+        if self.num_envs > 1:
+            self._populate_exp_batch()
+            return
+        tm = self._timer
+        if tm:
+            t = tm.now()
+        old_s = self._get_player_state()
+        if tm:
+            t = tm.add('current_state', t)
         if self.rng.rand() <= self.exploration or (len(self.mem) <= self.history_len):
             act = self.rng.choice(range(self.num_actions))
         else:
             # build a history state
-            history = self.mem.recent_state()
-            history.append(old_s)
-            history = np.stack(history, axis=2)
+            history = self.mem.history_state(old_s)
+            if tm:
+                t = tm.add('history', t)
 
             # assume batched network
             q_values = self.predictor([[history]])[0][0]  # this is the bottleneck
             act = np.argmax(q_values)
+            if tm:
+                t = tm.add('predict', t)
 
         reward, isOver = self.player.action(act)
+        if tm:
+            t = tm.add('action', t)
         # NOTE: since modify action interface will destroy the proxy design
         action_o = self.player.get_internal_state()['agent_actions'][1:]
         self.mem.append(AugmentExperience(old_s, act, reward, isOver, action_o))
+        if tm:
+            tm.add('append', t)
 
-    def _process_batch(self, batch_exp):
-        state = np.asarray([e[0] for e in batch_exp], dtype='uint8')
-        reward = np.asarray([e[1] for e in batch_exp], dtype='float32')
-        action = np.asarray([e[2] for e in batch_exp], dtype='int8')
-        isOver = np.asarray([e[3] for e in batch_exp], dtype='bool')
-        action_o = np.asarray([e[4] for e in batch_exp], dtype='int8')
+    def _populate_exp_batch(self):
+        """ populate a transition for each environment of a vectorized player """
+        tm = self._timer
+        if tm:
+            t = tm.now()
+        old_s = self._get_player_state().copy()
+        if tm:
+            t = tm.add('current_state', t)
+        act = self._select_actions(old_s)
+        if tm:
+            t = tm.now()
+        reward, isOver = self.player.action(act)
+        if tm:
+            t = tm.add('action', t)
+        action_o = self.player.get_internal_state()['agent_actions'][:, 1:]
+        self.mem.append_batch([AugmentExperience(old_s[i], act[i], reward[i], isOver[i], action_o[i])
+                               for i in range(self.num_envs)])
+        if tm:
+            tm.add('append', t)
 
-        return [state, action, reward, isOver, action_o]
+    def _populate_exp_recurrent(self):
+        """ populate a transition for each environment, advancing the recurrent
+            state of the actor by one frame whether the action is greedy or not """
+        tm = self._timer
+        if tm:
+            t = tm.now()
+        old_s = self._get_player_state()
+        old_s = old_s.copy() if self.num_envs > 1 else old_s[np.newaxis]
+        if tm:
+            t = tm.add('current_state', t)
+        if self._rnn_state is None:
+            self._rnn_state = np.zeros((self.num_envs, self.rnn_state_size), dtype='float32')
+        frames = old_s if self.symbolic_renderer is None else self.symbolic_renderer.render_batch(old_s)
+        frames = frames.reshape(frames.shape[:3] + (-1,))
+        q_values, rnn_state = self.predictor([frames, self._rnn_state])
+        act = np.argmax(q_values, axis=1)
+        rand = self.rng.rand(self.num_envs) <= self.exploration
+        act[rand] = self.rng.choice(self.num_actions, size=rand.sum())
+        if tm:
+            t = tm.add('predict', t)
+        if self.num_envs > 1:
+            reward, isOver = self.player.action(act)
+            action_o = self.player.get_internal_state()['agent_actions'][:, 1:]
+        else:
+            reward, isOver = self.player.action(act[0])
+            reward, isOver = [reward], [isOver]
+            action_o = [self.player.get_internal_state()['agent_actions'][1:]]
+        if tm:
+            t = tm.add('action', t)
+        exps = [AugmentExperience(old_s[i], act[i], reward[i], isOver[i], action_o[i], self._rnn_state[i])
+                for i in range(self.num_envs)]
+        if self.num_envs > 1:
+            self.mem.append_batch(exps)
+        else:
+            self.mem.append(exps[0])
+        # a new episode starts from the zero state
+        rnn_state[np.asarray(isOver, dtype='bool')] = 0
+        self._rnn_state = rnn_state
+        if tm:
+            tm.add('append', t)
 
 if __name__ == '__main__':
     import sys
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import numpy as np
+from six.moves import range
+
+from tensorpack.utils import logger
+
+__all__ = ['bench_env', 'check_ai', 'bench_ai', 'bench_render', 'bench_replay', 'bench_predictor',
+           'bench_learner', 'compare_baseline', 'write_results']
+
+# (team size, field, mode) of the environments used in training
+ENV_CONFIGS = [(1, 'small', None), (1, 'small', 'OPPONENT_DYNAMIC'), (1, 'small', 'ALL_RANDOM'),
+               (2, 'large', None), (2, 'large', 'WEAKCOOP'), (2, 'large', 'OPPONENT_DYNAMIC'),
+               (2, 'large', 'COOP_DYNAMIC'), (2, 'large', 'ALL_RANDOM')]
+
+
+def _result(value, unit, higher_is_better=True):
+    return {'value': float(value), 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def bench_env(frame_skip=2, nr_step=2000, configs=ENV_CONFIGS):
+    """ :meth:`SoccerPlayer.action` steps per second, without observations """
+    from soccer_env import SoccerPlayer
+    ret = {}
+    rng = np.random.RandomState(0)
+    for team_size, field, mode in configs:
+        pl = SoccerPlayer(field=field, team_size=team_size, mode=mode, frame_skip=frame_skip)
+        nr_actions = pl.get_action_space().num_actions()
+        acts = rng.randint(nr_actions, size=nr_step)
+        t = time.time()
+        for a in acts:
+            pl.action(a)
+        ret['env/action/team{}-{}'.format(team_size, mode or 'default')] = \
+            _result(nr_step / (time.time() - t), 'steps/s')
+    return ret
+
+
+# (environment class, team size, field, mode) of the replays of check_ai
+AI_CONFIGS = [('BatchedAIEnvironment', 2, 'large', 'WEAKCOOP'), ('BatchedAIEnvironment', 2, 'large', None),
+              ('BatchedAIEnvironment', 1, 'small', None), ('SoccerSavingBallEnvironment', 2, 'large', None),
+              ('SoccerPassingBallEnvironment', 2, 'large', None)]
+
+
+def _replay_ai(raw_env, batched, nr_step, seed, **kwargs):
+    """
+    Returns:
+        the agent actions and positions after every step of a seeded run with
+        the batched or the per-agent AI, and the seconds spent in the AI.
+    """
+    import random
+    from soccer_env import SoccerPlayer
+    random.seed(seed)
+    np.random.seed(seed)
+    pl = SoccerPlayer(frame_skip=1, raw_env=raw_env, **kwargs)
+    env = pl.env
+    ai = env._get_ai_action if batched else env._get_reference_ai_action
+    elapsed = [0.0]
+
+    def timed_ai(team_name, team_agent_index):
+        t = time.time()
+        ret = ai(team_name, team_agent_index)
+        elapsed[0] += time.time() - t
+        return ret
+    env._get_ai_action = timed_ai
+    trajectory = []
+    for a in np.random.RandomState(seed).randint(pl.get_action_space().num_actions(), size=nr_step):
+        pl.action(a)
+        trajectory.append((list(pl.get_internal_state()['agent_actions']),
+                           [tuple(env.state.get_agent_pos(i)) for i in pl._agent_indices]))
+    return trajectory, elapsed[0]
+
+
+def check_ai(nr_step=1000, seed=0, configs=AI_CONFIGS):
+    """
+    Replay the same seeded run of every config with the batched and with the
+    per-agent rule-based AI, and fail on the first step where they differ.
+
+    Returns:
+        dict: config name -> seconds spent in the batched and in the per-agent AI.
+    """
+    import soccer_env
+    ret = {}
+    for env_name, team_size, field, mode in configs:
+        name = '{}/team{}-{}'.format(env_name, team_size, mode or 'default')
+        kwargs = dict(team_size=team_size, field=field, mode=mode)
+        raw_env = getattr(soccer_env, env_name)
+        batched, t_batched = _replay_ai(raw_env, True, nr_step, seed, **kwargs)
+        ref, t_ref = _replay_ai(raw_env, False, nr_step, seed, **kwargs)
+        for k, (b, r) in enumerate(zip(batched, ref)):
+            assert b == r, "{}: the batched AI differs at step {}: {} instead of {}".format(name, k, b, r)
+        ret[name] = (t_batched, t_ref)
+    return ret
+
+
+def bench_ai(nr_step=1000):
+    """
+    Time of the rule-based actions of all agents in a frame, batched and per agent,
+    in WEAKCOOP. Fails if the two don't play the same, see :func:`check_ai`.
+    """
+    times = check_ai(nr_step)
+    t_batched, t_ref = times['BatchedAIEnvironment/team2-WEAKCOOP']
+    return {'ai/batched': _result(t_batched / nr_step * 1e6, 'us', False),
+            'ai/per_agent': _result(t_ref / nr_step * 1e6, 'us', False)}
+
+
+def bench_render(frame_skip=2, nr_step=1000, team_size=2, field='large'):
+    """ latency of :meth:`SoccerPlayer.current_state` after a step, for each renderer """
+    from soccer_env import SoccerPlayer
+    ret = {}
+    rng = np.random.RandomState(0)
+    for renderer in ['pygame', 'fast']:
+        pl = SoccerPlayer(field=field, team_size=team_size, frame_skip=frame_skip, renderer=renderer)
+        if pl.renderer != renderer:
+            logger.warn("Skip the {} renderer, it isn't available.".format(renderer))
+            continue
+        nr_actions = pl.get_action_space().num_actions()
+        total = 0
+        for a in rng.randint(nr_actions, size=nr_step):
+            pl.action(a)
+            t = time.time()
+            pl.current_state()
+            total += time.time() - t
+        ret['render/{}'.format(renderer)] = _result(total / nr_step * 1e6, 'us', False)
+    return ret
+
+
+def bench_replay(capacities=(1e5, 1e6), state_shape=(84, 84), history_len=4, batch_size=32,
+                 num_agents=1, storage_dir=None, nr_batch=500):
+    """
+    Append rate while filling an :class:`AugmentReplayMemory` of each capacity,
+    and the rate of assembling training batches from the full memory.
+    A 1e6 memory of 84x84 frames needs 7GB, use `storage_dir` to keep it on disk.
+    """
+    from augment_expreplay import AugmentReplayMemory, AugmentExperience
+    ret = {}
+    rng = np.random.RandomState(0)
+    frames = rng.randint(0, 255, size=(64,) + tuple(state_shape)).astype('uint8')
+    for cap in capacities:
+        cap = int(cap)
+        mem = AugmentReplayMemory(cap, tuple(state_shape), history_len, num_agents, storage_dir)
+        exps = [AugmentExperience(frames[i % len(frames)], i % 5, 0.0, i % 97 == 0,
+                                  np.zeros(num_agents, dtype='int32')) for i in range(1000)]
+        t = time.time()
+        for i in range(cap):
+            mem.append(exps[i % len(exps)])
+        ret['replay/append/{:.0e}'.format(cap)] = _result(cap / (time.time() - t), 'transitions/s')
+
+        idx = rng.randint(0, cap - history_len - 1, size=(nr_batch, batch_size))
+        mem.sample_batch(idx[0])
+        t = time.time()
+        for i in range(nr_batch):
+            mem.sample_batch(idx[i])
+        ret['replay/sample_batch/{:.0e}'.format(cap)] = _result(nr_batch / (time.time() - t), 'batches/s')
+        del mem
+    return ret
+
+
+def bench_predictor(model, batch_sizes=(1, 32), nr_call=200):
+    """ latency of the Q-value predictor on random weights, for each batch size """
+    from tensorpack import OfflinePredictor, PredictConfig
+    pred = OfflinePredictor(PredictConfig(model=model, input_names=['state'], output_names=['Qvalue']))
+    shape = model.image_shape + (model.channel * model.obs_channels,)
+    ret = {}
+    rng = np.random.RandomState(0)
+    for b in batch_sizes:
+        state = rng.randint(0, 255, size=(b,) + shape).astype('uint8')
+        pred([state])
+        t = time.time()
+        for _ in range(nr_call):
+            pred([state])
+        ret['predictor/batch{}'.format(b)] = _result((time.time() - t) / nr_call * 1e3, 'ms', False)
+    return ret
+
+
+def bench_learner(model, expreplay, nr_step=200):
+    """
+    Training steps per second of the learner, fed by `expreplay` whose simulator
+    acts with a random stub predictor instead of the network.
+    """
+    import tensorflow as tf
+    from tensorpack.tfutils.tower import TowerContext
+
+    num_actions = expreplay.num_actions
+    expreplay.predictor = lambda dp: [np.random.rand(len(dp[0]), num_actions)]
+    with tf.Graph().as_default():
+        with TowerContext('', is_training=True):
+            inputs = model.get_reused_placehdrs()
+            model.build_graph(inputs)
+            cost = model.get_cost()
+        train_op = model.get_optimizer().minimize(cost)
+
+        with tf.Session() as sess, sess.as_default():
+            sess.run(tf.global_variables_initializer())
+            expreplay._init_memory()
+            th = expreplay.get_simulator_thread()
+            th.daemon = True
+            th.start()
+            data = expreplay.get_data()
+            sess.run(train_op, feed_dict=dict(zip(inputs, next(data))))
+            t = time.time()
+            for _ in range(nr_step):
+                sess.run(train_op, feed_dict=dict(zip(inputs, next(data))))
+            rate = nr_step / (time.time() - t)
+    return {'learner/train_step': _result(rate, 'steps/s')}
+
+
+def compare_baseline(results, baseline, tolerance=0.1):
+    """
+    Compare `results` with a `baseline` of the same format.
+
+    Returns:
+        list of names whose value is worse than the baseline by more than `tolerance` (relative).
+    """
+    regressions = []
+    for name, r in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]['value']
+        change = (r['value'] - old) / old if old else 0.0
+        if not r['higher_is_better']:
+            change = -change
+        r['baseline'] = old
+        r['change'] = change
+        if change < -tolerance:
+            regressions.append(name)
+            logger.warn("Regression in {}: {:.4g} {} vs. baseline {:.4g} ({:+.1%})".format(
+                name, r['value'], r['unit'], old, change))
+    return regressions
+
+
+def write_results(results, path=None):
+    """ print the results as JSON, and also write them to `path` if given """
+    s = json.dumps(results, indent=2, sort_keys=True)
+    print(s)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(s)
+
+
+if __name__ == '__main__':
+    # the equivalence check of the batched AI, which exits with an error on any difference
+    for name, (t_batched, t_ref) in sorted(check_ai().items()):
+        print("{}: same actions, AI time batched {:.3f}s, per agent {:.3f}s".format(name, t_batched, t_ref))
@@ -11,11 +11,58 @@ import numpy as np
 from tqdm import tqdm
 from six.moves import queue
 
-from tensorpack import *
-from tensorpack.utils.concurrency import *
-from tensorpack.utils.stats import *
+from tensorpack.utils import logger, get_tqdm_kwargs
+from tensorpack.utils.concurrency import StoppableThread, ShareSessionThread
+from tensorpack.callbacks.base import Triggerable
+
+from predictor_broker import get_shared_broker
+from frame_history import FrameHistory
+
+class StepPredictor(object):
+    """
+    Act with a recurrent model the way its simulator does in training: one
+    frame at a time, from the recurrent state carried over from the previous
+    frames of the episode. It's called like a predictor of history states, of
+    which only the last frame is fed, and needs :func:`reset_predictor` at the
+    start of every episode.
+    """
+
+    def __init__(self, predictor, state_size, obs_channels=1):
+        """
+        Args:
+            predictor: takes [frame, rnn_state_in] and returns [step_Qvalue, rnn_state_out].
+            state_size (int): size of the flat recurrent state.
+        """
+        self.predictor = predictor
+        self.state_size = state_size
+        self.obs_channels = obs_channels
+        self._state = None
+
+    def reset(self, mask=None):
+        """ start from the zero state, for all the rows or those in the boolean `mask` """
+        if mask is None or self._state is None:
+            self._state = None
+        else:
+            self._state[mask] = 0
+
+    def __call__(self, dp):
+        frame = np.asarray(dp[0])[..., -self.obs_channels:]
+        if self._state is None or len(self._state) != len(frame):
+            self._state = np.zeros((len(frame), self.state_size), dtype='float32')
+        Q, state = self.predictor([frame, self._state])
+        self._state = np.array(state, dtype='float32')
+        return [Q]
+
+
+def reset_predictor(func, mask=None):
+    """ tell a predictor which keeps a state, i.e. a :class:`StepPredictor`, that episodes start """
+    if isinstance(func, StepPredictor):
+        func.reset(mask)
+
 
 def play_one_episode(player, func, verbose=False):
+    reset_predictor(func)
+
     def f(s):
         spc = player.get_action_space()
         output = func([[s]])[0]
@@ -30,35 +77,28 @@ def play_one_episode(player, func, verbose=False):
     return np.mean(player.play_one_episode(f))
 
 
-def play_model(cfg, player):
-    predfunc = OfflinePredictor(cfg)
+def play_model(predfunc, player):
+    """ `predfunc`: an `OfflinePredictor` or anything called like one, e.g. a :class:`quantize.FrozenPredictor` """
     while True:
         score = play_one_episode(player, predfunc)
         print("Total:", score)
 
 
-def eval_with_funcs(predictors, nr_eval, get_player_fn):
+def eval_with_funcs(predictors, nr_eval, get_player_fn, early_stop=None):
     class Worker(StoppableThread, ShareSessionThread):
         def __init__(self, func, queue):
             super(Worker, self).__init__()
             self._func = func
             self.q = queue
 
-        def func(self, *args, **kwargs):
-            if self.stopped():
-                raise RuntimeError("stopped!")
-            return self._func(*args, **kwargs)
-
         def run(self):
             with self.default_sess():
                 player = get_player_fn(train=False)
                 while not self.stopped():
-                    try:
-                        score = play_one_episode(player, self.func)
-                        # print("Score, ", score)
-                    except RuntimeError:
-                        return
-                    self.queue_put_stoppable(self.q, score)
+                    # an episode started before the stop is finished and counted,
+                    # so the short episodes aren't favored
+                    score = play_one_episode(player, self._func)
+                    self.q.put(score)
 
     q = queue.Queue()
     threads = [Worker(f, q) for f in predictors]
@@ -66,11 +106,14 @@ def eval_with_funcs(predictors, nr_eval, get_player_fn):
     for k in threads:
         k.start()
         time.sleep(0.1)  # avoid simulator bugs
-    stat = StatCounter()
+    stat = StreamingStats()
     try:
         for _ in tqdm(range(nr_eval), **get_tqdm_kwargs()):
             r = q.get()
             stat.feed(r)
+            if early_stop is not None and early_stop(stat):
+                logger.info("Stop evaluation after {} episodes: {}.".format(stat.count, early_stop.reason))
+                break
         logger.info("Waiting for all the workers to finish the last run...")
         for k in threads:
             k.stop()
@@ -83,46 +126,206 @@ def eval_with_funcs(predictors, nr_eval, get_player_fn):
         logger.exception("Eval")
     finally:
         if stat.count > 0:
-            return (stat.average, stat.max)
+            return (stat.mean, stat.max)
         return (0, 0)
 
 
-def eval_model_multithread(cfg, nr_eval, get_player_fn):
-    nr_eval = 100000
-    predfunc = OfflinePredictor(cfg)
-    player = get_player_fn()
-    scores = []
-    for ep in range(nr_eval):
-        scores.append(play_one_episode(player, predfunc))
-        scores_ = np.asarray(scores)
-        print('%d: Max: %f, Min: %f, Mean: %f' % (ep, scores_.max(), scores_.min(), scores_.mean()))
-    scores = np.array(scores)
-    print('Over %d episodes, Max: %f, Min: %f, Mean: %f' % (nr_eval, scores.max(), scores.min(), scores.mean()))
-    '''
-    func = OfflinePredictor(cfg)
-    NR_PROC = min(multiprocessing.cpu_count() // 2, 8)
-    mean, max = eval_with_funcs([func] * NR_PROC, nr_eval, get_player_fn)
-    logger.info("Average Score: {}; Max Score: {}".format(mean, max))
-    '''
+# two-sided standard normal quantiles
+Z_VALUES = {0.9: 1.645, 0.95: 1.96, 0.99: 2.576}
+
+
+class StreamingStats(object):
+    """ count, mean, variance, min and max of a stream, each update is O(1) (Welford's algorithm) """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def feed(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+
+    @property
+    def variance(self):
+        """ the unbiased sample variance """
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def interval(self, confidence=0.95):
+        """ half width of the normal confidence interval of the mean """
+        if self.count < 2:
+            return float('inf')
+        return Z_VALUES[confidence] * self.std / np.sqrt(self.count)
+
+
+class EarlyStopping(object):
+    """
+    Decide when a sequential evaluation has seen enough episodes: when the
+    confidence interval of the mean score is within +-`tolerance`, or when
+    `time_budget` seconds have passed. The evaluation then still finishes and
+    counts the episodes in progress, otherwise the short ones would be favored.
+    """
+
+    def __init__(self, tolerance=None, time_budget=None, confidence=0.95, min_episodes=30):
+        """
+        Args:
+            min_episodes (int): don't trust the normal approximation before this many episodes.
+        """
+        assert confidence in Z_VALUES, "confidence has to be one of {}".format(sorted(Z_VALUES))
+        self.tolerance = tolerance
+        self.confidence = confidence
+        self.min_episodes = min_episodes
+        self.deadline = time.time() + time_budget if time_budget is not None else None
+        self.reason = None
+
+    def __call__(self, stats):
+        if self.tolerance is not None and stats.count >= self.min_episodes \
+                and stats.interval(self.confidence) <= self.tolerance:
+            self.reason = 'confidence interval within +-{}'.format(self.tolerance)
+        elif self.deadline is not None and time.time() > self.deadline:
+            self.reason = 'time budget exhausted'
+        return self.reason is not None
+
+
+def eval_lockstep(predfunc, player, history_len, nr_eval, log_period=1000, early_stop=None):
+    """
+    Play `nr_eval` episodes on all the environments of a vectorized player in
+    lockstep, with one batched predictor call per step.
+    The frame history, the random actions and the stuck prevention of a
+    `get_player(train=False)` player are applied here to all environments at once.
+    `early_stop` (an :class:`EarlyStopping`) can end the evaluation sooner.
+    The episodes in progress when it stops are finished and counted too, so
+    the short episodes aren't favored.
+
+    Returns:
+        StreamingStats: of the episode scores.
+    """
+    n = player.num_envs
+    num_actions = player.get_action_space().num_actions()
+    obs = player.current_state()
+    hist = FrameHistory(obs.shape[1:], history_len, num_envs=n)
+    hist.push(obs)
+    reset_predictor(predfunc)
+    score = np.zeros(n)
+    # same as PreventStuckPlayer(player, 30, 1)
+    last_act = np.full(n, -1)
+    repeat = np.zeros(n, dtype='int64')
+    stats = StreamingStats()
+    conf = early_stop.confidence if early_stop is not None else 0.95
+    # the environments whose episode is still to be counted, once stopping
+    pending = None
+    with tqdm(total=nr_eval, **get_tqdm_kwargs()) as pbar:
+        while pending is None or pending.any():
+            if pending is None:
+                if stats.count < nr_eval and early_stop is not None and early_stop(stats):
+                    logger.info("Stop evaluation after {} episodes: {}.".format(stats.count, early_stop.reason))
+                    pending = np.ones(n, dtype=bool)
+                elif stats.count >= nr_eval:
+                    pending = np.ones(n, dtype=bool)
+            act = predfunc([hist.window()])[0].argmax(axis=1)
+            rand = np.random.rand(n) < 0.001
+            act[rand] = np.random.randint(num_actions, size=rand.sum())
+            repeat = np.where(act == last_act, repeat + 1, 1)
+            last_act = act
+            reward, isOver = player.action(np.where(repeat >= 30, 1, act))
+            score += reward
+
+            hist.reset(isOver)
+            reset_predictor(predfunc, isOver)
+            hist.push(player.current_state())
+            for i in np.flatnonzero(isOver):
+                if pending is not None:
+                    if not pending[i]:
+                        continue
+                    pending[i] = False
+                stats.feed(score[i])
+                pbar.update()
+                if stats.count % log_period == 0:
+                    logger.info('%d: Max: %f, Min: %f, Mean: %f +- %f' % (
+                        stats.count, stats.max, stats.min, stats.mean, stats.interval(conf)))
+            score[isOver] = 0
+            last_act[isOver] = -1
+            repeat[isOver] = 0
+    return stats
+
+
+def eval_model_multithread(predfunc, nr_eval, get_player_fn, history_len, nr_env=None,
+                           tolerance=None, time_budget=None, confidence=0.95):
+    """
+    Evaluate `predfunc` (as in :func:`play_model`)
+    with :func:`eval_lockstep` on `nr_env` (default: number of cores)
+    environments, each in its own process. Stop before `nr_eval` episodes
+    when the `confidence` interval of the mean score is within +-`tolerance`,
+    or after `time_budget` seconds.
+    """
+    if nr_env is None:
+        nr_env = multiprocessing.cpu_count()
+    early_stop = EarlyStopping(tolerance, time_budget, confidence)
+    player = get_player_fn(train=False, nr_env=nr_env)
+    try:
+        stats = eval_lockstep(predfunc, player, history_len, nr_eval, early_stop=early_stop)
+    finally:
+        player.close()
+    print('Over %d episodes, Max: %f, Min: %f, Mean: %f, %d%% CI: [%f, %f]' % (
+        stats.count, stats.max, stats.min, stats.mean, int(confidence * 100),
+        stats.mean - stats.interval(confidence), stats.mean + stats.interval(confidence)))
 
 class Evaluator(Triggerable):
-    def __init__(self, nr_eval, input_names, output_names, get_player_fn):
+    def __init__(self, nr_eval, input_names, output_names, get_player_fn, predictor_broker=None,
+                 tolerance=None, time_budget=None, rnn_state_size=0, obs_channels=1):
+        """
+        Args:
+            predictor_broker (dict or None): if given, the eval threads predict
+                through a shared :class:`PredictorBroker` created with these arguments.
+            tolerance, time_budget: if given, a round stops early as in :class:`EarlyStopping`.
+            rnn_state_size (int): if given, the names are the ones of the step
+                outputs and each thread acts through its own :class:`StepPredictor`.
+        """
         self.eval_episode = nr_eval
         self.input_names = input_names
         self.output_names = output_names
         self.get_player_fn = get_player_fn
+        self.predictor_broker = predictor_broker
+        self.tolerance = tolerance
+        self.time_budget = time_budget
+        self.rnn_state_size = rnn_state_size
+        self.obs_channels = obs_channels
 
     def _setup_graph(self):
         NR_PROC = min(multiprocessing.cpu_count() // 2, 20)
-        self.pred_funcs = [self.trainer.get_predictor(
-            self.input_names, self.output_names)] * NR_PROC
+        if self.predictor_broker is not None:
+            pred = get_shared_broker(self.trainer, self.input_names, self.output_names,
+                                     **self.predictor_broker)
+        else:
+            pred = self.trainer.get_predictor(self.input_names, self.output_names)
+        if self.rnn_state_size:
+            self.pred_funcs = [StepPredictor(pred, self.rnn_state_size, self.obs_channels)
+                               for _ in range(NR_PROC)]
+        else:
+            self.pred_funcs = [pred] * NR_PROC
 
     def _trigger(self):
         t = time.time()
+        early_stop = None
+        if self.tolerance is not None or self.time_budget is not None:
+            early_stop = EarlyStopping(self.tolerance, self.time_budget)
         mean, max = eval_with_funcs(
-            self.pred_funcs, self.eval_episode, self.get_player_fn)
+            self.pred_funcs, self.eval_episode, self.get_player_fn, early_stop)
         t = time.time() - t
-        if t > 10 * 60:  # eval takes too long
+        if t > 10 * 60 and self.time_budget is None:  # eval takes too long
             self.eval_episode = int(self.eval_episode * 0.94)
         self.trainer.monitors.put_scalar('mean_score', mean)
         self.trainer.monitors.put_scalar('max_score', max)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import os
+import json
+import time
+import threading
+from multiprocessing.connection import Listener, Client
+
+from tensorpack.utils import logger, get_tqdm
+from tensorpack.utils.concurrency import LoopThread
+
+from augment_expreplay import AugmentExperience
+from shared_expreplay import SharedExpReplay
+from frame_history import FrameHistory
+
+__all__ = ['parse_address', 'read_authkey', 'encode_arrays', 'send_parts', 'recv_arrays',
+           'actor_exploration', 'RemoteExpReplay', 'run_actor']
+
+# environment variable with the shared secret of the learner and its actors
+AUTHKEY_ENV = 'DPIQN_AUTHKEY'
+
+
+def parse_address(address):
+    """ 'host:port' for TCP, anything else is the path of a Unix socket """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or 'localhost', int(port))
+    return address
+
+
+def read_authkey(path=None):
+    """ the shared secret of the learner and its actors, from the file `path`,
+        or else from the environment variable DPIQN_AUTHKEY. None if neither is given. """
+    if path is not None:
+        with open(path, 'rb') as f:
+            key = f.read().strip()
+        assert key, "The authkey file {} is empty".format(path)
+        return key
+    key = os.environ.get(AUTHKEY_ENV)
+    return key.encode() if key else None
+
+
+def encode_arrays(kind, arrays=(), **info):
+    """
+    The parts of a message for :func:`send_parts`: a JSON header with `kind`,
+    `info` and the dtype and shape of each of the named `arrays`, then the raw
+    bytes of each array. Nothing on the wire is unpickled by the receiver.
+
+    Args:
+        arrays: a list of (name, array) pairs.
+    """
+    arrays = [(name, np.asarray(x, order='C')) for name, x in arrays]
+    header = dict(info, kind=kind, arrays=[[name, x.dtype.str, x.shape] for name, x in arrays])
+    return [json.dumps(header).encode()] + [memoryview(x.reshape(-1)).cast('B') for _, x in arrays]
+
+
+def send_parts(conn, parts):
+    for part in parts:
+        conn.send_bytes(part)
+
+
+def recv_arrays(conn):
+    """ Returns: the header and the list of (name, array) pairs of a message of :func:`encode_arrays` """
+    header = json.loads(conn.recv_bytes().decode())
+    arrays = []
+    for name, dtype, shape in header.pop('arrays'):
+        dtype = np.dtype(dtype)
+        if dtype.hasobject:
+            raise ValueError("Refuse to receive an array of objects")
+        x = np.frombuffer(conn.recv_bytes(), dtype=dtype)
+        arrays.append((name, x.reshape(shape)))
+    return header, arrays
+
+
+def actor_exploration(actor_id, nr_actor, eps=0.4, alpha=7):
+    """ the fixed epsilon of an actor, spread over the actors as in
+        `Distributed Prioritized Experience Replay <https://arxiv.org/abs/1803.00933>`_ """
+    if nr_actor <= 1:
+        return eps
+    return eps ** (1 + actor_id * alpha / (nr_actor - 1.0))
+
+
+class RemoteExpReplay(SharedExpReplay):
+    """
+    :class:`SharedExpReplay` filled by actors in other processes or on other
+    hosts, which connect to `address` and run :func:`run_actor`.
+    Every connection appends to its own chunks of the memory, and the
+    trainable weights are sent to all actors every `weight_period` steps.
+    The actors aren't throttled, and use their own exploration.
+    The connections are authenticated with `authkey` (see :func:`read_authkey`),
+    which is required to listen on TCP.
+    """
+
+    def __init__(self, address, num_actions, state_shape, batch_size,
+                 memory_size, init_memory_size, init_exploration,
+                 update_frequency, history_len, num_agents=1, chunk_size=256,
+                 weight_period=400, authkey=None, nr_sampler=0, prefetch=4):
+        """
+        Args:
+            address: to listen on, see :func:`parse_address`.
+            weight_period (int): number of training steps between two weight broadcasts.
+            authkey (bytes): shared secret of the actors, optional only on a Unix socket.
+        """
+        if isinstance(address, tuple) and not authkey:
+            raise ValueError("Refuse to listen on {}:{} without an authkey, set --authkey_file or {}.".format(
+                address[0], address[1], AUTHKEY_ENV))
+        self.address = address
+        self.weight_period = weight_period
+        self.authkey = authkey
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        self._weights = None
+        self._new_weights = threading.Event()
+        self._nr_step = 0
+        super(RemoteExpReplay, self).__init__(
+            None, 0, num_actions, state_shape, batch_size, memory_size, init_memory_size,
+            init_exploration, update_frequency, history_len, num_agents, chunk_size,
+            nr_sampler=nr_sampler, prefetch=prefetch)
+
+    def _start_actors(self):
+        self._listener = Listener(self.address, authkey=self.authkey)
+        logger.info("Waiting for actors on {} ...".format(self._listener.address))
+        th = threading.Thread(target=self._accept_loop, name="ActorListener")
+        th.daemon = True
+        th.start()
+        th = LoopThread(self._broadcast, pausable=False)
+        th.name = "WeightBroadcaster"
+        th.daemon = True
+        th.start()
+
+    def _accept_loop(self):
+        while True:
+            conn = self._listener.accept()
+            th = threading.Thread(target=self._serve, args=(conn,))
+            th.daemon = True
+            th.start()
+
+    def _serve(self, conn):
+        """ append the transitions of one actor """
+        mem = self.mem.attach_writer()
+        actor_id = recv_arrays(conn)[0]['actor_id']
+        th = threading.current_thread()
+        th.name = "Actor-{}".format(actor_id)
+        logger.info("Actor {} connected.".format(actor_id))
+        with self._conns_lock:
+            self._conns.append(conn)
+            # the newcomer gets the current weights with the next broadcast
+            if self._weights is not None:
+                self._new_weights.set()
+        try:
+            while True:
+                _, arrays = recv_arrays(conn)
+                batch = dict(arrays)
+                for exp in zip(batch['state'], batch['action'], batch['reward'],
+                               batch['isOver'], batch['action_o']):
+                    mem.append(AugmentExperience(*exp))
+                for s in batch['score']:
+                    self._score_queue.put(s)
+        except (EOFError, OSError, ValueError, KeyError):
+            logger.warn("Actor {} disconnected.".format(actor_id))
+        finally:
+            with self._conns_lock:
+                self._conns.remove(conn)
+            conn.close()
+
+    def _broadcast(self):
+        self._new_weights.wait()
+        self._new_weights.clear()
+        with self._conns_lock:
+            conns = list(self._conns)
+        if not conns:
+            return
+        # encoded once for all actors
+        parts = encode_arrays('weights', sorted(self._weights.items()))
+        for conn in conns:
+            try:
+                send_parts(conn, parts)
+            except (EOFError, OSError):
+                pass
+
+    def _init_memory(self):
+        logger.info("Populating replay memory with remote actors ...")
+        self._start_actors()
+        with get_tqdm(total=self.init_memory_size) as pbar:
+            while len(self.mem) < self.init_memory_size:
+                time.sleep(0.5)
+                pbar.update(len(self.mem) - pbar.n)
+        self._init_memory_flag.set()
+
+    def _setup_graph(self):
+        import tensorflow as tf
+        self._weight_vars = [v for v in tf.trainable_variables() if not v.op.name.startswith('target')]
+
+    def _publish(self, weights):
+        """ send `weights`, a dict from variable names to values, with the next broadcast """
+        self._weights = weights
+        self._new_weights.set()
+
+    def _before_train(self):
+        # the actors start from the initial weights, not from random actions
+        values = self.trainer.sess.run(self._weight_vars)
+        self._publish({v.op.name: x for v, x in zip(self._weight_vars, values)})
+        super(RemoteExpReplay, self)._before_train()
+
+    def _before_run(self, _):
+        import tensorflow as tf
+        self._nr_step += 1
+        if self._nr_step % self.weight_period == 0:
+            return tf.train.SessionRunArgs(fetches=self._weight_vars)
+
+    def _after_run(self, _, run_values):
+        if run_values.results is not None:
+            self._publish({v.op.name: x for v, x in zip(self._weight_vars, run_values.results)})
+
+    def _trigger_epoch(self):
+        super(RemoteExpReplay, self)._trigger_epoch()
+        with self._conns_lock:
+            self.trainer.monitors.put_scalar('expreplay/nr_actor', len(self._conns))
+
+
+def run_actor(address, player, predictor, history_len, actor_id=0, nr_actor=1,
+              send_size=64, authkey=None):
+    """
+    Play with `player` forever and send the transitions to a :class:`RemoteExpReplay`.
+
+    Args:
+        predictor: an `OfflinePredictor` of the Q values from the history
+            state, whose weights are replaced by the ones of the learner,
+            with its `load_weights(weights)` method if it has one.
+        send_size (int): number of transitions sent at once.
+        authkey (bytes): the one of the learner.
+    """
+    conn = Client(address, authkey=authkey)
+    send_parts(conn, encode_arrays('hello', actor_id=actor_id))
+    exploration = actor_exploration(actor_id, nr_actor)
+    logger.info("Actor {} connected to {}, epsilon={:.4f}".format(actor_id, address, exploration))
+    rng = np.random.RandomState((os.getpid() + actor_id * 7919) % (2 ** 31))
+    num_actions = player.get_action_space().num_actions()
+    history = None
+    has_weights = False
+    columns = {k: [] for k in ['state', 'action', 'reward', 'isOver', 'action_o']}
+    while True:
+        # only the newest weights matter
+        weights = None
+        while conn.poll():
+            weights = dict(recv_arrays(conn)[1])
+        if weights is not None:
+            if hasattr(predictor, 'load_weights'):
+                predictor.load_weights(weights)
+            else:
+                from tensorpack.tfutils.sessinit import DictRestore
+                DictRestore(weights).init(predictor.sess)
+            has_weights = True
+
+        old_s = player.current_state()
+        if history is None:
+            history = FrameHistory(old_s.shape, history_len)
+        if not has_weights or rng.rand() <= exploration:
+            act = rng.choice(num_actions)
+            history.push(old_s)
+        else:
+            q_values = predictor([[history.peek(old_s)]])[0][0]
+            act = np.argmax(q_values)
+            history.push(old_s)
+        reward, isOver = player.action(act)
+        if isOver:
+            history.reset()
+        for k, v in zip(['state', 'action', 'reward', 'isOver', 'action_o'],
+                        [old_s, act, reward, isOver, player.get_internal_state()['agent_actions'][1:]]):
+            columns[k].append(v)
+        if len(columns['action']) >= send_size:
+            # with the scores of the episodes finished since the last batch
+            arrays = [(k, np.asarray(v)) for k, v in sorted(columns.items())]
+            arrays.append(('score', np.asarray(player.stats['score'], dtype='float64')))
+            send_parts(conn, encode_arrays('exp', arrays))
+            columns = {k: [] for k in columns}
+            player.reset_stat()
+
+
+class _LoopbackPlayer(object):
+    """ a stub player for :func:`check_loopback`. Frame t of actor i has i + 1
+        in its first pixel and t in the next two, an episode ends every `episode_len` steps """
+
+    def __init__(self, actor_id, num_actions, shape=(8, 8), episode_len=10):
+        self.actor_id = actor_id
+        self.num_actions = num_actions
+        self.shape = shape
+        self.episode_len = episode_len
+        self._t = 0
+        self._act = 0
+        self.reset_stat()
+
+    def current_state(self):
+        s = np.zeros(self.shape, dtype='uint8')
+        s[0, 0] = self.actor_id + 1
+        s[0, 1], s[0, 2] = divmod(self._t % 65536, 256)
+        return s
+
+    def get_action_space(self):
+        from tensorpack.RL.envbase import DiscreteActionSpace
+        return DiscreteActionSpace(self.num_actions)
+
+    def action(self, act):
+        self._t += 1
+        self._act = act
+        isOver = self._t % self.episode_len == 0
+        if isOver:
+            self.stats['score'].append(float(self.actor_id))
+        return 1.0, isOver
+
+    def get_internal_state(self):
+        return {'agent_actions': [self._act, 0]}
+
+    def reset_stat(self):
+        self.stats = {'score': []}
+
+
+class _LoopbackPredictor(object):
+    """ a stub predictor for :func:`check_loopback`, whose Q values are its weight 'w' """
+
+    def __init__(self, num_actions):
+        self.num_actions = num_actions
+        self.weight = None
+
+    def load_weights(self, weights):
+        self.weight = float(weights['w'])
+
+    def __call__(self, dp):
+        return [np.full((len(dp[0]), self.num_actions), self.weight, dtype='float32')]
+
+
+def check_loopback(nr_actor=3, history_len=4, init_memory_size=2000, timeout=60):
+    """
+    Run a :class:`RemoteExpReplay` and `nr_actor` :func:`run_actor` threads
+    with stub players and predictors over a Unix socket, and assert that the
+    actors fill the memory, that the sampled windows are consecutive frames
+    of one actor, that every actor gets the weights of the learner, and that
+    the learner gets the episode scores of every actor.
+    """
+    import tempfile
+    num_actions = 5
+    address = os.path.join(tempfile.mkdtemp(prefix='dpiqn-loopback-'), 'learner.sock')
+    authkey = b'loopback'
+    learner = RemoteExpReplay(address, num_actions, (8, 8), 64, 10 * init_memory_size, init_memory_size,
+                              1.0, 4, history_len, chunk_size=64, weight_period=1, authkey=authkey)
+    learner._publish({'w': np.float32(1)})
+    th = threading.Thread(target=learner._init_memory, name="LoopbackLearner")
+    th.daemon = True
+    th.start()
+    deadline = time.time() + timeout
+    while not hasattr(learner, '_listener'):
+        assert time.time() < deadline, "The learner doesn't listen."
+        time.sleep(0.01)
+    predictors = []
+    for i in range(nr_actor):
+        predictors.append(_LoopbackPredictor(num_actions))
+        actor = threading.Thread(
+            target=run_actor, name="LoopbackActor-{}".format(i),
+            args=(address, _LoopbackPlayer(i, num_actions), predictors[-1], history_len, i, nr_actor, 16, authkey))
+        actor.daemon = True
+        actor.start()
+
+    # memory fill
+    th.join(max(deadline - time.time(), 0))
+    assert learner._init_memory_flag.is_set(), \
+        "{} of {} transitions after {}s".format(len(learner.mem), init_memory_size, timeout)
+    actor_ids = set(np.unique(learner.mem.state[learner.mem.stamp >= 0][:, 0, 0]))
+    assert actor_ids >= set(range(1, nr_actor + 1)), actor_ids
+
+    # window contiguity, the frames of a previous episode are zero
+    state = learner.mem.sample_uniform(256, np.random.RandomState(0))[0]
+    for b, window in enumerate(np.moveaxis(state, -1, 1)):
+        kept = window[:, 0, 0] > 0
+        assert kept[-1] and np.all(kept[1:] >= kept[:-1]), (b, kept)
+        frames = window[kept].astype('int64')
+        assert np.all(frames[:, 0, 0] == frames[0, 0, 0]), (b, frames[:, 0, 0])
+        t = frames[:, 0, 1] * 256 + frames[:, 0, 2]
+        assert np.all(np.diff(t) == 1), (b, t)
+
+    # weight delivery to every actor
+    learner._publish({'w': np.float32(7)})
+    while not all(p.weight == 7 for p in predictors):
+        assert time.time() < deadline, "Weights received: {}".format([p.weight for p in predictors])
+        time.sleep(0.01)
+
+    # the scores of the finished episodes, then nothing reads them any more
+    scores = set(learner.player.stats['score'])
+    assert scores >= set(range(nr_actor)), scores
+    learner._score_queue.cancel_join_thread()
+    return len(learner.mem)
+
+
+if __name__ == '__main__':
+    size = check_loopback()
+    print("Loopback check passed, {} transitions in the memory.".format(size))
@@ -4,7 +4,9 @@
 # Author: Yuxin Wu <ppwwyyxxc@gmail.com>
 
 import numpy as np
-import copy
+import os
+import json
+import tempfile
 from collections import deque, namedtuple
 import threading
 import six
@@ -13,90 +15,307 @@ from six.moves import queue, range
 from tensorpack.dataflow import DataFlow
 from tensorpack.utils import logger, get_tqdm, get_rng
 from tensorpack.utils.concurrency import LoopThread, ShareSessionThread
+from tensorpack.tfutils.common import get_global_step_value
 from tensorpack.callbacks.base import Callback
 
-__all__ = ['ExpReplay']
+from predictor_broker import get_shared_broker
+from frame_history import FrameHistory
+import hotpath
+
+__all__ = ['ExpReplay', 'ReplayMemorySaver']
 
 Experience = namedtuple('Experience',
                         ['state', 'action', 'reward', 'isOver'])
 
 
+def stack_history(frames):
+    """ stack a list of (H, W) or (H, W, C) frames into a (H, W, len * C) network input """
+    ret = np.stack(frames, axis=2)
+    return ret.reshape(ret.shape[:2] + (-1,))
+
+
+def check_snapshot_step(meta, step):
+    """ raise ValueError if the snapshot of `meta` wasn't saved at global step `step` (when not None) """
+    if step is not None and meta.get('step') != step:
+        raise ValueError("Snapshot was saved at step {}, not at step {} of the checkpoint".format(
+            meta.get('step'), step))
+
+
 class ReplayMemory(object):
-    def __init__(self, max_size, state_shape, history_len):
-        self.max_size = int(max_size)
+    def __init__(self, max_size, state_shape, history_len, storage_dir=None, num_streams=1, renderer=None):
+        """
+        Args:
+            storage_dir (str or None): if given, the columns are `np.memmap` files
+                under this directory instead of in-memory arrays.
+            num_streams (int): number of environments stepped together. Their
+                transitions are interleaved, so the history of a stream is every
+                `num_streams`-th row. Use :meth:`append_batch` when it's larger than 1.
+            renderer (FastRenderer or None): if given, the memory keeps symbolic
+                states and this renderer draws the frames of the sampled windows.
+                `state_shape` is still the shape of a frame.
+        """
+        self.num_streams = int(num_streams)
+        self.max_size = int(max_size) // self.num_streams * self.num_streams
         self.state_shape = state_shape
         self.history_len = int(history_len)
+        if storage_dir is not None:
+            logger.info("Replay memory is backed by files under {}".format(storage_dir))
+        self.storage_dir = storage_dir
+        self.renderer = renderer
+        if renderer is not None:
+            assert renderer.out_shape == tuple(state_shape), (renderer.out_shape, state_shape)
+            stored_shape = renderer.symbolic_shape
+        else:
+            stored_shape = state_shape
 
-        self.state = np.zeros((self.max_size,) + state_shape, dtype='uint8')
-        self.action = np.zeros((self.max_size,), dtype='int32')
-        self.reward = np.zeros((self.max_size,), dtype='float32')
-        self.isOver = np.zeros((self.max_size,), dtype='bool')
+        self.state = self._alloc('state', (self.max_size,) + stored_shape, 'uint8')
+        self.action = self._alloc('action', (self.max_size,), 'int32')
+        self.reward = self._alloc('reward', (self.max_size,), 'float32')
+        self.isOver = self._alloc('isOver', (self.max_size,), 'bool')
+
+        self._columns = ['state', 'action', 'reward', 'isOver']
 
         self._curr_size = 0
         self._curr_pos = 0
-        self._hist = deque(maxlen=history_len - 1)
+        self._num_appended = 0
+        self._hists = [deque(maxlen=history_len - 1) for _ in range(self.num_streams)]
+        self._hist = self._hists[0]
+        # the network input of the current state of each stream, built in place
+        self._frame_hists = None
+        if renderer is None:
+            self._frame_hists = [FrameHistory(state_shape, history_len) for _ in range(self.num_streams)]
+        self._snapshot_dir = None
+        self._snapshot_segments = []
+        # held by the writers and by save_snapshot, so a snapshot doesn't see half an append
+        self._write_lock = threading.Lock()
+        self._batch_bufs = {}
+
+    def _alloc(self, name, shape, dtype):
+        """ allocate a zero-filled column, either in memory or on disk """
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        # a file of its own, so several memories can share the directory
+        fd, fname = tempfile.mkstemp(prefix='replay-{}-'.format(name), suffix='.dat', dir=self.storage_dir)
+        os.close(fd)
+        arr = np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+        # the mapping keeps the file alive; unlinking it now lets the OS reclaim
+        # the space when the process exits, even if it gets killed
+        os.unlink(fname)
+        return arr
 
     def append(self, exp):
         """
         Args:
             exp (Experience):
         """
-        if self._curr_size < self.max_size:
-            self._assign(self._curr_pos, exp)
-            self._curr_pos = (self._curr_pos + 1) % self.max_size
-            self._curr_size += 1
-        else:
-            self._assign(self._curr_pos, exp)
-            self._curr_pos = (self._curr_pos + 1) % self.max_size
+        with self._write_lock:
+            if self._curr_size < self.max_size:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+                self._curr_size += 1
+            else:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+            self._num_appended += 1
+            self._push_history(0, exp)
+
+    def append_batch(self, exps):
+        """
+        Args:
+            exps (list): one :class:`Experience` for each stream.
+        """
+        assert len(exps) == self.num_streams
+        with self._write_lock:
+            for exp in exps:
+                self._assign(self._curr_pos, exp)
+                self._curr_pos = (self._curr_pos + 1) % self.max_size
+            self._curr_size = min(self._curr_size + self.num_streams, self.max_size)
+            self._num_appended += self.num_streams
+            for i, exp in enumerate(exps):
+                self._push_history(i, exp)
+
+    def _push_history(self, stream, exp):
+        hist = self._hists[stream]
+        fhist = self._frame_hists[stream] if self._frame_hists is not None else None
         if exp.isOver:
-            self._hist.clear()
+            hist.clear()
+            if fhist is not None:
+                fhist.reset()
         else:
-            self._hist.append(exp)
-
-    def recent_state(self):
-        """ return a list of (hist_len-1,) + STATE_SIZE """
-        lst = list(self._hist)
-        states = [np.zeros(self.state_shape, dtype='uint8')] * (self._hist.maxlen - len(lst))
-        states.extend([k.state for k in lst])
-        return states
-
-    def sample(self, idx):
-        """ return a tuple of (s,r,a,o),
-            where s is of shape STATE_SIZE + (hist_len+1,)"""
-        idx = (self._curr_pos + idx) % self._curr_size
-        k = self.history_len + 1
-        if idx + k <= self._curr_size:
-            state = self.state[idx: idx + k]
-            reward = self.reward[idx: idx + k]
-            action = self.action[idx: idx + k]
-            isOver = self.isOver[idx: idx + k]
+            hist.append(exp)
+            if fhist is not None:
+                fhist.push(exp.state)
+
+    def history_state(self, state, stream=0):
+        """ return the network input of `state` following the recent history of a stream.
+            Without a renderer, it's a view that is only valid until the next append. """
+        if self.renderer is None:
+            return self._frame_hists[stream].peek(state)
+        states = [k.state for k in self._hists[stream]]
+        states.append(state)
+        frames = np.zeros((self.history_len,) + self.state_shape, dtype='uint8')
+        frames[-len(states):] = self.renderer.render_batch(np.asarray(states))
+        return stack_history(frames)
+
+    def sample_batch(self, idx, buffers=None):
+        """ sample the transitions of an array of indices.
+
+        Args:
+            idx (np.ndarray): indices of the first frame of each window, counted
+                from the oldest row in the memory.
+            buffers (list or None): from :meth:`new_batch_buffers`, to fill
+                instead of the buffers shared by the calls without it.
+        Returns:
+            list: [state, action, reward, isOver] ready to be used as a datapoint,
+            where state is of shape (batch,) + STATE_SIZE + (hist_len+1,).
+            The arrays are preallocated and reused by the next call with the same buffers.
+        """
+        rows = self._window_rows(idx)
+        frames, state, action, reward, isOver = self._get_batch_buffers(len(idx), buffers)
+        over = self._gather_state(rows, state, frames)
+        last = rows[:, -2]
+        np.take(self.action, last, out=action, mode='clip')
+        np.take(self.reward, last, out=reward, mode='clip')
+        isOver[:] = over[:, -2]
+        return [state, action, reward, isOver]
+
+    def _window_rows(self, idx):
+        """ return a (batch, hist_len+1) array of memory rows, covering the ring-buffer wraparound """
+        start = (self._curr_pos + np.asarray(idx)) % self._curr_size
+        offset = np.arange(self.history_len + 1) * self.num_streams
+        return (start[:, np.newaxis] + offset) % self._curr_size
+
+    def _gather_state(self, rows, out, frames):
+        """ gather the frames of all windows into `out`, through the (batch, hist_len+1) + STATE_SIZE
+            scratch `frames`, and zero the frames which belong to a previous episode.
+            Returns the isOver of the windows. """
+        isOver = self.isOver[rows]
+        if self.renderer is not None:
+            states = self.state[rows.ravel()]
+            frames.reshape((-1,) + self.state_shape)[...] = self.renderer.render_batch(states)
         else:
-            end = idx + k - self._curr_size
-            state = self._slice(self.state, idx, end)
-            reward = self._slice(self.reward, idx, end)
-            action = self._slice(self.action, idx, end)
-            isOver = self._slice(self.isOver, idx, end)
-        ret = self._pad_sample(state, reward, action, isOver)
-        return ret
-
-    # the next_state is a different episode if current_state.isOver==True
-    def _pad_sample(self, state, reward, action, isOver):
-        for k in range(self.history_len - 2, -1, -1):
-            if isOver[k]:
-                state = copy.deepcopy(state)
-                state[:k + 1].fill(0)
-                break
-        state = state.transpose(1, 2, 0)
-        return (state, reward[-2], action[-2], isOver[-2])
-
-    def _slice(self, arr, start, end):
-        s1 = arr[start:]
-        s2 = arr[:end]
-        return np.concatenate((s1, s2), axis=0)
+            np.take(self.state, rows, axis=0, out=frames, mode='clip')
+        # the next_state is a different episode if current_state.isOver==True:
+        # everything up to the last isOver before the current frame is cleared
+        over = isOver[:, :self.history_len - 1]
+        mask = np.logical_or.accumulate(over[:, ::-1], axis=1)[:, ::-1]
+        frames[:, :self.history_len - 1][mask] = 0
+        # (B, k, H, W, C) -> (B, H, W, k * C)
+        frames = frames.reshape(frames.shape[:4] + (-1,))
+        out.reshape(out.shape[:3] + frames.shape[1:2] + frames.shape[4:])[...] = frames.transpose(0, 2, 3, 1, 4)
+        return isOver
+
+    def new_batch_buffers(self, batch_size):
+        """ allocate the arrays :meth:`sample_batch` fills: a frame scratch, followed by the datapoint """
+        k = self.history_len + 1
+        channels = k * int(np.prod(self.state_shape[2:]))
+        bufs = [np.zeros((batch_size, k) + self.state_shape, dtype='uint8'),
+                np.zeros((batch_size,) + self.state_shape[:2] + (channels,), dtype='uint8')]
+        bufs.extend(np.zeros(shape, dtype=dtype) for shape, dtype in self._batch_spec(batch_size))
+        return bufs
+
+    def _get_batch_buffers(self, batch_size, buffers=None):
+        if buffers is not None:
+            return buffers
+        bufs = self._batch_bufs.get(batch_size)
+        if bufs is None:
+            bufs = self._batch_bufs[batch_size] = self.new_batch_buffers(batch_size)
+        return bufs
+
+    def _batch_spec(self, batch_size):
+        """ (shape, dtype) of the non-state columns in a batch """
+        return [((batch_size,), 'int8'), ((batch_size,), 'float32'), ((batch_size,), 'bool')]
 
     def __len__(self):
         return self._curr_size
 
+    def save_snapshot(self, path, step=None):
+        """ Save the memory under directory `path`, blocking the writers meanwhile.
+            If the previous snapshot went to the same directory, only the entries
+            appended since then are written, as a new segment file.
+
+            Args:
+                step (int or None): the global step of the model checkpoint saved with it.
+        """
+        with self._write_lock:
+            self._save_snapshot(path, step)
+
+    def _save_snapshot(self, path, step):
+        if self._snapshot_dir != path:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self._snapshot_dir = path
+            self._snapshot_segments = []
+            start = 0
+        else:
+            start = self._snapshot_segments[-1]['end'] if self._snapshot_segments else 0
+        end = self._num_appended
+        # entries older than one full ring have been overwritten anyway
+        start = max(start, end - self.max_size)
+        if end > start:
+            rows = np.arange(start, end) % self.max_size
+            fname = 'segment-{:012d}.npz'.format(end)
+            np.savez(os.path.join(path, fname), **{c: getattr(self, c)[rows] for c in self._columns})
+            self._snapshot_segments.append({'file': fname, 'start': start, 'end': end})
+
+        # drop the segments which are completely overwritten
+        segments = []
+        for seg in self._snapshot_segments:
+            if seg['end'] <= end - self.max_size:
+                os.remove(os.path.join(path, seg['file']))
+            else:
+                segments.append(seg)
+        self._snapshot_segments = segments
+
+        meta = {'max_size': self.max_size,
+                'step': step,
+                'num_appended': end,
+                'curr_pos': end % self.max_size,
+                'curr_size': min(end, self.max_size),
+                'hist_len': [len(hist) for hist in self._hists],
+                'segments': segments}
+        tmp = os.path.join(path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(path, 'meta.json'))
+
+    def load_snapshot(self, path, step=None):
+        """ Restore the memory from a directory written by :meth:`save_snapshot`.
+
+            Args:
+                step (int or None): if given, raise ValueError unless the snapshot
+                    was saved at this global step.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        check_snapshot_step(meta, step)
+        assert meta['max_size'] == self.max_size, \
+            "Snapshot has memory size {}, expect {}".format(meta['max_size'], self.max_size)
+        for seg in meta['segments']:
+            rows = np.arange(seg['start'], seg['end']) % self.max_size
+            data = np.load(os.path.join(path, seg['file']))
+            for c in self._columns:
+                getattr(self, c)[rows] = data[c]
+        self._num_appended = meta['num_appended']
+        self._curr_pos = meta['curr_pos']
+        self._curr_size = meta['curr_size']
+        # the most recent row of stream i is at curr_pos - num_streams + i
+        for i, (hist, hist_len) in enumerate(zip(self._hists, meta['hist_len'])):
+            hist.clear()
+            for k in range(hist_len, 0, -1):
+                pos = self._curr_pos - (k - 1) * self.num_streams - self.num_streams + i
+                hist.append(self._get_exp(pos % self.max_size))
+            if self._frame_hists is not None:
+                self._frame_hists[i].reset()
+                for exp in hist:
+                    self._frame_hists[i].push(exp.state)
+        # keep appending segments to the same directory
+        self._snapshot_dir = path
+        self._snapshot_segments = meta['segments']
+
+    def _get_exp(self, pos):
+        return Experience(self.state[pos], self.action[pos], self.reward[pos], self.isOver[pos])
+
     def _assign(self, pos, exp):
         self.state[pos] = exp.state
         self.reward[pos] = exp.reward
@@ -124,7 +343,8 @@ class ExpReplay(DataFlow, Callback):
                  batch_size,
                  memory_size, init_memory_size,
                  init_exploration,
-                 update_frequency, history_len):
+                 update_frequency, history_len, memory_dir=None,
+                 predictor_broker=None, symbolic_renderer=None, nr_sampler=0, prefetch=4):
         """
         Args:
             predictor_io_names (tuple of list of str): input/output names to
@@ -134,6 +354,18 @@ class ExpReplay(DataFlow, Callback):
                 initial frames.
             update_frequency (int): number of new transitions to add to memory
                 after sampling a batch of transitions for training.
+            memory_dir (str or None): keep the replay memory in memory-mapped
+                files under this directory.
+            predictor_broker (dict or None): if given, predict through a
+                :class:`PredictorBroker` shared with other consumers of the same
+                predictor, created with these arguments.
+            symbolic_renderer (FastRenderer or None): if given, store the
+                symbolic states of the player in the memory and render the
+                frames when they are needed.
+            nr_sampler (int): number of threads assembling batches in the
+                background. 0 to assemble each batch when it's requested.
+            prefetch (int): number of assembled batches the sampler threads
+                keep ready.
         """
         init_memory_size = int(init_memory_size)
 
@@ -141,6 +373,8 @@ class ExpReplay(DataFlow, Callback):
             if k != 'self':
                 setattr(self, k, v)
         self.exploration = init_exploration
+        # a vectorized player steps several environments together
+        self.num_envs = getattr(player, 'num_envs', 1)
         self.num_actions = player.get_action_space().num_actions()
         logger.info("Number of Legal actions: {}".format(self.num_actions))
 
@@ -149,26 +383,60 @@ class ExpReplay(DataFlow, Callback):
 
         # a queue to receive notifications to populate memory
         self._populate_job_queue = queue.Queue(maxsize=5)
-
-        self.mem = ReplayMemory(memory_size, state_shape, history_len)
+        # batches being assembled or waiting to be trained on are not sampled
+        # from the rows the simulator may overwrite in the meantime
+        nr_pending = self._populate_job_queue.maxsize
+        if nr_sampler:
+            nr_pending += prefetch + nr_sampler
+        # a job adds update_frequency transitions on average, in steps of num_envs
+        self._sample_guard = nr_pending * -(-update_frequency // self.num_envs) * self.num_envs
+        self._sampler_ths = []
+
+        self.mem = self._get_memory()
+        # per-stage timings of the simulator, None unless enabled by hotpath.enable()
+        self._timer = hotpath.get_timer()
+
+    def _get_memory(self):
+        return ReplayMemory(self.memory_size, self.state_shape, self.history_len,
+                            self.memory_dir, self.num_envs, self.symbolic_renderer)
+
+    def _get_player_state(self):
+        if self.symbolic_renderer is not None:
+            return self.player.symbolic_state()
+        return self.player.current_state()
 
     def get_simulator_thread(self):
         # spawn a separate thread to run policy
+        # each step adds num_envs transitions, the fraction of a step left is carried to the next job
+        credit = [0.0]
+
         def populate_job_func():
+            tm = self._timer
+            if tm:
+                t = tm.now()
             self._populate_job_queue.get()
-            for _ in range(self.update_frequency):
+            if tm:
+                tm.add('idle', t)
+            credit[0] += float(self.update_frequency) / self.num_envs
+            nr_populate = int(credit[0])
+            credit[0] -= nr_populate
+            for _ in range(nr_populate):
                 self._populate_exp()
         th = ShareSessionThread(LoopThread(populate_job_func, pausable=False))
         th.name = "SimulatorThread"
         return th
 
     def _init_memory(self):
+        if len(self.mem) >= self.init_memory_size:
+            logger.info("Replay memory already has {} entries, skip populating.".format(len(self.mem)))
+            self._init_memory_flag.set()
+            return
         logger.info("Populating replay memory with epsilon={} ...".format(self.exploration))
 
         with get_tqdm(total=self.init_memory_size) as pbar:
             while len(self.mem) < self.init_memory_size:
                 self._populate_exp()
-                pbar.update()
+                pbar.update(self.num_envs)
         self._init_memory_flag.set()
 
     # quickly fill the memory for debug
@@ -185,20 +453,72 @@ class ExpReplay(DataFlow, Callback):
 
     def _populate_exp(self):
         """ populate a transition by epsilon-greedy"""
-        old_s = self.player.current_state()
+        if self.num_envs > 1:
+            self._populate_exp_batch()
+            return
+        tm = self._timer
+        if tm:
+            t = tm.now()
+        old_s = self._get_player_state()
+        if tm:
+            t = tm.add('current_state', t)
         if self.rng.rand() <= self.exploration or (len(self.mem) <= self.history_len):
             act = self.rng.choice(range(self.num_actions))
         else:
             # build a history state
-            history = self.mem.recent_state()
-            history.append(old_s)
-            history = np.stack(history, axis=2)
+            history = self.mem.history_state(old_s)
+            if tm:
+                t = tm.add('history', t)
 
             # assume batched network
             q_values = self.predictor([[history]])[0][0]  # this is the bottleneck
             act = np.argmax(q_values)
+            if tm:
+                t = tm.add('predict', t)
         reward, isOver = self.player.action(act)
+        if tm:
+            t = tm.add('action', t)
         self.mem.append(Experience(old_s, act, reward, isOver))
+        if tm:
+            tm.add('append', t)
+
+    def _select_actions(self, old_s):
+        """ epsilon-greedy actions for all the environments of a vectorized player,
+            with one batched predictor call for the greedy ones """
+        act = self.rng.choice(self.num_actions, size=self.num_envs)
+        greedy = np.flatnonzero(self.rng.rand(self.num_envs) > self.exploration)
+        if len(greedy) and len(self.mem) > self.history_len * self.num_envs:
+            tm = self._timer
+            if tm:
+                t = tm.now()
+            history = [self.mem.history_state(old_s[i], i) for i in greedy]
+            if tm:
+                t = tm.add('history', t)
+            q_values = self.predictor([history])[0]
+            act[greedy] = np.argmax(q_values, axis=1)
+            if tm:
+                tm.add('predict', t)
+        return act
+
+    def _populate_exp_batch(self):
+        """ populate a transition for each environment of a vectorized player """
+        tm = self._timer
+        if tm:
+            t = tm.now()
+        # the player reuses its observation buffer
+        old_s = self._get_player_state().copy()
+        if tm:
+            t = tm.add('current_state', t)
+        act = self._select_actions(old_s)
+        if tm:
+            t = tm.now()
+        reward, isOver = self.player.action(act)
+        if tm:
+            t = tm.add('action', t)
+        self.mem.append_batch([Experience(old_s[i], act[i], reward[i], isOver[i])
+                               for i in range(self.num_envs)])
+        if tm:
+            tm.add('append', t)
 
     def _debug_sample(self, sample):
         import cv2
@@ -219,25 +539,51 @@ class ExpReplay(DataFlow, Callback):
         # wait for memory to be initialized
         self._init_memory_flag.wait()
 
-        while True:
-            idx = self.rng.randint(
-                self._populate_job_queue.maxsize * self.update_frequency,
-                len(self.mem) - self.history_len - 1,
-                size=self.batch_size)
-            batch_exp = [self.mem.sample(i) for i in idx]
+        if not self.nr_sampler:
+            while True:
+                yield self._sample_batch()
+                self._populate_job_queue.put(1)
 
-            yield self._process_batch(batch_exp)
+        if not self._sampler_ths:
+            self._start_samplers()
+        while True:
+            buffers, dp = self._ready_batches.get()
+            yield dp
+            # the datapoint has been consumed once the next one is requested
+            self._free_buffers.put(buffers)
             self._populate_job_queue.put(1)
 
-    def _process_batch(self, batch_exp):
-        state = np.asarray([e[0] for e in batch_exp], dtype='uint8')
-        reward = np.asarray([e[1] for e in batch_exp], dtype='float32')
-        action = np.asarray([e[2] for e in batch_exp], dtype='int8')
-        isOver = np.asarray([e[3] for e in batch_exp], dtype='bool')
-        return [state, action, reward, isOver]
+    def _start_samplers(self):
+        """ start `nr_sampler` threads filling a pool of preallocated batches """
+        self._ready_batches = queue.Queue(maxsize=self.prefetch)
+        self._free_buffers = queue.Queue()
+        # every sampler and the consumer hold one, the others wait in the ready queue
+        for _ in range(self.prefetch + self.nr_sampler + 1):
+            self._free_buffers.put(self.mem.new_batch_buffers(self.batch_size))
+
+        def sampler_func():
+            buffers = self._free_buffers.get()
+            self._ready_batches.put((buffers, self._sample_batch(buffers)))
+        for k in range(self.nr_sampler):
+            th = LoopThread(sampler_func, pausable=False)
+            th.name = "SamplerThread-{}".format(k)
+            th.daemon = True
+            th.start()
+            self._sampler_ths.append(th)
+
+    def _sample_batch(self, buffers=None):
+        idx = self.rng.randint(
+            self._sample_guard,
+            len(self.mem) - self.history_len * self.num_envs - 1,
+            size=self.batch_size)
+        return self.mem.sample_batch(idx, buffers)
 
     def _setup_graph(self):
-        self.predictor = self.trainer.get_predictor(*self.predictor_io_names)
+        if self.predictor_broker is not None:
+            self.predictor = get_shared_broker(
+                self.trainer, *self.predictor_io_names, **self.predictor_broker)
+        else:
+            self.predictor = self.trainer.get_predictor(*self.predictor_io_names)
 
     def _before_train(self):
         self._init_memory()
@@ -255,6 +601,35 @@ class ExpReplay(DataFlow, Callback):
             except:
                 logger.exception("Cannot log training scores.")
         self.player.reset_stat()
+        if self._timer:
+            self._timer.put_monitors(self.trainer.monitors)
+
+
+class ReplayMemorySaver(Callback):
+    """
+    Snapshot the memory of an :class:`ExpReplay` next to the model checkpoints,
+    so a resumed training doesn't have to repopulate it. The snapshot records
+    the global step, so it's only restored with the checkpoint of the same step.
+    """
+
+    def __init__(self, expreplay, checkpoint_dir=None, dirname='replay'):
+        """
+        Args:
+            expreplay (ExpReplay): the replay whose memory to save.
+            checkpoint_dir (str): Defaults to ``logger.LOG_DIR``, same as :class:`ModelSaver`.
+            dirname (str): name of the snapshot directory under `checkpoint_dir`.
+        """
+        self.expreplay = expreplay
+        if checkpoint_dir is None:
+            checkpoint_dir = logger.LOG_DIR
+        self.path = os.path.join(checkpoint_dir, dirname)
+
+    def _trigger(self):
+        try:
+            self.expreplay.mem.save_snapshot(self.path, get_global_step_value())
+            logger.info("Replay memory saved to {} ({} entries).".format(self.path, len(self.expreplay.mem)))
+        except (OSError, IOError):
+            logger.exception("Exception in ReplayMemorySaver.trigger!")
 
 
 if __name__ == '__main__':
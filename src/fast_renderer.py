@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+__all__ = ['FastRenderer', 'check_parity']
+
+# the largest differences to the pygame observation, from the fixed-point
+# rounding of cv2's gray-scale conversion and resize
+PARITY_MAX_DIFF = 2
+PARITY_MEAN_DIFF = 0.25
+
+
+def _linear_resize_matrix(dst, src):
+    """ the (dst, src) matrix of a 1-D cv2.INTER_LINEAR resize """
+    scale = float(src) / dst
+    m = np.zeros((dst, src), dtype='float64')
+    for d in range(dst):
+        f = (d + 0.5) * scale - 0.5
+        s = int(np.floor(f))
+        f -= s
+        if s < 0:
+            f, s = 0, 0
+        if s >= src - 1:
+            f, s = 0, src - 1
+        m[d, s] += 1 - f
+        if f > 0:
+            m[d, s + 1] += f
+    return m
+
+
+def _gray(rgba):
+    """ float gray-scale and alpha of an RGBA image, same weights as cv2.COLOR_RGB2GRAY """
+    rgba = rgba.astype('float64')
+    return rgba[:, :, :3].dot([0.299, 0.587, 0.114]), rgba[:, :, 3] / 255.0
+
+
+def check_parity(a, b):
+    """ returns (max, mean) absolute difference of two uint8 images """
+    d = np.abs(a.astype('int32') - b.astype('int32'))
+    return d.max(), d.mean()
+
+
+class FastRenderer(object):
+    """
+    Draw the soccer field straight into a gray-scale image of `out_shape`.
+    The result is equivalent (up to rounding) to resizing the gray-scale
+    full-size screenshot with cv2.INTER_LINEAR.
+
+    Both the gray-scale conversion and the resize are linear, so every tile
+    of the map adds a fixed small block to the output. These blocks are
+    computed once per (tile, content), and a frame only updates the tiles
+    whose agents changed since the previous frame.
+
+    :meth:`render_batch` draws many frames at once from symbolic states, i.e.
+    (num_agents, 3) uint8 arrays of (x, y, has ball) in the order of `sprites`.
+    """
+
+    def __init__(self, tile_map, out_shape, transpose=False, sprites=None):
+        """
+        Args:
+            tile_map (TileMap): the map.
+            out_shape: (h, w) of the output.
+            transpose (bool): whether the reference screenshot is (width, height).
+            sprites (list): the sprite name of each agent of a symbolic state.
+        """
+        self.tile_map = tile_map
+        self.out_shape = tuple(out_shape)
+        self.transpose = transpose
+        self.sprites = sprites
+        th, tw = tile_map.tile_height, tile_map.tile_width
+        full_h, full_w = tile_map.height * th, tile_map.width * tw
+        if transpose:
+            # the screenshot is (full_w, full_h), resized to out_shape
+            self._row_mat = _linear_resize_matrix(self.out_shape[1], full_h)
+            self._col_mat = _linear_resize_matrix(self.out_shape[0], full_w)
+        else:
+            self._row_mat = _linear_resize_matrix(self.out_shape[0], full_h)
+            self._col_mat = _linear_resize_matrix(self.out_shape[1], full_w)
+
+        # the rectangle of the output each tile contributes to
+        self._slot_rect = {}
+        for y in range(tile_map.height):
+            rows = np.flatnonzero(self._row_mat[:, y * th:(y + 1) * th].any(axis=1))
+            for x in range(tile_map.width):
+                cols = np.flatnonzero(self._col_mat[:, x * tw:(x + 1) * tw].any(axis=1))
+                self._slot_rect[(y, x)] = (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+
+        # gray-scale background of each tile
+        self._background = {}
+        for y in range(tile_map.height):
+            for x in range(tile_map.width):
+                g = np.zeros((th, tw), dtype='float64')
+                for gids in tile_map.background:
+                    if gids[y, x]:
+                        g = self._blend(g, tile_map.get_tile(gids[y, x]))
+                self._background[(y, x)] = g
+        self._sprites = {name: _gray(tile_map.get_tile(gid)) for name, gid in tile_map.sprites.items()}
+
+        self._blocks = {}
+        self._background_acc = np.zeros(self._row_mat.shape[:1] + self._col_mat.shape[:1], dtype='float64')
+        for slot in self._background:
+            r0, r1, c0, c1 = self._slot_rect[slot]
+            self._background_acc[r0:r1, c0:c1] += self._block(slot, ())
+        self._batch_tables = None
+        self.reset()
+
+    @property
+    def symbolic_shape(self):
+        return (len(self.sprites), 3)
+
+    def _blend(self, dst, rgba):
+        gray, alpha = _gray(rgba)
+        return gray * alpha + dst * (1 - alpha)
+
+    def _block(self, slot, sprites):
+        """ the output block of a tile showing `sprites` (drawn in order) over its background """
+        key = (slot, sprites)
+        block = self._blocks.get(key)
+        if block is None:
+            y, x = slot
+            th, tw = self.tile_map.tile_height, self.tile_map.tile_width
+            g = self._background[slot]
+            for name in sprites:
+                gray, alpha = self._sprites[name]
+                g = gray * alpha + g * (1 - alpha)
+            r0, r1, c0, c1 = self._slot_rect[slot]
+            block = self._row_mat[r0:r1, y * th:(y + 1) * th].dot(g).dot(
+                self._col_mat[c0:c1, x * tw:(x + 1) * tw].T)
+            self._blocks[key] = block
+        return block
+
+    def _compose(self, content):
+        """ the accumulator of a frame drawn from scratch, `content` maps tiles to sprite names """
+        acc = self._background_acc.copy()
+        for slot, sprites in content.items():
+            r0, r1, c0, c1 = self._slot_rect[slot]
+            acc[r0:r1, c0:c1] += self._block(slot, sprites) - self._block(slot, ())
+        return acc
+
+    def _to_image(self, acc):
+        """ round (..., rows, cols) accumulators to uint8 images of `out_shape` """
+        obs = np.clip(np.rint(acc), 0, 255).astype('uint8')
+        if self.transpose:
+            obs = np.ascontiguousarray(np.swapaxes(obs, -1, -2))
+        return obs
+
+    def _get_batch_tables(self):
+        """ the change of every (tile, sprite) to the accumulator, padded to the
+            same block size, and the flat accumulator index of each block element """
+        if self._batch_tables is not None:
+            return self._batch_tables
+        names = sorted(self.tile_map.sprites)
+        slots = [(y, x) for y in range(self.tile_map.height) for x in range(self.tile_map.width)]
+        rects = np.array([self._slot_rect[slot] for slot in slots])
+        bh = (rects[:, 1] - rects[:, 0]).max()
+        bw = (rects[:, 3] - rects[:, 2]).max()
+        rows, cols = self._background_acc.shape
+        deltas = np.zeros((len(slots), len(names), bh, bw), dtype='float64')
+        for i, slot in enumerate(slots):
+            for j, name in enumerate(names):
+                d = self._block(slot, (name,)) - self._block(slot, ())
+                deltas[i, j, :d.shape[0], :d.shape[1]] = d
+        # the padding has zero change, any index inside the accumulator will do
+        r = np.minimum(rects[:, 0, None] + np.arange(bh), rows - 1)
+        c = np.minimum(rects[:, 2, None] + np.arange(bw), cols - 1)
+        index = (r[:, :, None] * cols + c[:, None, :]).reshape(len(slots), -1)
+        codes = [[names.index(s), names.index(s + '_BALL')] for s in self.sprites]
+        self._batch_tables = (deltas.reshape(len(slots), len(names), -1), index, np.array(codes))
+        return self._batch_tables
+
+    def render_batch(self, states):
+        """
+        Args:
+            states: (N, num_agents, 3) uint8 symbolic states.
+        Returns:
+            (N, h, w) uint8 images, same as :meth:`render` on each state.
+        """
+        states = np.asarray(states)
+        n = len(states)
+        deltas, index, codes = self._get_batch_tables()
+        rows, cols = self._background_acc.shape
+        x, y, ball = states[:, :, 0], states[:, :, 1], states[:, :, 2] > 0
+        slot = y.astype('int64') * self.tile_map.width + x
+        code = codes[np.arange(states.shape[1]), ball.astype('int64')]
+        # each agent adds its block, overlapping blocks of neighbouring tiles sum up
+        pix = index[slot] + (np.arange(n) * (rows * cols))[:, None, None]
+        acc = np.bincount(pix.ravel(), weights=deltas[slot, code].ravel(), minlength=n * rows * cols)
+        acc = acc.reshape(n, rows, cols) + self._background_acc
+
+        # agents on the same tile are blended over each other, draw those frames one by one
+        sorted_slot = np.sort(slot, axis=1)
+        for i in np.flatnonzero((sorted_slot[:, 1:] == sorted_slot[:, :-1]).any(axis=1)):
+            acc[i] = self._compose(self._get_content(self._get_agents(states[i])))
+        return self._to_image(acc)
+
+    def _get_agents(self, state):
+        return [(int(x), int(y), s + '_BALL' if ball else s) for (x, y, ball), s in zip(state, self.sprites)]
+
+    def _get_content(self, agents):
+        content = {}
+        for x, y, name in agents:
+            content.setdefault((y, x), ())
+            content[(y, x)] += (name,)
+        return content
+
+    def reset(self):
+        """ start again from the plain background, which also drops accumulated rounding errors """
+        self._acc = self._background_acc.copy()
+        self._content = {}
+        self._last_agents = None
+        self._obs = None
+
+    def render(self, agents):
+        """
+        Args:
+            agents: list of (x, y, sprite name) in drawing order.
+        Returns:
+            a read-only (h, w) uint8 image, the same object as long as `agents` doesn't change.
+        """
+        agents = tuple(agents)
+        if agents == self._last_agents:
+            return self._obs
+        content = self._get_content(agents)
+        for slot in set(self._content) | set(content):
+            old = self._content.get(slot, ())
+            new = content.get(slot, ())
+            if old != new:
+                r0, r1, c0, c1 = self._slot_rect[slot]
+                self._acc[r0:r1, c0:c1] += self._block(slot, new) - self._block(slot, old)
+        self._content = content
+        self._last_agents = agents
+
+        obs = self._to_image(self._acc)
+        obs.flags.writeable = False
+        self._obs = obs
+        return obs
+
+
+if __name__ == '__main__':
+    # parity over random steps and speed against the pygame pipeline,
+    # exits with an error when a frame is out of bounds
+    import sys
+    import time
+    from soccer_env import SoccerPlayer
+
+    failed = False
+    for team_size, field in [(1, None), (2, 'large')]:
+        pl = SoccerPlayer(image_shape=(84, 84), frame_skip=1, field=field, team_size=team_size, renderer='fast')
+        if pl.renderer != 'fast':
+            print("team{}-{}: the fast renderer was rejected at start-up".format(team_size, field or 'small'))
+            failed = True
+            continue
+        rng = np.random.RandomState(0)
+        worst_max = worst_mean = 0
+        t_fast = t_ref = 0
+        nr_step = 2000
+        for k in range(nr_step):
+            pl.action(rng.randint(pl.get_action_space().num_actions()))
+            t = time.time()
+            fast = pl.current_state()
+            t_fast += time.time() - t
+            t = time.time()
+            ref = pl._pygame_state()
+            t_ref += time.time() - t
+            max_diff, mean_diff = check_parity(fast, ref)
+            if max_diff > PARITY_MAX_DIFF or mean_diff > PARITY_MEAN_DIFF:
+                print("team{}-{}: step {} differs by up to {} (mean {:.4f})".format(
+                    team_size, field or 'small', k, max_diff, mean_diff))
+                failed = True
+                break
+            worst_max, worst_mean = max(worst_max, max_diff), max(worst_mean, mean_diff)
+        else:
+            print("team{}-{}: max diff {}, mean diff {:.4f}; per frame: fast {:.1f}us, pygame {:.1f}us".format(
+                team_size, field or 'small', worst_max, worst_mean, t_fast / nr_step * 1e6, t_ref / nr_step * 1e6))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from tensorpack.RL.envbase import ProxyPlayer
+
+__all__ = ['FrameHistory', 'FrameHistoryPlayer']
+
+
+class FrameHistory(object):
+    """
+    The last `history_len` frames of one or more environments, stacked on the
+    channel axis like :func:`expreplay.stack_history`, in a preallocated ring.
+
+    Every frame is written twice, at slot k and k + history_len of a buffer
+    with 2 * history_len slots, so the most recent frames are always a single
+    slice of it. :meth:`push` copies one frame and :meth:`window` returns a
+    view, nothing is allocated per step. Missing frames at the start of an
+    episode are zeros.
+    """
+
+    def __init__(self, frame_shape, history_len, num_envs=None):
+        """
+        Args:
+            frame_shape: (H, W) or (H, W, C).
+            num_envs (int or None): if given, keep a history for each of that
+                many environments stepped together, and take their frames in
+                one (num_envs,) + frame_shape array.
+        """
+        frame_shape = tuple(frame_shape)
+        self.history_len = int(history_len)
+        self.nr_ch = frame_shape[2] if len(frame_shape) == 3 else 1
+        lead = () if num_envs is None else (int(num_envs),)
+        self._frame_shape = lead + frame_shape[:2] + (self.nr_ch,)
+        self._buf = np.zeros(lead + frame_shape[:2] + (2 * self.history_len * self.nr_ch,), dtype='uint8')
+        self._pos = 0
+        self._set_window()
+
+    def _set_window(self):
+        start = (self._pos + 1) * self.nr_ch
+        self._window = self._buf[..., start:start + self.history_len * self.nr_ch]
+
+    def _write(self, slot, frame):
+        c = self.nr_ch
+        k = slot * c
+        self._buf[..., k:k + c] = frame
+        k += self.history_len * c
+        self._buf[..., k:k + c] = frame
+
+    def push(self, frame):
+        """ append a frame, dropping the oldest """
+        self._pos = (self._pos + 1) % self.history_len
+        self._write(self._pos, np.reshape(frame, self._frame_shape))
+        self._set_window()
+
+    def peek(self, frame):
+        """
+        Returns:
+            the window as if `frame` was pushed. The oldest frame is
+            overwritten, so follow it with :meth:`push` or :meth:`reset`.
+        """
+        nxt = (self._pos + 1) % self.history_len
+        self._write(nxt, np.reshape(frame, self._frame_shape))
+        start = (nxt + 1) * self.nr_ch
+        return self._buf[..., start:start + self.history_len * self.nr_ch]
+
+    def reset(self, mask=None):
+        """ forget all frames, or only those of the environments in the boolean `mask` """
+        if mask is None:
+            self._buf.fill(0)
+        else:
+            self._buf[mask] = 0
+
+    def window(self):
+        """ a (H, W, history_len * C) view of the history, oldest frame first,
+            with a leading (num_envs,) axis if given """
+        return self._window
+
+
+class FrameHistoryPlayer(ProxyPlayer):
+    """
+    Stack the last `hist_len` observations of a player, like tensorpack's
+    `HistoryFramePlayer` but with a :class:`FrameHistory`.
+    The state is a view into the history, it changes with the next action.
+    """
+
+    def __init__(self, player, hist_len):
+        super(FrameHistoryPlayer, self).__init__(player)
+        s = self.player.current_state()
+        self.history = FrameHistory(s.shape, hist_len)
+        self.history.push(s)
+
+    def current_state(self):
+        return self.history.window()
+
+    def action(self, act):
+        r, isOver = self.player.action(act)
+        if isOver:
+            # the state is already of a new episode
+            self.history.reset()
+        self.history.push(self.player.current_state())
+        return (r, isOver)
+
+    def restart_episode(self):
+        super(FrameHistoryPlayer, self).restart_episode()
+        self.history.reset()
+        self.history.push(self.player.current_state())
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+
+__all__ = ['HotPathTimer', 'StartupTimer', 'STARTUP', 'enable', 'get_timer']
+
+
+class HotPathTimer(object):
+    """
+    Accumulate the time spent in named stages of the simulator loop.
+
+    Timed code keeps a timestamp and hands it back at the end of each stage::
+
+        t = timer.now()
+        ...
+        t = timer.add('stage', t)
+
+    Every call adds to a running sum and count, and every `sample_period`-th
+    duration of a stage also goes into a fixed-size ring used for percentiles.
+    Code paths take the timer only when profiling is enabled, see :func:`get_timer`.
+    """
+
+    now = staticmethod(time.perf_counter)
+
+    def __init__(self, sample_period=1, ring_size=4096):
+        self.sample_period = sample_period
+        self.ring_size = ring_size
+        self.reset()
+
+    def reset(self):
+        # name -> [total seconds, count, ring, number of samples]
+        self._stages = {}
+
+    def add(self, name, start):
+        """ record the time since `start` under `name`, and return the current time """
+        end = time.perf_counter()
+        st = self._stages.get(name)
+        if st is None:
+            st = self._stages[name] = [0.0, 0, np.zeros(self.ring_size), 0]
+        st[0] += end - start
+        st[1] += 1
+        if st[1] % self.sample_period == 0:
+            st[2][st[3] % self.ring_size] = end - start
+            st[3] += 1
+        return end
+
+    def summary(self, stages=None):
+        """
+        Args:
+            stages (dict): the stages to summarize, by default the current ones.
+
+        Returns:
+            dict: name -> (total seconds, mean, p50, p99) since the last :meth:`reset`,
+            the last three in microseconds.
+        """
+        if stages is None:
+            stages = self._stages
+        ret = {}
+        for name, (total, count, ring, nr_sample) in list(stages.items()):
+            samples = ring[:min(nr_sample, self.ring_size)]
+            if len(samples):
+                p50, p99 = np.percentile(samples, [50, 99]) * 1e6
+            else:
+                p50 = p99 = 0.0
+            ret[name] = (total, total / count * 1e6, p50, p99)
+        return ret
+
+    def put_monitors(self, monitors, prefix='hotpath/'):
+        """ put the summary to `trainer.monitors` and reset """
+        # detached first, the simulator thread keeps adding to a new dict meanwhile
+        stages, self._stages = self._stages, {}
+        for name, (total, mean, p50, p99) in self.summary(stages).items():
+            monitors.put_scalar(prefix + name + '_total_sec', total)
+            monitors.put_scalar(prefix + name + '_mean_us', mean)
+            monitors.put_scalar(prefix + name + '_p50_us', p50)
+            monitors.put_scalar(prefix + name + '_p99_us', p99)
+
+
+class StartupTimer(object):
+    """
+    Wall time of the steps before a process gets to its actual work, each
+    step measured from the end of the previous one by :meth:`mark`.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.steps = []
+        self.finished = False
+
+    def mark(self, name):
+        """ record the time since the previous step under `name`, unless finished """
+        if self.finished:
+            return
+        now = time.perf_counter()
+        self.steps.append((name, now - self._last))
+        self._last = now
+
+    def finish(self):
+        """
+        Stop recording.
+
+        Returns:
+            str: the duration of every step and the total, or None if already finished.
+        """
+        if self.finished:
+            return None
+        self.finished = True
+        return 'startup: ' + ', '.join('{} {:.0f}ms'.format(name, sec * 1000) for name, sec in
+                                       self.steps + [('total', self._last - self.start)])
+
+
+# started when this module is first imported, so import it before the heavy modules
+STARTUP = StartupTimer()
+
+_TIMER = None
+
+
+def enable(sample_period=1):
+    """ enable profiling for the objects created afterwards """
+    global _TIMER
+    _TIMER = HotPathTimer(sample_period)
+    return _TIMER
+
+
+def get_timer():
+    """ the global :class:`HotPathTimer`, or None if profiling is disabled """
+    return _TIMER
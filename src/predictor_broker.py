@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import numpy as np
+from concurrent.futures import Future
+from six.moves import queue, range
+
+from tensorpack.utils import logger
+from tensorpack.utils.concurrency import LoopThread, ShareSessionThread
+
+__all__ = ['PredictorBroker', 'get_shared_broker']
+
+
+class PredictorBroker(object):
+    """
+    Serve the predictor calls of any number of threads with batched calls.
+
+    It's a drop-in replacement of the wrapped predictor: ``broker(dp)`` takes
+    a list of batched inputs and blocks until its own slice of the outputs is ready.
+    A serving thread takes the pending requests, waits at most `max_wait` seconds
+    for more of them until `max_batch` states are collected, and runs them in
+    one predictor call. It doesn't wait for threads which haven't called it
+    within `idle` seconds, so a lone caller isn't slowed down.
+    """
+
+    def __init__(self, predictor, max_batch=32, max_wait=0.002, idle=0.1):
+        """
+        Args:
+            predictor: a callable taking a list of inputs, e.g. an :class:`OnlinePredictor`.
+            max_batch (int): maximum number of states in one call.
+            max_wait (float): maximum time in seconds to wait for more requests.
+            idle (float): time in seconds after which a caller isn't waited for.
+        """
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.idle = idle
+        # thread ident -> time of its last call
+        self._callers = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def __call__(self, dp):
+        if self._thread is None:
+            self._start()
+        self._callers[threading.current_thread().ident] = time.time()
+        fut = Future()
+        self._queue.put(([np.asarray(x) for x in dp], fut))
+        return fut.result()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            # started from a caller thread, so it shares the caller's default session
+            th = ShareSessionThread(LoopThread(self._serve_batch, pausable=False))
+            th.name = "PredictorBroker"
+            th.daemon = True
+            th.start()
+            self._thread = th
+
+    def _serve_batch(self):
+        reqs = [self._queue.get()]
+        size = len(reqs[0][0][0])
+        now = time.time()
+        deadline = now + self.max_wait
+        # a caller blocks on its request, so each active one has at most one pending
+        nr_active = 0
+        for ident, t in list(self._callers.items()):
+            if t > now - self.idle:
+                nr_active += 1
+            elif self._callers.get(ident) == t:
+                # e.g. an eval thread which finished, only this thread removes callers
+                del self._callers[ident]
+        while size < self.max_batch and len(reqs) < nr_active:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            reqs.append(req)
+            size += len(req[0][0])
+
+        if len(reqs) == 1:
+            inputs = reqs[0][0]
+        else:
+            inputs = [np.concatenate([r[0][k] for r in reqs])
+                      for k in range(len(reqs[0][0]))]
+        try:
+            outputs = self.predictor(inputs)
+        except Exception as e:
+            logger.exception("Exception in PredictorBroker!")
+            for _, fut in reqs:
+                fut.set_exception(e)
+            return
+
+        start = 0
+        for dp, fut in reqs:
+            end = start + len(dp[0])
+            fut.set_result([o[start:end] for o in outputs])
+            start = end
+
+
+_BROKERS = {}
+
+
+def get_shared_broker(trainer, input_names, output_names, **kwargs):
+    """
+    Returns:
+        the same :class:`PredictorBroker` for all callers asking for the same
+        input/output names of the same trainer, so that e.g. the simulator and
+        the evaluation threads share their batches.
+        `kwargs` are used when the broker is created.
+    """
+    key = (id(trainer), tuple(input_names), tuple(output_names))
+    if key not in _BROKERS:
+        _BROKERS[key] = PredictorBroker(trainer.get_predictor(input_names, output_names), **kwargs)
+    return _BROKERS[key]
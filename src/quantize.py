@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+
+from tensorpack.utils import logger
+
+from shared_expreplay import CheckpointPredictor
+
+__all__ = ['freeze_graph', 'quantize_graph', 'save_graph', 'load_graph', 'FrozenPredictor',
+           'sample_replay_states', 'parity_report', 'QuantizedCheckpointPredictor']
+
+# the message of the logged requantization ranges, see freeze_requantization_ranges
+RANGE_MARKER = '__requant_min_max:'
+
+
+def freeze_graph(sess, output_names=['Qvalue']):
+    """
+    Returns:
+        GraphDef: the part of the graph of `sess` that computes `output_names`,
+        with the variables turned into constants. The Pivalue heads, the target
+        network and the training ops are left out.
+    """
+    import tensorflow as tf
+    return tf.graph_util.convert_variables_to_constants(
+        sess, sess.graph.as_graph_def(), output_names)
+
+
+@contextmanager
+def _redirect_stderr(f):
+    """ send everything written to fd 2, including the C++ logs of TF, to file `f` """
+    sys.stderr.flush()
+    saved = os.dup(2)
+    os.dup2(f.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stderr.flush()
+        os.dup2(saved, 2)
+        os.close(saved)
+
+
+def quantize_graph(graph_def, calib_states, input_name='state', output_names=['Qvalue'], batch_size=64):
+    """
+    Quantize the weights and the conv/matmul ops of a frozen graph to 8 bits
+    with TF's graph transforms. The ranges of the int32 accumulators are
+    calibrated on `calib_states` instead of being computed for every call.
+
+    Args:
+        graph_def (GraphDef): from :func:`freeze_graph`.
+        calib_states (np.ndarray): network inputs, e.g. from :func:`sample_replay_states`.
+
+    Returns:
+        GraphDef: with a float placeholder `input_name`.
+    """
+    from tensorflow.tools.graph_transforms import TransformGraph
+    inputs = [input_name]
+    graph_def = TransformGraph(graph_def, inputs, output_names, [
+        'strip_unused_nodes(type=float)',
+        'fold_constants(ignore_errors=true)',
+        'quantize_weights',
+        'quantize_nodes'])
+    logged = TransformGraph(graph_def, inputs, output_names, [
+        'insert_logging(op=RequantizationRange, show_name=true, message="{}")'.format(RANGE_MARKER)])
+    pred = FrozenPredictor(logged, inputs, output_names)
+    with tempfile.NamedTemporaryFile('w+', suffix='.log') as f:
+        with _redirect_stderr(f):
+            for k in range(0, len(calib_states), batch_size):
+                pred([calib_states[k:k + batch_size]])
+        f.seek(0)
+        nr_ranges = sum(RANGE_MARKER in line for line in f)
+        if nr_ranges == 0:
+            raise RuntimeError("No requantization range was logged. Is TF_CPP_MIN_LOG_LEVEL set?")
+        logger.info("Calibrated on {} states, {} ranges logged.".format(len(calib_states), nr_ranges))
+        graph_def = TransformGraph(graph_def, inputs, output_names, [
+            'freeze_requantization_ranges(min_max_log_file="{}")'.format(f.name)])
+    pred.close()
+    return graph_def
+
+
+def save_graph(graph_def, path):
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+
+def load_graph(path):
+    import tensorflow as tf
+    graph_def = tf.GraphDef()
+    with open(path, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+    return graph_def
+
+
+class FrozenPredictor(object):
+    """
+    Run a frozen graph on CPU. Called with a datapoint like `OfflinePredictor`,
+    so it can replace one in the simulators and the evaluators.
+    """
+
+    def __init__(self, graph_def, input_names=['state'], output_names=['Qvalue']):
+        """
+        Args:
+            graph_def (GraphDef or str): a graph, or a file written by :func:`save_graph`.
+        """
+        import tensorflow as tf
+        if not isinstance(graph_def, tf.GraphDef):
+            graph_def = load_graph(graph_def)
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._inputs = [self.graph.get_tensor_by_name(n + ':0') for n in input_names]
+        self._outputs = [self.graph.get_tensor_by_name(n + ':0') for n in output_names]
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    def __call__(self, dp):
+        return self.sess.run(self._outputs, feed_dict=dict(zip(self._inputs, dp)))
+
+    def close(self):
+        self.sess.close()
+
+
+def sample_replay_states(mem, nr, rng, batch_size=256):
+    """
+    Returns:
+        np.ndarray: `nr` random network inputs (without the next frame) from a replay memory.
+    """
+    states = None
+    for k in range(0, nr, batch_size):
+        idx = rng.randint(0, len(mem) - mem.history_len - 1, size=min(batch_size, nr - k))
+        comb_state = mem.sample_batch(idx)[0]
+        nr_ch = comb_state.shape[-1] // (mem.history_len + 1) * mem.history_len
+        if states is None:
+            states = np.zeros((nr,) + comb_state.shape[1:3] + (nr_ch,), dtype='uint8')
+        states[k:k + len(idx)] = comb_state[..., :nr_ch]
+    return states
+
+
+def _latency(pred, states, nr_call):
+    """ median seconds of a call on one state """
+    times = []
+    for k in range(nr_call):
+        s = states[k % len(states)][np.newaxis]
+        start = time.time()
+        pred([s])
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def parity_report(float_pred, int8_pred, states, batch_size=64, nr_call=200):
+    """
+    Compare the Q-values of two predictors on `states`.
+
+    Returns:
+        dict: agreement of the greedy actions, absolute errors of the Q-values,
+        and the median latency in ms of single-state calls.
+    """
+    q_float, q_int8 = [], []
+    for k in range(0, len(states), batch_size):
+        dp = [states[k:k + batch_size]]
+        q_float.append(float_pred(dp)[0])
+        q_int8.append(int8_pred(dp)[0])
+    q_float, q_int8 = np.concatenate(q_float), np.concatenate(q_int8)
+    err = np.abs(q_float - q_int8)
+    report = {
+        'argmax_agreement': float(np.mean(q_float.argmax(axis=1) == q_int8.argmax(axis=1))),
+        'q_max_abs_err': float(err.max()),
+        'q_mean_abs_err': float(err.mean()),
+        'float_ms': _latency(float_pred, states, nr_call) * 1000,
+        'int8_ms': _latency(int8_pred, states, nr_call) * 1000,
+    }
+    logger.info("int8 vs float on {} states: argmax agreement {:.4f}, "
+                "Q abs error mean {:.4g} max {:.4g}, latency {:.3f}ms vs {:.3f}ms".format(
+                    len(states), report['argmax_agreement'], report['q_mean_abs_err'],
+                    report['q_max_abs_err'], report['int8_ms'], report['float_ms']))
+    return report
+
+
+class QuantizedCheckpointPredictor(CheckpointPredictor):
+    """
+    :class:`CheckpointPredictor` which acts with an int8 copy of every
+    checkpoint it loads. The copy is calibrated on a sample of the states the
+    predictor was called with, and the float model acts until there are enough.
+    """
+
+    def __init__(self, model, checkpoint_dir, period=60, calib_size=256, calib_every=16):
+        """
+        Args:
+            calib_size (int): number of states to calibrate on.
+            calib_every (int): keep every n-th state for the calibration.
+        """
+        super(QuantizedCheckpointPredictor, self).__init__(model, checkpoint_dir, period=period)
+        self.calib_size = calib_size
+        self.calib_every = calib_every
+        self._states = None
+        self._nr_called = 0
+        self._int8 = None
+        self._quantized = None
+
+    def _keep_state(self, state):
+        if self._states is None:
+            self._states = np.zeros((self.calib_size,) + state.shape, dtype=state.dtype)
+        k = self._nr_called // self.calib_every
+        self._states[k % self.calib_size] = state
+
+    def _requantize(self):
+        graph_def = quantize_graph(freeze_graph(self._pred.sess), self._states)
+        if self._int8 is not None:
+            self._int8.close()
+        self._int8 = FrozenPredictor(graph_def)
+        self._quantized = self._loaded
+        logger.info("Acting with an int8 copy of {}.".format(self._loaded))
+
+    def __call__(self, dp):
+        if self._nr_called % self.calib_every == 0:
+            self._keep_state(dp[0][0])
+        self._nr_called += 1
+        self._maybe_reload()
+        enough = self._nr_called >= self.calib_size * self.calib_every
+        if self._loaded is not None and self._loaded != self._quantized and enough:
+            self._requantize()
+        if self._int8 is not None:
+            return self._int8(dp)
+        return self._pred(dp)
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import os
+import json
+import time
+import uuid
+import atexit
+from collections import deque
+import multiprocessing as mp
+from six.moves import queue, range
+
+from tensorpack.utils import logger, get_tqdm
+from tensorpack.utils.concurrency import LoopThread
+from tensorpack.RL.envbase import DiscreteActionSpace
+
+from augment_expreplay import AugmentReplayMemory, AugmentExpReplay, AugmentExperience
+from expreplay import check_snapshot_step
+
+__all__ = ['SharedReplayMemory', 'SharedExpReplay', 'CheckpointPredictor']
+
+
+class SharedReplayMemory(AugmentReplayMemory):
+    """
+    :class:`AugmentReplayMemory` whose columns live in POSIX shared memory,
+    so that actor processes append to it while the learner samples from it.
+    Pass it to a child process as an argument, it attaches to the same memory.
+
+    The rows are divided into chunks, and a writer reserves a whole chunk at a
+    time under a lock, so the windows of its transitions stay contiguous.
+    A chunk starts with the hist_len-1 rows before its first transition.
+    Every row has a stamp, the generation of the chunk it was written in,
+    which is set only after the row. A chunk is unstamped before it is
+    rewritten, so the learner never samples a half-written transition and
+    drops the windows whose stamps changed while they were copied.
+    """
+
+    def __init__(self, max_size, state_shape, history_len, num_agents, chunk_size=256,
+                 renderer=None, name=None, lock=None):
+        """
+        Args:
+            chunk_size (int): number of transitions a writer reserves at once.
+            name (str or None): attach to the memory created under this name,
+                instead of creating a new one.
+        """
+        self.chunk_size = int(chunk_size)
+        assert self.chunk_size >= 2, chunk_size
+        self.chunk_rows = int(history_len) - 1 + self.chunk_size
+        self.nr_chunks = max(int(max_size) // self.chunk_rows, 2)
+        self._owner = name is None
+        self.name = name or 'replay-{}'.format(uuid.uuid4().hex[:12])
+        self._shms = []
+        self._lock = lock or mp.get_context('spawn').Lock()
+        super(SharedReplayMemory, self).__init__(self.nr_chunks * self.chunk_rows, state_shape, history_len,
+                                                 num_agents, None, 1, renderer)
+        self._init_args = (max_size, state_shape, history_len, num_agents, chunk_size, renderer)
+        self.stamp = self._alloc('stamp', (self.max_size,), 'int64')
+        # [number of chunks reserved, number of transitions in completed chunks]
+        self._counters = self._alloc('counters', (2,), 'int64')
+        if self._owner:
+            self.stamp.fill(-1)
+            atexit.register(self.close)
+            logger.info("Shared replay memory {}: {} chunks of {} transitions".format(
+                self.name, self.nr_chunks, self.chunk_size))
+
+        # the chunk this process writes to
+        self._gen = -1
+        self._next_row = self._chunk_end = 0
+        self._nr_appended = 0
+        self._recent = deque(maxlen=self.history_len)
+
+    def __reduce__(self):
+        return (_attach_memory, self._init_args + (self.name, self._lock))
+
+    def attach_writer(self):
+        """ another handle on the same memory with its own chunk, for another writer in this process """
+        return _attach_memory(*(self._init_args + (self.name, self._lock)))
+
+    def _alloc(self, name, shape, dtype):
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        # Python 3.8+, imported here so that CheckpointPredictor works without it
+        from multiprocessing import shared_memory
+        shm_name = '{}-{}'.format(self.name, name)
+        # child processes share the resource tracker of the creator, which
+        # removes the memory if the creator dies without closing it
+        shm = shared_memory.SharedMemory(shm_name, create=self._owner, size=nbytes if self._owner else 0)
+        self._shms.append(shm)
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    def close(self):
+        """ detach from the memory, and remove it if this process created it """
+        self.state = self.action = self.reward = self.isOver = self.action_o = None
+        self.stamp = self._counters = None
+        for shm in self._shms:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            if self._owner:
+                try:
+                    shm.unlink()
+                except OSError:
+                    pass
+        self._shms = []
+
+    def __len__(self):
+        return int(min(self._counters[1], self.nr_chunks * self.chunk_size))
+
+    def _reserve_chunk(self):
+        with self._lock:
+            gen = int(self._counters[0])
+            self._counters[0] += 1
+            self._counters[1] += self._nr_appended
+        self._nr_appended = 0
+        start = (gen % self.nr_chunks) * self.chunk_rows
+        self.stamp[start:start + self.chunk_rows] = -1
+
+        # the rows before the first transition, padded with empty finished episodes
+        recent = list(self._recent)
+        prefix = recent[:-1]
+        pad = self.history_len - 1 - len(prefix)
+        empty = AugmentExperience(np.zeros_like(self.state[0]), 0, 0, True, np.zeros_like(self.action_o[0]))
+        for k, exp in enumerate([empty] * pad + prefix + recent[-1:]):
+            self._assign(start + k, exp)
+        # the last transition of the previous chunk had no next frame there
+        self._next_row = start + pad + len(prefix) + len(recent[-1:])
+        self.stamp[start:self._next_row] = gen
+        self._chunk_end = start + self.chunk_rows
+        self._gen = gen
+
+    def append(self, exp):
+        if self._next_row >= self._chunk_end:
+            self._reserve_chunk()
+        self._assign(self._next_row, exp)
+        self.stamp[self._next_row] = self._gen
+        self._next_row += 1
+        self._nr_appended += 1
+        self._recent.append(exp)
+        self._push_history(0, exp)
+
+    def append_batch(self, exps):
+        for exp in exps:
+            self.append(exp)
+
+    def save_snapshot(self, path, step=None):
+        """ Save the whole memory under directory `path`, with the stamps of the chunks.
+            The rows rewritten while they are saved are saved unstamped. """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with self._lock:
+            counters = self._counters.copy()
+        stamp = self.stamp.copy()
+        # straight from the shared memory, without a copy of the whole memory
+        np.savez(os.path.join(path, 'shared.tmp.npz'), **{c: getattr(self, c) for c in self._columns})
+        np.savez(os.path.join(path, 'stamp.tmp.npz'), stamp=np.where(self.stamp == stamp, stamp, -1),
+                 counters=counters)
+        for fname in ['shared.npz', 'stamp.npz']:
+            os.rename(os.path.join(path, fname.replace('.', '.tmp.')), os.path.join(path, fname))
+        meta = {'max_size': self.max_size, 'chunk_rows': self.chunk_rows, 'step': step}
+        tmp = os.path.join(path, 'meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(path, 'meta.json'))
+
+    def load_snapshot(self, path, step=None):
+        """ Restore the memory from a directory written by :meth:`save_snapshot`,
+            before any actor appends to it. See :meth:`ReplayMemory.load_snapshot` for `step`. """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        check_snapshot_step(meta, step)
+        assert (meta['max_size'], meta.get('chunk_rows')) == (self.max_size, self.chunk_rows), \
+            "Snapshot has memory size {} in chunks of {} rows, expect {} in chunks of {}".format(
+                meta['max_size'], meta.get('chunk_rows'), self.max_size, self.chunk_rows)
+        data = np.load(os.path.join(path, 'shared.npz'))
+        for c in self._columns:
+            getattr(self, c)[:] = data[c]
+        data = np.load(os.path.join(path, 'stamp.npz'))
+        self.stamp[:] = data['stamp']
+        with self._lock:
+            self._counters[:] = data['counters']
+
+    def _draw_windows(self, n, rng):
+        """ (n, hist_len+1) rows of random windows inside the chunks """
+        chunk = rng.randint(self.nr_chunks, size=n)
+        start = chunk * self.chunk_rows + rng.randint(self.chunk_size - 1, size=n)
+        return start[:, np.newaxis] + np.arange(self.history_len + 1)
+
+    def sample_uniform(self, batch_size, rng, buffers=None):
+        """
+        Sample a batch uniformly from the visible transitions.
+
+        Returns:
+            list: the same datapoint as :meth:`sample_batch`.
+        """
+        bufs = self._get_batch_buffers(batch_size, buffers)
+        todo = np.arange(batch_size)
+        while len(todo):
+            rows = self._draw_windows(len(todo), rng)
+            stamps = self.stamp[rows]
+            visible = (stamps[:, :1] >= 0) & (stamps == stamps[:, :1]).all(axis=1, keepdims=True)
+            keep = np.flatnonzero(visible[:, 0])
+            if not len(keep):
+                continue
+            rows, stamps = rows[keep], stamps[keep]
+            if len(keep) == batch_size:
+                tmp = bufs
+            else:
+                tmp = self.new_batch_buffers(len(keep))
+            self._fill_batch(rows, tmp)
+            # windows overwritten while being copied are drawn again
+            intact = np.flatnonzero((self.stamp[rows] == stamps).all(axis=1))
+            if tmp is not bufs:
+                for dst, src in zip(bufs, tmp):
+                    dst[todo[:len(intact)]] = src[intact]
+            elif len(intact) < batch_size:
+                # shift the intact windows to the front, in place
+                for buf in bufs:
+                    buf[:len(intact)] = buf[intact]
+            todo = todo[len(intact):]
+        return bufs[1:]
+
+
+def _attach_memory(max_size, state_shape, history_len, num_agents, chunk_size, renderer, name, lock):
+    return SharedReplayMemory(max_size, state_shape, history_len, num_agents, chunk_size, renderer, name, lock)
+
+
+class CheckpointPredictor(object):
+    """
+    Q-value predictor of an actor process, which reloads the newest
+    checkpoint of the learner at most every `period` seconds.
+    """
+
+    def __init__(self, model, checkpoint_dir, input_names=['state'], output_names=['Qvalue'], period=60):
+        from tensorpack import OfflinePredictor, PredictConfig
+        self._pred = OfflinePredictor(PredictConfig(
+            model=model, input_names=input_names, output_names=output_names))
+        self.checkpoint_dir = checkpoint_dir
+        self.period = period
+        self._loaded = None
+        self._last_check = 0
+
+    def _maybe_reload(self):
+        if time.time() - self._last_check < self.period:
+            return
+        import tensorflow as tf
+        from tensorpack.tfutils.sessinit import get_model_loader
+        self._last_check = time.time()
+        path = tf.train.latest_checkpoint(self.checkpoint_dir)
+        if path is not None and path != self._loaded:
+            get_model_loader(path).init(self._pred.sess)
+            self._loaded = path
+
+    def __call__(self, dp):
+        self._maybe_reload()
+        return self._pred(dp)
+
+
+def _actor_main(idx, mem, get_actor_fn, exploration, allowance, steps, score_queue):
+    player, predictor = get_actor_fn()
+    rng = np.random.RandomState((os.getpid() + idx * 7919) % (2 ** 31))
+    num_actions = player.get_action_space().num_actions()
+    symbolic = mem.renderer is not None
+    while True:
+        # don't run ahead of the training by more than the learner allows
+        while steps.value >= allowance.value:
+            time.sleep(0.001)
+        old_s = player.symbolic_state() if symbolic else player.current_state()
+        if rng.rand() <= exploration.value:
+            act = rng.choice(num_actions)
+        else:
+            q_values = predictor([[mem.history_state(old_s)]])[0][0]
+            act = np.argmax(q_values)
+        reward, isOver = player.action(act)
+        action_o = player.get_internal_state()['agent_actions'][1:]
+        mem.append(AugmentExperience(old_s, act, reward, isOver, action_o))
+        with steps.get_lock():
+            steps.value += 1
+        if isOver:
+            for s in player.stats['score']:
+                score_queue.put(s)
+            player.reset_stat()
+
+
+class ActorStats(object):
+    """ stands for the player of :class:`ExpReplay`, with the episode scores of all the actors """
+
+    def __init__(self, num_actions, score_queue):
+        self.num_actions = num_actions
+        self._score_queue = score_queue
+        self._scores = []
+
+    def get_action_space(self):
+        return DiscreteActionSpace(self.num_actions)
+
+    @property
+    def stats(self):
+        while True:
+            try:
+                self._scores.append(self._score_queue.get_nowait())
+            except queue.Empty:
+                break
+        return {'score': self._scores}
+
+    def reset_stat(self):
+        self._scores = []
+
+
+class SharedExpReplay(AugmentExpReplay):
+    """
+    :class:`AugmentExpReplay` filled by `nr_actor` actor processes through a
+    :class:`SharedReplayMemory`, instead of a simulator thread in the learner.
+    Every actor has its own player and predictor, made by `get_actor_fn`.
+    The learner still lets the actors add `update_frequency` transitions per
+    training batch, after the memory is initialized.
+    """
+
+    def __init__(self, get_actor_fn, nr_actor, num_actions,
+                 state_shape, batch_size,
+                 memory_size, init_memory_size,
+                 init_exploration,
+                 update_frequency, history_len, num_agents=1, chunk_size=256,
+                 symbolic_renderer=None, nr_sampler=0, prefetch=4):
+        """
+        Args:
+            get_actor_fn: a picklable function run in each actor process,
+                which returns (player, predictor), the predictor taking
+                [[history state]] like the one of :class:`ExpReplay`.
+            nr_actor (int): number of actor processes.
+            num_actions (int): number of actions of the player.
+            chunk_size (int): see :class:`SharedReplayMemory`.
+        """
+        self.get_actor_fn = get_actor_fn
+        self.nr_actor = nr_actor
+        self.chunk_size = chunk_size
+        ctx = mp.get_context('spawn')
+        self._ctx = ctx
+        self._exploration = ctx.Value('d', init_exploration, lock=False)
+        self._allowance = ctx.Value('q', int(init_memory_size))
+        self._steps = ctx.Value('q', 0)
+        self._score_queue = ctx.Queue()
+        self._actors = []
+        super(SharedExpReplay, self).__init__(
+            None, ActorStats(num_actions, self._score_queue), state_shape, batch_size,
+            memory_size, init_memory_size, init_exploration, update_frequency, history_len,
+            num_agents=num_agents, symbolic_renderer=symbolic_renderer,
+            nr_sampler=nr_sampler, prefetch=prefetch)
+
+    @property
+    def exploration(self):
+        return self._exploration.value
+
+    @exploration.setter
+    def exploration(self, value):
+        self._exploration.value = value
+
+    def _get_memory(self):
+        return SharedReplayMemory(self.memory_size, self.state_shape, self.history_len, self.num_agents,
+                                  self.chunk_size, self.symbolic_renderer)
+
+    def _start_actors(self):
+        for i in range(self.nr_actor):
+            proc = self._ctx.Process(
+                target=_actor_main,
+                args=(i, self.mem, self.get_actor_fn, self._exploration,
+                      self._allowance, self._steps, self._score_queue))
+            proc.daemon = True
+            proc.start()
+            self._actors.append(proc)
+
+    def _init_memory(self):
+        logger.info("Populating replay memory with {} actors ...".format(self.nr_actor))
+        # the transitions of the chunks being written are not counted yet
+        self._allowance.value = self.init_memory_size + self.nr_actor * self.chunk_size
+        self._start_actors()
+        with get_tqdm(total=self.init_memory_size) as pbar:
+            while len(self.mem) < self.init_memory_size:
+                time.sleep(0.5)
+                pbar.update(len(self.mem) - pbar.n)
+                assert all(p.is_alive() for p in self._actors), "An actor process died."
+        self._init_memory_flag.set()
+
+    def get_simulator_thread(self):
+        def populate_job_func():
+            self._populate_job_queue.get()
+            with self._allowance.get_lock():
+                self._allowance.value = max(self._allowance.value, self._steps.value) + self.update_frequency
+        th = LoopThread(populate_job_func, pausable=False)
+        th.name = "SimulatorThread"
+        return th
+
+    def _setup_graph(self):
+        # the actors predict with their own copies of the model
+        pass
+
+    def _sample_batch(self, buffers=None):
+        return self.mem.sample_uniform(self.batch_size, self.rng, buffers)
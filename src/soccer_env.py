@@ -4,8 +4,10 @@
 import numpy as np
 import time
 import os
-import cv2
-from collections import deque
+import sys
+import types
+import copy
+from collections import deque, namedtuple
 import threading
 import six
 from six.moves import range
@@ -16,13 +18,151 @@ from tensorpack.utils.stats import StatCounter
 
 from tensorpack.RL.envbase import RLEnvironment, DiscreteActionSpace
 
+# the base of the environments, the renderer, cv2 and the fast renderer are imported when needed
 import pygame_soccer.soccer.soccer_environment as soccer_environment
-import pygame_soccer.soccer.soccer_renderer as soccer_renderer
-import pygame_soccer.util.file_util as file_util
 
-__all__ = ['SoccerPlayer', 'get_raw_env']
+import hotpath
 
-class SoccerSavingBallEnvironment(soccer_environment.SoccerEnvironment):
+__all__ = ['SoccerPlayer', 'SoccerSnapshot', 'BatchedAIEnvironment', 'get_raw_env', 'make_environment']
+
+# see SoccerPlayer.snapshot
+SoccerSnapshot = namedtuple('SoccerSnapshot', ['state', 'mode', 'timestep', 'changing_counter',
+                                               'score', 'agent_actions', 'obs'])
+
+
+def _squared_distance(a, b):
+    """ (len(a), len(b)) squared distances between two lists of positions """
+    d = np.asarray(a, dtype='int64')[:, np.newaxis] - np.asarray(b, dtype='int64')[np.newaxis]
+    return (d ** 2).sum(axis=2)
+
+
+class BatchedAIEnvironment(soccer_environment.SoccerEnvironment):
+    """
+    :class:`SoccerEnvironment` whose rule-based AI finds the targets of all
+    agents once per frame: the first time an agent's action is asked for after
+    a step, the nearest opponents, the defensive targets and the goals to run
+    to are computed for all agents together with array operations.
+
+    The targets follow `_get_nearest_opponent_index`, `_get_defensive_agent_index`
+    and `_get_ai_action` of pygame_soccer, as kept in :meth:`_get_reference_ai_action`
+    of the subclasses: the Euclidean distance of `get_pos_distance`, compared
+    squared so that ties stay exact, and the first of equally near candidates.
+    The state getters and the final move (`_get_strategic_action`) still run
+    per agent. `python src/benchmark.py` replays seeded episodes with both
+    and fails on any difference.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._ai_frame = None
+        self._ai_layout = None
+        super(BatchedAIEnvironment, self).__init__(*args, **kwargs)
+
+    def reset(self):
+        self._ai_frame = None
+        super(BatchedAIEnvironment, self).reset()
+
+    def take_action(self, action):
+        ret = super(BatchedAIEnvironment, self).take_action(action)
+        self._ai_frame = None
+        return ret
+
+    def take_all_actions(self, actions):
+        ret = super(BatchedAIEnvironment, self).take_all_actions(actions)
+        self._ai_frame = None
+        return ret
+
+    def _get_reference_ai_action(self, team_name, team_agent_index):
+        """ the per-agent AI, for the equivalence check """
+        return super(BatchedAIEnvironment, self)._get_ai_action(team_name, team_agent_index)
+
+    def _get_ai_threat(self, nearest, team):
+        """ the agent each agent keeps the ball away from, given their nearest opponents """
+        return nearest
+
+    def _get_ai_mode(self, team_name, agent_mode):
+        return agent_mode
+
+    def _get_ai_layout(self):
+        """ (team of each agent, agents of each team in team order, goals of each team) """
+        if self._ai_layout is None:
+            team_size = self.options.team_size
+            members = [np.array([self.get_agent_index(team_name, i) for i in range(team_size)])
+                       for team_name in self.team_names]
+            team = np.zeros(team_size * len(self.team_names), dtype='int64')
+            for t, m in enumerate(members):
+                team[m] = t
+            goals = [self.map_data.goals[team_name] for team_name in self.team_names]
+            self._ai_layout = (team, members, goals)
+        return self._ai_layout
+
+    def _get_ai_frame(self):
+        """ the targets of all agents in the current state """
+        if self._ai_frame is not None:
+            return self._ai_frame
+        team, members, goals = self._get_ai_layout()
+        state = self.state
+        positions = [state.get_agent_pos(i) for i in range(len(team))]
+        dist = _squared_distance(positions, positions)
+
+        # argmin/argmax take the first of equal candidates, like the strict
+        # comparisons and np.argmin/np.argmax of pygame_soccer
+        nearest = np.zeros(len(team), dtype='int64')
+        for t, me in enumerate(members):
+            opp = members[1 - t]
+            nearest[me] = opp[dist[np.ix_(me, opp)].argmin(axis=1)]
+        ball = state.get_ball_possession()
+        defend = np.where(team == self.team_names.index(ball['team_name']), nearest, ball['agent_index'])
+        threat = self._get_ai_threat(nearest, team)
+
+        # defensive agents run to the opponent goal nearest to their target,
+        # offensive agents with the ball to their own goal farthest from the threat
+        defend_goal = np.zeros(len(team), dtype='int64')
+        escape_goal = np.zeros(len(team), dtype='int64')
+        pos = np.asarray(positions)
+        for t, me in enumerate(members):
+            defend_goal[me] = _squared_distance(goals[1 - t], pos[defend[me]]).argmin(axis=0)
+            escape_goal[me] = _squared_distance(goals[t], pos[threat[me]]).argmax(axis=0)
+        self._ai_frame = (positions, defend, threat, defend_goal, escape_goal)
+        return self._ai_frame
+
+    def _get_ai_action(self, team_name, team_agent_index):
+        agent_index = self.get_agent_index(team_name, team_agent_index)
+        # Select the previous action if it's frame skipping
+        if self.state.get_agent_frame_skip_index(agent_index) > 0:
+            return self.state.get_agent_action(agent_index)
+        positions, defend, threat, defend_goal, escape_goal = self._get_ai_frame()
+        agent_mode = self._get_ai_mode(team_name, self.state.get_agent_mode(agent_index))
+        agent_ball = self.state.get_agent_ball(agent_index)
+        if agent_mode == 'DEFENSIVE':
+            if agent_ball:
+                target_pos = positions[threat[agent_index]]
+                strategic_mode = 'AVOID'
+            else:
+                goals = self.map_data.goals[self.get_opponent_team_name(team_name)]
+                target_pos = goals[defend_goal[agent_index]]
+                strategic_mode = 'APPROACH'
+        elif agent_mode == 'OFFENSIVE':
+            if agent_ball:
+                target_pos = self.map_data.goals[team_name][escape_goal[agent_index]]
+                strategic_mode = 'APPROACH'
+            else:
+                target_pos = positions[defend[agent_index]]
+                strategic_mode = 'INTERCEPT'
+        else:
+            raise KeyError('Unknown agent mode {}'.format(agent_mode))
+        return self._get_strategic_action(positions[agent_index], target_pos, strategic_mode)
+
+    def get_ai_actions(self):
+        """ the rule-based action of every agent, keyed by agent index """
+        actions = {}
+        for team_name in self.team_names:
+            for team_agent_index in range(self.options.team_size):
+                agent_index = self.get_agent_index(team_name, team_agent_index)
+                actions[agent_index] = self._get_ai_action(team_name, team_agent_index)
+        return actions
+
+
+class SoccerSavingBallEnvironment(BatchedAIEnvironment):
    def reset(self):
         super(SoccerSavingBallEnvironment, self).reset()
         player_agent_index = self.get_agent_index('PLAYER', 1)
@@ -30,7 +170,16 @@ class SoccerSavingBallEnvironment(soccer_environment.SoccerEnvironment):
         agent_index = ball_pos['agent_index']
         self.state.switch_ball(agent_index, player_agent_index)
 
-   def _get_ai_action(self, team_name, team_agent_index):
+   def _get_ai_threat(self, nearest, team):
+    # the computer keeps the ball away from the second player
+    threat = nearest.copy()
+    threat[team == self.team_names.index('COMPUTER')] = self.get_agent_index('PLAYER', 1)
+    return threat
+
+   def _get_ai_mode(self, team_name, agent_mode):
+    return 'OFFENSIVE' if team_name == 'COMPUTER' else 'DEFENSIVE'
+
+   def _get_reference_ai_action(self, team_name, team_agent_index):
     # Get the opponent team name
     opponent_team_name = self.get_opponent_team_name(team_name)
     # Get the agent info
@@ -98,7 +247,7 @@ class SoccerSavingBallEnvironment(soccer_environment.SoccerEnvironment):
     return action
 
 
-class SoccerPassingBallEnvironment(soccer_environment.SoccerEnvironment):
+class SoccerPassingBallEnvironment(BatchedAIEnvironment):
    def reset(self):
         super(SoccerPassingBallEnvironment, self).reset()
         player_agent_index = self.get_agent_index('PLAYER', 0)
@@ -106,7 +255,16 @@ class SoccerPassingBallEnvironment(soccer_environment.SoccerEnvironment):
         agent_index = ball_pos['agent_index']
         self.state.switch_ball(agent_index, player_agent_index)
 
-   def _get_ai_action(self, team_name, team_agent_index):
+   def _get_ai_threat(self, nearest, team):
+    # the computer keeps the ball away from agent 0
+    threat = nearest.copy()
+    threat[team == self.team_names.index('COMPUTER')] = 0
+    return threat
+
+   def _get_ai_mode(self, team_name, agent_mode):
+    return 'OFFENSIVE'
+
+   def _get_reference_ai_action(self, team_name, team_agent_index):
     # Get the opponent team name
     opponent_team_name = self.get_opponent_team_name(team_name)
     # Get the agent info
@@ -170,6 +328,71 @@ class SoccerPassingBallEnvironment(soccer_environment.SoccerEnvironment):
     action = self._get_strategic_action(agent_pos, target_pos, strategic_mode)
     return action
 
+def _default_map_path():
+    """ the map of pygame_soccer used without `field='large'` """
+    return os.path.join(os.path.dirname(soccer_environment.__file__), '../data/map/soccer.tmx')
+
+
+_env_prototypes = {}
+_env_prototypes_lock = threading.Lock()
+
+
+def make_environment(raw_env, env_options, renderer_options=None):
+    """
+    Same as `raw_env(env_options=env_options, renderer_options=renderer_options)`.
+
+    Without a display, the map, tilesets and sprites are only loaded by the
+    first environment of a map content (sha1 of its files) and options in
+    this process. The others are copies of it, which share its map data.
+    """
+    map_path = env_options.map_path or _default_map_path()
+    if renderer_options is not None or not os.path.isfile(map_path):
+        return raw_env(env_options=env_options, renderer_options=renderer_options)
+    from tile_map import load_tile_map, sources_digest
+    key = (raw_env, sources_digest(load_tile_map(map_path).sources),
+           tuple(sorted((k, v) for k, v in vars(env_options).items() if k != 'map_path')))
+    with _env_prototypes_lock:
+        proto = _env_prototypes.get(key)
+        if proto is None:
+            proto = raw_env(env_options=env_options, renderer_options=None)
+            _env_prototypes[key] = proto
+        if proto is not False:
+            try:
+                return copy.deepcopy(proto, _copy_memo(proto, env_options))
+            except (TypeError, copy.Error) as e:
+                logger.warn("Can't copy {}, every player loads its map: {}".format(raw_env.__name__, e))
+                _env_prototypes[key] = False
+    return raw_env(env_options=env_options, renderer_options=renderer_options)
+
+
+def _copy_memo(proto, env_options):
+    """ a deepcopy memo of the environment `proto` which shares its map data,
+        uses `env_options`, copies its pygame surfaces (which can't be
+        deepcopied) and gives new seeds to its random generators """
+    memo = {id(proto.options): env_options, id(proto.map_data): proto.map_data}
+    pygame = sys.modules.get('pygame')
+    seen = set(memo)
+    stack = [proto]
+    while stack:
+        x = stack.pop()
+        if id(x) in seen:
+            continue
+        seen.add(id(x))
+        if pygame is not None and isinstance(x, pygame.Surface):
+            memo[id(x)] = x.copy()
+        elif isinstance(x, random.Random):
+            memo[id(x)] = random.Random()
+        elif isinstance(x, np.random.RandomState):
+            memo[id(x)] = np.random.RandomState()
+        elif isinstance(x, dict):
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple, set, frozenset, deque)):
+            stack.extend(x)
+        elif hasattr(x, '__dict__') and not isinstance(x, (type, types.ModuleType, types.FunctionType)):
+            stack.extend(vars(x).values())
+    return memo
+
+
 class SoccerPlayer(RLEnvironment):
     """
     A wrapper for pygame_soccer emulator.
@@ -178,13 +401,42 @@ class SoccerPlayer(RLEnvironment):
     """
     SOCCER_WIDTH = 288
     SOCCER_HEIGHT = 192
+    SOCCER_LARGE_WIDTH = 416
+    SOCCER_LARGE_HEIGHT = 320
+    TILE_SIZE = 32
+    # the four moves and STAND of pygame_soccer, known without building an environment
+    NUM_ACTIONS = 5
+
+    # channels of the 'grid' observation
+    GRID_CHANNELS = ['self', 'teammate', 'opponent', 'ball', 'player_goal', 'computer_goal', 'offensive']
 
     def __init__(self, viz=0,
                 field=None, partial=False, radius=2,
                 frame_skip=4,
                 image_shape=(84, 84),
-                mode=None, team_size=1, ai_frame_skip=1, raw_env=soccer_environment.SoccerEnvironment):
+                mode=None, team_size=1, ai_frame_skip=1, raw_env=BatchedAIEnvironment,
+                obs_type='pixel', renderer='pygame', reset_pool=0):
+        """
+        Args:
+            obs_type (str): 'pixel' for a gray-scale screenshot resized to `image_shape`,
+                or 'grid' for a (rows, cols, len(GRID_CHANNELS)) uint8 tensor built from
+                the game state without rendering.
+            renderer (str): how to draw the 'pixel' observation. 'pygame' renders a
+                screenshot and resizes it, 'fast' draws the resized gray-scale image
+                directly with :class:`FastRenderer`. Falls back to 'pygame' when the
+                fast renderer doesn't reproduce the pygame observation.
+            reset_pool (int): if positive, take that many initial states of
+                episodes at construction, and restart episodes by restoring a
+                random one of them instead of resetting the environment.
+        """
         super(SoccerPlayer, self).__init__()
+        assert obs_type in ['pixel', 'grid'], obs_type
+        assert renderer in ['pygame', 'fast'], renderer
+        assert not (partial and obs_type == 'grid'), "partial observation is only for pixels"
+        self.obs_type = obs_type
+        self.renderer = 'pygame'
+        # per-stage timings of action() and current_state(), None unless enabled by hotpath.enable()
+        self._timer = hotpath.get_timer()
 
         if team_size > 1 and mode != None:
             self.mode = mode.split(',')
@@ -194,22 +446,29 @@ class SoccerPlayer(RLEnvironment):
         self.partial = partial
         self.viz = viz
         if self.viz:
+            import pygame_soccer.soccer.soccer_renderer as soccer_renderer
             self.renderer_options = soccer_renderer.RendererOptions(
                 show_display=True, max_fps=10, enable_key_events=True)
         else:
             self.renderer_options = None
 
         if self.field == 'large' :
+            import pygame_soccer.util.file_util as file_util
             map_path = file_util.resolve_path(__file__, '../data/map/soccer_large.tmx')
         else :
             map_path = None
+        self.map_path = map_path
 
         self.team_size = team_size
         self.env_options = soccer_environment.SoccerEnvironmentOptions(team_size=self.team_size, map_path=map_path, ai_frame_skip=ai_frame_skip)
-        self.env = raw_env(env_options=self.env_options, renderer_options=self.renderer_options)
+        self.env = make_environment(raw_env, self.env_options, self.renderer_options)
 
         self.computer_team_name = self.env.team_names[1]
         self.player_team_name = self.env.team_names[0]
+        # agent order of the symbolic state
+        self._agent_indices = [self.env.get_agent_index(team_name, i)
+                               for team_name in [self.player_team_name, self.computer_team_name]
+                               for i in range(self.team_size)]
 
         # Partial
         if self.partial:
@@ -217,6 +476,8 @@ class SoccerPlayer(RLEnvironment):
             self.player_agent_index = self.env.get_agent_index(self.player_team_name, 0)
 
         self.actions = self.env.actions
+        assert len(self.actions) == SoccerPlayer.NUM_ACTIONS, self.actions
+        self._init_step()
         self.frame_skip = frame_skip
         self.image_shape = image_shape
 
@@ -225,7 +486,134 @@ class SoccerPlayer(RLEnvironment):
         self.changing_counter = 0
         self.timestep = 0
         self.current_episode_score = StatCounter()
+        # the observation of a restored snapshot, until the next step
+        self._obs = None
+        self._reset_pool = None
+        if self.obs_type == 'grid':
+            self._init_grid()
         self.restart_episode()
+        if renderer == 'fast' and obs_type == 'pixel':
+            self._init_fast_renderer()
+        if reset_pool > 0:
+            pool = []
+            for _ in range(reset_pool):
+                self.restart_episode()
+                pool.append(self.snapshot())
+            self._reset_pool = pool
+
+    @staticmethod
+    def get_state_shape(obs_type='pixel', image_shape=(84, 84), field=None, **kwargs):
+        """ shape of :meth:`current_state` for the given constructor arguments """
+        if obs_type == 'pixel':
+            # cv2.resize takes (w, h)
+            return tuple(image_shape[::-1])
+        if field == 'large':
+            w, h = SoccerPlayer.SOCCER_LARGE_WIDTH, SoccerPlayer.SOCCER_LARGE_HEIGHT
+        else:
+            w, h = SoccerPlayer.SOCCER_WIDTH, SoccerPlayer.SOCCER_HEIGHT
+        return (h // SoccerPlayer.TILE_SIZE, w // SoccerPlayer.TILE_SIZE, len(SoccerPlayer.GRID_CHANNELS))
+
+    @staticmethod
+    def get_symbolic_shape(team_size=1, **kwargs):
+        """ shape of :meth:`symbolic_state` for the given constructor arguments """
+        return (team_size * 2, 3)
+
+    def symbolic_state(self):
+        """
+        Returns:
+            a (num_agents, 3) uint8 array of (x, y, has ball) of the player team
+            then the computer team, from which :meth:`get_symbolic_renderer`
+            draws the same frame as :meth:`current_state`.
+        """
+        state = self.env.state
+        return np.asarray([tuple(state.get_agent_pos(index)) + (state.get_agent_ball(index),)
+                           for index in self._agent_indices], dtype='uint8')
+
+    def get_symbolic_renderer(self):
+        """ the :class:`FastRenderer` of this player, it takes :meth:`symbolic_state` """
+        assert self.renderer == 'fast', "Symbolic states need the fast renderer!"
+        return self._fast_renderer
+
+    def _init_grid(self):
+        """ the static part of the grid observation and the agent lookups """
+        shape = self.get_state_shape('grid', field=self.field)
+        self._grid_base = np.zeros(shape, dtype='uint8')
+        ch = self.GRID_CHANNELS
+        for team_name, c in [(self.player_team_name, ch.index('player_goal')),
+                             (self.computer_team_name, ch.index('computer_goal'))]:
+            for x, y in self.env.map_data.goals[team_name]:
+                self._grid_base[y, x, c] = 255
+        self._grid_obs = np.empty_like(self._grid_base)
+        player_index = self.env.get_agent_index(self.player_team_name, 0)
+        self._grid_agents = []
+        for team_name in [self.player_team_name, self.computer_team_name]:
+            for i in range(self.team_size):
+                index = self.env.get_agent_index(team_name, i)
+                if index == player_index:
+                    c = ch.index('self')
+                elif team_name == self.player_team_name:
+                    c = ch.index('teammate')
+                else:
+                    c = ch.index('opponent')
+                self._grid_agents.append((index, c))
+
+    def _get_grid_state(self):
+        ret = self._grid_obs
+        ret[...] = self._grid_base
+        state = self.env.state
+        ball_index = state.get_ball_possession()['agent_index']
+        c_ball = self.GRID_CHANNELS.index('ball')
+        c_offensive = self.GRID_CHANNELS.index('offensive')
+        for index, c in self._grid_agents:
+            x, y = state.get_agent_pos(index)
+            ret[y, x, c] = 255
+            if index == ball_index:
+                ret[y, x, c_ball] = 255
+            if state.get_agent_mode(index) == 'OFFENSIVE':
+                ret[y, x, c_offensive] = 255
+        return ret.copy()
+
+    def _init_fast_renderer(self):
+        """
+        Set up the :class:`FastRenderer` like the pygame_soccer renderer: its
+        screenshot is the (width, height) pygame surface array, and agent i is
+        drawn with sprite AGENT{i+1} of agent_sprite.yaml. It's checked against
+        the pygame observation of the current state, see `python src/fast_renderer.py`
+        for the check over many steps.
+        """
+        if self.partial:
+            logger.warn("The fast renderer doesn't support partial observation, using pygame.")
+            return
+        map_path = self.map_path or _default_map_path()
+        if not os.path.isfile(map_path):
+            logger.warn("Map {} not found, using the pygame renderer.".format(map_path))
+            return
+        from tile_map import load_tile_map
+        from fast_renderer import FastRenderer, check_parity, PARITY_MAX_DIFF, PARITY_MEAN_DIFF
+        renderer = FastRenderer(load_tile_map(map_path), self.get_state_shape(image_shape=self.image_shape),
+                                transpose=True, sprites=['AGENT{}'.format(index + 1) for index in self._agent_indices])
+        max_diff, mean_diff = check_parity(renderer.render(self._get_fast_agents(renderer)), self._pygame_state())
+        if max_diff > PARITY_MAX_DIFF or mean_diff > PARITY_MEAN_DIFF:
+            logger.warn("The fast renderer differs from the pygame observation by up to {} (mean {:.3f}), "
+                        "using pygame.".format(max_diff, mean_diff))
+            return
+        self._fast_renderer = renderer
+        self.renderer = 'fast'
+
+    def _get_fast_agents(self, renderer):
+        state = self.env.state
+        ret = []
+        for index, sprite in zip(self._agent_indices, renderer.sprites):
+            x, y = state.get_agent_pos(index)
+            ret.append((x, y, sprite + '_BALL' if state.get_agent_ball(index) else sprite))
+        return ret
+
+    def _pygame_state(self):
+        import cv2
+        ret = self._grab_raw_image()
+        ret = cv2.cvtColor(ret, cv2.COLOR_RGB2GRAY)
+        ret = cv2.resize(ret, self.image_shape)
+        return ret.astype('uint8')  # to save some memory
 
     def _grab_raw_image(self):
         self.env.render()
@@ -235,6 +623,17 @@ class SoccerPlayer(RLEnvironment):
             screenshot = self.env.renderer.get_screenshot()
         return screenshot
 
+    def _get_ai_actions(self):
+        """ the rule-based action of every agent, keyed by agent index """
+        if isinstance(self.env, BatchedAIEnvironment):
+            return self.env.get_ai_actions()
+        actions = {}
+        for team_name in self.env.team_names:
+            for team_agent_index in range(self.env.options.team_size):
+                agent_index = self.env.get_agent_index(team_name, team_agent_index)
+                actions[agent_index] = self.env._get_ai_action(team_name, team_agent_index)
+        return actions
+
     def _get_computer_actions(self):
         # Collaborator
         for i in range(self.team_size):
@@ -270,11 +669,30 @@ class SoccerPlayer(RLEnvironment):
             # Opponent
             self._set_opponent_mode(mode[(self.team_size - 1):])
 
+    def _render(self):
+        """ update the display after a step, observations are drawn by :meth:`current_state` """
+        if self.viz:
+            self.env.render()
+
     def current_state(self):
-        ret = self._grab_raw_image()
-        ret = cv2.cvtColor(ret, cv2.COLOR_RGB2GRAY)
-        ret = cv2.resize(ret, self.image_shape)
-        return ret.astype('uint8')  # to save some memory
+        """
+        With the fast renderer, the returned array is read-only and is the same
+        object until the agents move or the ball changes hands.
+        """
+        if self._obs is not None:
+            return self._obs
+        tm = self._timer
+        if tm:
+            t = tm.now()
+        if self.obs_type == 'grid':
+            ret = self._get_grid_state()
+        elif self.renderer == 'fast':
+            ret = self._fast_renderer.render(self._get_fast_agents(self._fast_renderer))
+        else:
+            ret = self._pygame_state()
+        if tm:
+            tm.add('render', t)
+        return ret
 
     def get_action_space(self):
         return DiscreteActionSpace(len(self.actions))
@@ -283,81 +701,185 @@ class SoccerPlayer(RLEnvironment):
         self.stats['score'].append(self.current_episode_score.sum)
 
     def restart_episode(self):
+        if self._reset_pool is not None:
+            self.restore(random.choice(self._reset_pool))
+            return
+        self._obs = None
         self.current_episode_score.reset()
         self.env.reset()
         self._set_computer_mode(self.mode)
-        self.last_raw_screen = self._grab_raw_image()
+        if self.renderer == 'fast':
+            self._fast_renderer.reset()
+        self._render()
         self.changing_counter = 0
         self.timestep = 0
 
-    def action(self, act):
-        ball_pos_agent_old = self.env.state.get_ball_possession()
+    def _state_memo(self, env=None):
+        """ a deepcopy memo which maps what the game state of `env` shares
+            with its environment to the same parts of this player's environment """
+        src = self.env if env is None else env
+        memo = {id(src): self.env}
+        for k in ['map_data', 'options', 'renderer']:
+            if hasattr(src, k):
+                memo[id(getattr(src, k))] = getattr(self.env, k)
+        return memo
+
+    def snapshot(self):
+        """
+        Returns:
+            SoccerSnapshot: the game state, the mode, the counters and the
+            observation of the current step, for :meth:`restore`. The random
+            generators aren't part of it.
+        """
+        obs = self.current_state()
+        if obs.flags.writeable:
+            obs = obs.copy()
+            obs.flags.writeable = False
+        return SoccerSnapshot(
+            state=copy.deepcopy(self.env.state.__dict__, self._state_memo()),
+            mode=list(self.mode),
+            timestep=self.timestep,
+            changing_counter=self.changing_counter,
+            score=copy.deepcopy(self.current_episode_score),
+            agent_actions=list(self.agent_actions),
+            obs=obs)
+
+    def restore(self, snapshot):
+        """
+        Go back to a :meth:`snapshot` of this player. The snapshot can be restored again.
+        """
+        # in place, the renderer may hold the state object
+        self.env.state.__dict__.update(copy.deepcopy(snapshot.state, self._state_memo()))
+        if isinstance(self.env, BatchedAIEnvironment):
+            self.env._ai_frame = None
+        if snapshot.mode != self.mode:
+            self.mode = list(snapshot.mode)
+            self._init_step()
+        self.timestep = snapshot.timestep
+        self.changing_counter = snapshot.changing_counter
+        self.current_episode_score = copy.deepcopy(snapshot.score)
+        self.agent_actions[:] = snapshot.agent_actions
+        self._obs = snapshot.obs
+        self._render()
+
+    def clone(self):
+        """
+        A copy of this player in its current state for lookahead rollouts,
+        which shares the map and the renderer but not the game state.
+        Only for the 'grid' observation or the fast renderer, without viz.
+        """
+        assert not self.viz and (self.obs_type == 'grid' or self.renderer == 'fast'), \
+            "The pygame renderer draws the state of the original player"
+        other = copy.copy(self)
+        other.env = copy.copy(self.env)
+        other.env.state = copy.copy(self.env.state)
+        other.env.state.__dict__ = copy.deepcopy(self.env.state.__dict__, other._state_memo(self.env))
+        other.last_info = dict(self.last_info)
+        other.agent_actions = list(self.agent_actions)
+        other.current_episode_score = copy.deepcopy(self.current_episode_score)
+        other.reset_stat()
+        if self.renderer == 'fast':
+            # with its own image, which is updated in place
+            other._fast_renderer = copy.copy(self._fast_renderer)
+            other._fast_renderer.reset()
+        # the routines of a frame are bound to this player
+        other._init_step()
+        return other
+
+    def _init_step(self):
+        """ resolve the mode into the routine which steps one frame """
+        env = self.env
+        self._player_index = env.get_agent_index(self.player_team_name, 0)
+        if self.team_size > 1:
+            self._coop_index = env.get_agent_index(self.player_team_name, 1)
+            # all agents draw a random action in ALL_RANDOM, the player's is overridden
+            self._random_indices = self._agent_indices
+        else:
+            self._random_indices = self._agent_indices[1:]
+        steps = {'WEAKCOOP': self._step_weakcoop,
+                 'OPPONENT_DYNAMIC': self._step_opponent_dynamic,
+                 'COOP_DYNAMIC': self._step_coop_dynamic,
+                 'ALL_RANDOM': self._step_all_random}
+        self._step_frame = steps.get(self.mode[0], self._step_default)
+
+    def _step_default(self, act):
+        return self.env.take_action(self.env.actions[act])
+
+    def _step_weakcoop(self, act):
+        actions = self._get_ai_actions()
+        actions[self._player_index] = self.env.actions[act]
+        if random.random() < 0.5:
+            actions[self._coop_index] = random.choice(self.env.actions)
+        return self.env.take_all_actions(actions)
+
+    def _step_opponent_dynamic(self, act):
+        ret = self.env.take_action(self.env.actions[act])
+        if self.timestep % random.randint(4, 10) == 0:
+            self._set_opponent_mode([random.choice(['OFFENSIVE', 'DEFENSIVE']) for i in range(self.team_size)])
+        return ret
+
+    def _step_coop_dynamic(self, act):
+        ret = self.env.take_action(self.env.actions[act])
+        if self.timestep % random.randint(4, 10) == 0:
+            self._set_collaborator_mode([random.choice(['OFFENSIVE', 'DEFENSIVE']) for i in range(self.team_size - 1)])
+        return ret
+
+    def _step_all_random(self, act):
+        # the player's action is taken once with the rule-based agents, and
+        # once more with all the other agents acting randomly
+        self.env.take_action(self.env.actions[act])
+        actions = dict.fromkeys(self._agent_indices)
+        for index in self._random_indices:
+            actions[index] = random.choice(self.env.actions)
+        actions[self._player_index] = self.env.actions[act]
+        return self.env.take_all_actions(actions)
+
+    def step_n(self, act, n):
+        """
+        Step the environment `n` frames with action `act`, or until the episode ends.
+        The episode isn't restarted, see :meth:`action`.
+
+        Returns:
+            (reward, isOver, agent_actions, ball_changed), where agent_actions are
+            the actions of all agents in the first frame, and ball_changed tells
+            if the ball went to another agent of the player team.
+        """
+        env = self.env
+        self._obs = None
+        ball_old = env.state.get_ball_possession()
+        step = self._step_frame
+        tm = self._timer
         r = 0
-        ball_poss_old = self.env.state.get_ball_possession()['team_name']
-        for k in range(self.frame_skip):
+        isOver = False
+        agent_actions = None
+        for k in range(n):
+            if tm:
+                t = tm.now()
             self.timestep += 1
-            if k == self.frame_skip - 1:
-                self.last_raw_screen = self._grab_raw_image()
-
-            if self.mode[0] == 'WEAKCOOP':
-                actions = {}
-                for team_name in self.env.team_names:
-                    for team_agent_index in range(self.env.options.team_size):
-                        agent_index = self.env.get_agent_index(team_name, team_agent_index)
-                        agent_action = self.env._get_ai_action(team_name, team_agent_index)
-                        actions[agent_index] = agent_action
-                player_index = self.env.get_agent_index(self.player_team_name, 0)
-                coop_index = self.env.get_agent_index(self.player_team_name, 1)
-
-                actions[player_index] = self.env.actions[act]
-                if random.random() < 0.5:
-                    actions[coop_index] = random.choice(self.env.actions)
-                ret = self.env.take_all_actions(actions)
-            else:
-                ret = self.env.take_action(self.env.actions[act])
-
-            if self.mode[0] == 'OPPONENT_DYNAMIC':
-                choices = ['OFFENSIVE', 'DEFENSIVE']
-                if self.timestep % random.randint(4, 10) == 0:
-                    new_modes = [random.choice(choices) for i in range(self.team_size)]
-                    self._set_opponent_mode(new_modes)
-
-            if self.mode[0] == 'COOP_DYNAMIC':
-                choices = ['OFFENSIVE', 'DEFENSIVE']
-                if self.timestep % random.randint(4, 10) == 0:
-                    new_modes = [random.choice(choices) for i in range(self.team_size - 1)]
-                    self._set_collaborator_mode(new_modes)
-
-            if self.mode[0] == 'ALL_RANDOM':
-                if self.team_size == 1:
-                    player_index = self.env.get_agent_index(self.player_team_name, 0)
-                    opponent_index = self.env.get_agent_index(self.computer_team_name, 0)
-                    actions = {player_index: self.env.actions[act],
-                           opponent_index: random.choice(self.env.actions)}
-                else:
-                    actions = {}
-                    for team_name in [self.player_team_name, self.computer_team_name]:
-                        for team_index in range(self.team_size):
-                            agent_index = self.env.get_agent_index(team_name, team_index)
-                            actions[agent_index] = random.choice(self.env.actions)
-                    player_index = self.env.get_agent_index(self.player_team_name, 0)
-                    actions[player_index] = self.env.actions[act]
-                ret = self.env.take_all_actions(actions)
+            if k == n - 1:
+                self._render()
+            ret = step(act)
+            if tm:
+                t = tm.add('take_action', t)
             if k == 0:
-                self.last_info['agent_actions'] = self._get_computer_actions()
+                agent_actions = self._get_computer_actions()
+                if tm:
+                    tm.add('computer_actions', t)
             r += ret.reward
-
-            if self.env.state.is_terminal():
+            if env.state.is_terminal():
+                isOver = True
                 break
 
-        self.current_episode_score.feed(r)
-        isOver = self.env.state.is_terminal()
-        ball_pos_agent_new = self.env.state.get_ball_possession()
-
-        if ball_pos_agent_old['team_name'] == ball_pos_agent_new['team_name'] and ball_pos_agent_new['team_name'] == 'PLAYER':
-            if ball_pos_agent_old['team_agent_index'] != ball_pos_agent_new['team_agent_index']:
-                self.changing_counter += 1
+        ball_new = env.state.get_ball_possession()
+        ball_changed = (ball_old['team_name'] == ball_new['team_name'] == 'PLAYER' and
+                        ball_old['team_agent_index'] != ball_new['team_agent_index'])
+        return r, isOver, agent_actions, ball_changed
 
+    def action(self, act):
+        r, isOver, self.last_info['agent_actions'], ball_changed = self.step_n(act, self.frame_skip)
+        self.current_episode_score.feed(r)
+        if ball_changed:
+            self.changing_counter += 1
         if isOver:
             self.finish_episode()
             self.restart_episode()
@@ -370,7 +892,7 @@ class SoccerPlayer(RLEnvironment):
 
 def get_raw_env(experiment):
     if experiment == 'STANDARD':
-        return soccer_environment.SoccerEnvironment
+        return BatchedAIEnvironment
     elif experiment == 'PASSING':
         return soccer_environment.SoccerPassingBallEnvironment
     elif experiment == 'SAVING':
@@ -20,6 +20,8 @@ import pygame_soccer.soccer.soccer_environment as soccer_environment
 import pygame_soccer.soccer.soccer_renderer as soccer_renderer
 import pygame_soccer.util.file_util as file_util
 
+from soccer_env import make_environment
+
 __all__ = ['SoccerPlayer']
 
 
@@ -57,7 +59,7 @@ class SoccerPlayer(RLEnvironment):
 
         self.team_size = team_size
         self.env_options = soccer_environment.SoccerEnvironmentOptions(team_size=self.team_size, map_path=map_path, ai_frame_skip=ai_frame_skip)
-        self.env = soccer_environment.SoccerEnvironment(env_options=self.env_options, renderer_options=self.renderer_options)
+        self.env = make_environment(soccer_environment.SoccerEnvironment, self.env_options, self.renderer_options)
 
         self.computer_team_name = self.env.team_names[1]
         self.player_team_name = self.env.team_names[0]
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import xml.etree.ElementTree as ET
+import yaml
+
+__all__ = ['TileMap', 'load_tile_map']
+
+# the high bits of a gid are flip flags
+GID_MASK = 0x1FFFFFFF
+
+# where load_tile_map keeps the compiled maps
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dpiqn', 'maps')
+
+
+class TileMap(object):
+    """
+    The data of a Tiled map (.tmx) used by pygame_soccer: tile layers,
+    goal/spawn positions, agent sprites and the decoded tileset.
+    Positions are (x, y) in tiles, arrays are indexed by [y, x].
+    """
+
+    def __init__(self, tmx_path):
+        self.path = os.path.abspath(tmx_path)
+        # every file the map is read from
+        self.sources = [self.path]
+        root = ET.parse(self.path).getroot()
+        base = os.path.dirname(self.path)
+        self.width = int(root.get('width'))
+        self.height = int(root.get('height'))
+        self.tile_width = int(root.get('tilewidth'))
+        self.tile_height = int(root.get('tileheight'))
+
+        ts = root.find('tileset')
+        self.firstgid = int(ts.get('firstgid'))
+        tsx_path = os.path.join(base, ts.get('source'))
+        tsx = ET.parse(tsx_path).getroot()
+        self.sources.append(os.path.normpath(tsx_path))
+        self.columns = int(tsx.get('columns'))
+        self.tileset_path = os.path.normpath(os.path.join(os.path.dirname(tsx_path), tsx.find('image').get('source')))
+        self.tileset = self._load_image(self.tileset_path)
+        self.sources.append(self.tileset_path)
+
+        # name -> (gid array, properties)
+        self.layers = []
+        for layer in root.findall('layer'):
+            props = {p.get('name'): p.get('value') for p in layer.findall('properties/property')}
+            data = layer.find('data').text
+            gids = np.array([int(v) for v in data.replace('\n', '').split(',')], dtype='int64')
+            gids = (gids & GID_MASK).reshape(self.height, self.width)
+            for k in ['tile', 'sprite']:
+                if k in props:
+                    path = os.path.normpath(os.path.join(base, props[k]))
+                    with open(path) as f:
+                        props[k] = yaml.safe_load(f)
+                    self.sources.append(path)
+            self.layers.append((layer.get('name'), gids, props))
+        self._set_lookups()
+
+    def _set_lookups(self):
+        """ the attributes derived from the layers """
+        self.background = [gids for _, gids, props in self.layers if props.get('background') == 'true']
+        self.goals = self._find_tiles('goal')
+        self.spawns = self._find_tiles('spawn_area')
+        self.sprites = {}
+        for _, gids, props in self.layers:
+            for name, pos in props.get('sprite', {}).items():
+                self.sprites[name] = int(gids[pos['y'], pos['x']])
+
+    def _load_image(self, path):
+        """ returns the image as (h, w, 4) RGBA uint8 """
+        import cv2
+        im = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        assert im is not None, path
+        if im.ndim == 2:
+            im = cv2.cvtColor(im, cv2.COLOR_GRAY2RGBA)
+        elif im.shape[2] == 3:
+            im = cv2.cvtColor(im, cv2.COLOR_BGR2RGBA)
+        else:
+            im = cv2.cvtColor(im, cv2.COLOR_BGRA2RGBA)
+        return im
+
+    def _find_tiles(self, layer_name):
+        """ returns {name: [(x, y), ...]} of the tiles of a layer listed in its tile yaml """
+        for name, gids, props in self.layers:
+            if name == layer_name:
+                return {k: [(int(x), int(y)) for y, x in zip(*np.nonzero(gids == v))]
+                        for k, v in props['tile'].items()}
+        return {}
+
+    def get_tile(self, gid):
+        """ returns the RGBA (tile_height, tile_width, 4) image of a gid """
+        idx = gid - self.firstgid
+        y = idx // self.columns * self.tile_height
+        x = idx % self.columns * self.tile_width
+        return self.tileset[y:y + self.tile_height, x:x + self.tile_width]
+
+    def save(self, cache_path, digest):
+        """
+        Write the map to directory `cache_path` for :meth:`load`: the arrays
+        as .npy files, the rest in meta.json, which is written last.
+        """
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        arrays = [('tileset', self.tileset)] + [('layer{}'.format(i), gids) for i, (_, gids, _) in enumerate(self.layers)]
+        files = {}
+        for name, arr in arrays:
+            files[name] = '{}-{}.npy'.format(digest[:16], name)
+            # renamed into place, so that readers which mapped an older file keep it
+            tmp = os.path.join(cache_path, '{}.{}.tmp.npy'.format(files[name], os.getpid()))
+            np.save(tmp, np.ascontiguousarray(arr))
+            os.rename(tmp, os.path.join(cache_path, files[name]))
+        meta = {'digest': digest,
+                'files': files,
+                'path': self.path,
+                'sources': self.sources,
+                'size': [self.width, self.height, self.tile_width, self.tile_height],
+                'firstgid': self.firstgid,
+                'columns': self.columns,
+                'tileset_path': self.tileset_path,
+                'layers': [(name, props) for name, _, props in self.layers]}
+        tmp = os.path.join(cache_path, 'meta.json.{}.tmp'.format(os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.rename(tmp, os.path.join(cache_path, 'meta.json'))
+        # the arrays of older versions of the sources
+        for fname in os.listdir(cache_path):
+            if fname.endswith('.npy') and fname not in files.values() and '.tmp.' not in fname:
+                os.remove(os.path.join(cache_path, fname))
+
+    @classmethod
+    def load(cls, cache_path, meta=None):
+        """
+        Read a map written by :meth:`save`. The arrays are memory-mapped
+        read-only, so all the processes on a host share one copy.
+        """
+        if meta is None:
+            meta = read_cache_meta(cache_path)
+        self = cls.__new__(cls)
+        self.path = meta['path']
+        self.sources = meta['sources']
+        self.width, self.height, self.tile_width, self.tile_height = meta['size']
+        self.firstgid = meta['firstgid']
+        self.columns = meta['columns']
+        self.tileset_path = meta['tileset_path']
+        files = meta['files']
+        self.tileset = np.load(os.path.join(cache_path, files['tileset']), mmap_mode='r')
+        self.layers = [(name, np.load(os.path.join(cache_path, files['layer{}'.format(i)]), mmap_mode='r'), props)
+                       for i, (name, props) in enumerate(meta['layers'])]
+        self._set_lookups()
+        return self
+
+
+def read_cache_meta(cache_path):
+    """ returns the meta.json of a compiled map, or None if there is none """
+    try:
+        with open(os.path.join(cache_path, 'meta.json')) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def sources_digest(sources):
+    """ sha1 of the contents of the files, or None if one is missing """
+    h = hashlib.sha1()
+    for path in sorted(set(sources)):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        h.update(path.encode('utf-8'))
+        h.update(hashlib.sha1(data).digest())
+    return h.hexdigest()
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def load_tile_map(tmx_path, cache_dir=CACHE_DIR):
+    """
+    A :class:`TileMap` of `tmx_path`, compiled once for all processes.
+
+    The compiled map in `cache_dir` is used when the sha1 of its source
+    files (the tmx, tsx, yaml and tileset image) is unchanged, otherwise the
+    map is parsed and the cache rewritten. Within a process, players of the
+    same map share one read-only :class:`TileMap`.
+
+    Args:
+        cache_dir (str or None): None to always parse.
+    """
+    path = os.path.abspath(tmx_path)
+    if cache_dir is None:
+        return TileMap(path)
+    cache_path = os.path.join(cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest()[:16])
+    with _loaded_lock:
+        meta = read_cache_meta(cache_path)
+        digest = sources_digest(meta['sources']) if meta is not None else None
+        if digest is not None and digest == meta['digest']:
+            if digest not in _loaded:
+                try:
+                    _loaded[digest] = TileMap.load(cache_path, meta)
+                except (IOError, OSError, ValueError):
+                    # e.g. removed by a writer of a newer version
+                    digest = None
+            if digest is not None:
+                return _loaded[digest]
+        tile_map = TileMap(path)
+        digest = sources_digest(tile_map.sources)
+        try:
+            tile_map.save(cache_path, digest)
+        except (IOError, OSError) as e:
+            from tensorpack.utils import logger
+            logger.warn("Can't write the compiled map to {}: {}".format(cache_path, e))
+        _loaded[digest] = tile_map
+        return tile_map
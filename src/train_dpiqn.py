@@ -3,6 +3,8 @@
 # File: train_soccer.py
 # Author: Zhangwei hong <williamd4112@hotmail.com>
 
+# first, so that --startup_report times the other imports
+import hotpath
 import numpy as np
 
 import os
@@ -14,6 +16,7 @@ import argparse
 import subprocess
 import multiprocessing
 import threading
+import functools
 from collections import deque
 
 from tensorpack import *
@@ -26,11 +29,18 @@ from DPIQNModel import Model as DQNModel
 import common
 from common import play_model, Evaluator, eval_model_multithread
 from soccer_env import SoccerPlayer
-from augment_expreplay import AugmentExpReplay
-from tensorpack.tfutils import symbolic_functions as symbf
+from frame_history import FrameHistoryPlayer
+from augment_expreplay import AugmentExpReplay, AugmentReplayMemory
+from expreplay import ReplayMemorySaver
+# vec_soccer_env, shared_expreplay, distributed, quantize and benchmark are imported by
+# the tasks that use them, shared memory needs Python 3.8+
+hotpath.STARTUP.mark('imports')
 
 BATCH_SIZE = None
 IMAGE_SIZE = (84, 84)
+OBS_TYPE = 'pixel'
+RENDERER = 'pygame'
+OBS_CHANNELS = 1
 FRAME_HISTORY = None
 ACTION_REPEAT = None   # aka FRAME_SKIP
 UPDATE_FREQ = 4
@@ -38,10 +48,33 @@ UPDATE_FREQ = 4
 GAMMA = 0.99
 
 MEMORY_SIZE = 1e6
-# will consume at least 1e6 * 84 * 84 bytes == 6.6G memory.
+SYMBOLIC_REPLAY = False
+PRIORITIZED = False
+PRIO_ALPHA = 0.6
+BETA_SCHED = None
+# will consume at least 1e6 * 84 * 84 bytes == 6.6G memory, unless MEMORY_DIR is set
+MEMORY_DIR = None
+NR_ENV = 1
+PREDICTOR_BROKER = None
+NR_ACTOR = 0
+# address the learner listens on for remote actors, see distributed.parse_address
+LEARNER = None
+# file with the shared secret of the learner and the remote actors, see distributed.read_authkey
+AUTHKEY_FILE = None
+WEIGHT_PERIOD = 400
+ACTOR_CHUNK = 256
+ACTOR_INT8 = False
+SHARE_FEATURES = False
+STARTUP_REPORT = False
+# number of initial states the training players restart from, 0 to reset the game
+RESET_POOL = 0
+NR_SAMPLER = 2
+PREFETCH = 4
 INIT_MEMORY_SIZE = 5e4
 STEPS_PER_EPOCH = 1000 // UPDATE_FREQ * 10  # each epoch is 100k played frames
 EVAL_EPISODE = 50
+# number of epochs between two evaluations in training, 0 to disable
+EVAL_PERIOD = 0
 
 NUM_ACTIONS = None
 METHOD = None
@@ -53,6 +86,9 @@ RNN_CELL = 'lstm'
 FC_HIDDEN = 512
 RNN_HIDDEN = 512
 RNN_STEP = 1
+# with the recurrent state kept in the replay memory, the frames to warm it up over
+RNN_BURN_IN = 0
+RNN_STATE_SIZE = 0
 UPDATE_TARGET_STEP = 10000
 MULTI_TASK = False
 LR_SCHED = None
@@ -63,18 +99,38 @@ REG = None
 TASK = None
 PI_COEF = 1.0
 
-def get_player(viz=False, train=False):
-    pl = SoccerPlayer(image_shape=IMAGE_SIZE[::-1], viz=viz, frame_skip=ACTION_REPEAT, field=FIELD, ai_frame_skip=AI_SKIP, team_size=2 if MULTI_TASK else 1, mode=MODE)
+def get_player(viz=False, train=False, nr_env=None):
+    """ with `nr_env`, return a VecSoccerPlayer of that many unwrapped players """
+    kwargs = dict(image_shape=IMAGE_SIZE[::-1], viz=viz, frame_skip=ACTION_REPEAT, field=FIELD, ai_frame_skip=AI_SKIP, team_size=2 if MULTI_TASK else 1, mode=MODE,
+                  obs_type=OBS_TYPE, renderer=RENDERER)
+    if train and SYMBOLIC_REPLAY:
+        # the replay memory renders the symbolic states with the fast renderer
+        kwargs['renderer'] = 'fast'
+    if train and RESET_POOL:
+        kwargs['reset_pool'] = RESET_POOL
+    if nr_env is not None:
+        # the players are stepped together in worker processes
+        from vec_soccer_env import VecSoccerPlayer
+        pl = VecSoccerPlayer(nr_env, symbolic=train and SYMBOLIC_REPLAY, **kwargs)
+        _startup_done()
+        return pl
+    pl = SoccerPlayer(**kwargs)
     if not train:
-        # create a new axis to stack history on
-        pl = MapPlayerState(pl, lambda im: im[:, :, np.newaxis])
         # in training, history is taken care of in expreplay buffer
-        pl = HistoryFramePlayer(pl, FRAME_HISTORY)
+        pl = FrameHistoryPlayer(pl, FRAME_HISTORY)
 
         pl = PreventStuckPlayer(pl, 30, 1)
     #pl = LimitLengthPlayer(pl, 30000)
+    _startup_done()
     return pl
 
+def _startup_done():
+    """ the startup ends with the first player """
+    hotpath.STARTUP.mark('player')
+    report = hotpath.STARTUP.finish()
+    if STARTUP_REPORT and report is not None:
+        logger.info(report)
+
 def get_rnn_cell():
     if RNN_CELL == 'gru':
         return tf.nn.rnn_cell.GRUCell(num_units=RNN_HIDDEN, activation=tf.nn.relu)
@@ -86,51 +142,95 @@ def get_rnn_cell():
 class Model(DQNModel):
     def __init__(self):
         super(Model, self).__init__(IMAGE_SIZE, FRAME_HISTORY, METHOD,
-            NUM_ACTIONS, GAMMA, LR, PI_COEF, RNN_HIDDEN, RNN_STEP, MULTI_TASK, 3 if MULTI_TASK else 1, REG, MULTI_TASK_MODE)
+            NUM_ACTIONS, GAMMA, LR, PI_COEF, RNN_HIDDEN, RNN_STEP, MULTI_TASK, 3 if MULTI_TASK else 1, REG, MULTI_TASK_MODE,
+            OBS_CHANNELS, PRIORITIZED, SHARE_FEATURES, RNN_STATE_SIZE)
 
     def get_rnn_init_state(self, cell, name):
-        return cell.zero_state(self.batch_size, tf.float32)
+        if self.rnn_state_in is None:
+            return cell.zero_state(self.batch_size, tf.float32)
+        # the stored state of the q layer, followed by the one of the pi layer
+        size = self.rnn_state_size // 2
+        state = self.rnn_state_in[:, :size] if name == 'q' else self.rnn_state_in[:, size:]
+        if RNN_CELL == 'lstm':
+            return tf.nn.rnn_cell.LSTMStateTuple(state[:, :RNN_HIDDEN], state[:, RNN_HIDDEN:])
+        return state
+
+    @staticmethod
+    def _flat_rnn_state(state):
+        if isinstance(state, tf.nn.rnn_cell.LSTMStateTuple):
+            return tf.concat(list(state), 1)
+        return state
 
     def _get_DQN_prediction(self, image):
         """ image: [0,255]"""
         image = image / 255.0
 
         if USE_RNN:
+            # one sample per frame
             self.batch_size = tf.shape(image)[0]
-            image = tf.transpose(image, perm=[0, 3, 1, 2])
-            image = tf.reshape(image, (self.batch_size * self.channel,) + self.image_shape + (1,))
-
+            image = self._split_frames(image, self.channel)
+        q_l, pi_l = self._get_frame_features(image)
+        return self._get_heads(q_l, pi_l, RNN_BURN_IN if self.rnn_state_in is not None else 0)
+
+    def _get_DQN_step(self, frame, rnn_state):
+        self.batch_size = tf.shape(frame)[0]
+        self.rnn_state_in = rnn_state
+        q_l, pi_l = self._get_frame_features(frame / 255.0)
+        Q, _, q_state, pi_state = self._get_heads(q_l, pi_l)
+        return Q, tf.concat([self._flat_rnn_state(q_state), self._flat_rnn_state(pi_state)], 1)
+
+    def _get_online_predictions(self, comb_state):
+        if not USE_RNN:
+            return super(Model, self)._get_online_predictions(comb_state)
+        # every distinct frame of the hist_len+1 window goes through the trunk once,
+        # and the windows of state and next_state are stacked on the batch axis
+        batch_size = tf.shape(comb_state)[0]
+        q_l, pi_l = self._get_frame_features(self._split_frames(comb_state / 255.0, self.channel + 1))
+
+        def windows(l):
+            l = tf.reshape(l, [batch_size, self.channel + 1, FC_HIDDEN])
+            return tf.concat([l[:, :-1], l[:, 1:]], 0)
+        self.batch_size = 2 * batch_size
+        Q, pis, _, _ = self._get_heads(windows(q_l), windows(pi_l),
+                                       RNN_BURN_IN if self.rnn_state_in is not None else 0)
+        self.batch_size = batch_size
+        return self._split_predictions(Q, pis)
+
+    def _split_frames(self, image, nr_frame):
+        """ (N, H, W, nr_frame * C) -> (N * nr_frame, H, W, C) """
+        batch_size = tf.shape(image)[0]
+        image = tf.reshape(image, (batch_size,) + self.image_shape + (nr_frame, self.obs_channels))
+        image = tf.transpose(image, perm=[0, 3, 1, 2, 4])
+        return tf.reshape(image, (batch_size * nr_frame,) + self.image_shape + (self.obs_channels,))
+
+    def _get_frame_features(self, image):
+        """ the conv trunk and the fc0 layers of both heads """
         with tf.variable_scope('q'):
             with argscope(Conv2D, nl=PReLU.symbolic_function, use_bias=True, padding='SAME'), \
                     argscope(LeakyReLU, alpha=0.01):
-                h = (LinearWrap(image)
-                     .Conv2D('conv0', out_channel=32, kernel_shape=8, stride=4)
-                     .Conv2D('conv1', out_channel=64, kernel_shape=4, stride=2)
-                     .Conv2D('conv2', out_channel=64, kernel_shape=3)())
+                if OBS_TYPE == 'grid':
+                    # the grid is already at tile resolution
+                    h = (LinearWrap(image)
+                         .Conv2D('conv0', out_channel=32, kernel_shape=3)
+                         .Conv2D('conv1', out_channel=64, kernel_shape=3)
+                         .Conv2D('conv2', out_channel=64, kernel_shape=3)())
+                else:
+                    h = (LinearWrap(image)
+                         .Conv2D('conv0', out_channel=32, kernel_shape=8, stride=4)
+                         .Conv2D('conv1', out_channel=64, kernel_shape=4, stride=2)
+                         .Conv2D('conv2', out_channel=64, kernel_shape=3)())
 
                 q_l = FullyConnected('fc0-q', h, FC_HIDDEN, nl=LeakyReLU)
                 pi_l = FullyConnected('fc0-pi', h, FC_HIDDEN, nl=LeakyReLU)
+        return q_l, pi_l
 
-                if USE_RNN:
-                    # q
-                    q_l = tf.reshape(q_l, [self.batch_size, self.channel, FC_HIDDEN])
-                    q_cell = get_rnn_cell()
-                    q_l, q_rnn_state_out = tf.nn.dynamic_rnn(inputs=q_l,
-                                cell=q_cell,
-                                initial_state=self.get_rnn_init_state(q_cell, 'q'),
-                                dtype=tf.float32, scope='rnn-q')
-                    q_l = q_l[:, -RNN_STEP:, :]
-                    q_l = tf.reshape(q_l, (self.batch_size * RNN_STEP, RNN_HIDDEN))
-
-                    # pi
-                    pi_l = tf.reshape(pi_l, [self.batch_size, self.channel, FC_HIDDEN])
-                    pi_cell = get_rnn_cell()
-                    pi_l, pi_rnn_state_out = tf.nn.dynamic_rnn(inputs=pi_l,
-                                cell=pi_cell,
-                                initial_state=self.get_rnn_init_state(pi_cell, 'pi'),
-                                dtype=tf.float32, scope='rnn-pi')
-                    pi_l = pi_l[:, -RNN_STEP:, :]
-                    pi_l = tf.reshape(pi_l, (self.batch_size * RNN_STEP, RNN_HIDDEN))
+    def _get_heads(self, q_l, pi_l, burn_in=0):
+        """ the recurrent layers if any, the Pivalue heads and the Qvalue head """
+        q_rnn_state_out = pi_rnn_state_out = None
+        if USE_RNN:
+            with tf.variable_scope('q'):
+                q_l, q_rnn_state_out = self._run_rnn(q_l, 'q', burn_in)
+                pi_l, pi_rnn_state_out = self._run_rnn(pi_l, 'pi', burn_in)
 
         pi_ys = []
         for i in range(self.num_agents):
@@ -148,7 +248,125 @@ class Model(DQNModel):
 
         pi_values = [ tf.identity(pi_ys[i], name='Pivalue-%d' % i) for i in range(self.num_agents) ]
 
-        return tf.identity(Q, name='Qvalue'), pi_values, None, None
+        return tf.identity(Q, name='Qvalue'), pi_values, q_rnn_state_out, pi_rnn_state_out
+
+    def _run_rnn(self, l, name, burn_in):
+        """ unroll the recurrent layer `name` over per-frame features, the first
+            `burn_in` frames only to warm up the initial state """
+        l = tf.reshape(l, [self.batch_size, -1, FC_HIDDEN])
+        cell = get_rnn_cell()
+        state = self.get_rnn_init_state(cell, name)
+        with tf.variable_scope('rnn-' + name) as scope:
+            if burn_in:
+                _, state = tf.nn.dynamic_rnn(inputs=l[:, :burn_in], cell=cell, initial_state=state,
+                                             dtype=tf.float32, scope=scope)
+                if isinstance(state, tf.nn.rnn_cell.LSTMStateTuple):
+                    state = tf.nn.rnn_cell.LSTMStateTuple(*[tf.stop_gradient(k) for k in state])
+                else:
+                    state = tf.stop_gradient(state)
+                scope.reuse_variables()
+                l = l[:, burn_in:]
+            l, state = tf.nn.dynamic_rnn(inputs=l, cell=cell, initial_state=state,
+                                         dtype=tf.float32, scope=scope)
+        l = l[:, -RNN_STEP:, :]
+        return tf.reshape(l, (-1, RNN_HIDDEN)), state
+
+def get_actor(config):
+    """ run in an actor process: its player and predictor, from the settings of the learner """
+    globals().update(config)
+    # the learner keeps the GPUs
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    if ACTOR_INT8:
+        import quantize
+        return get_player(train=True), quantize.QuantizedCheckpointPredictor(Model(), config['LOG_DIR'])
+    from shared_expreplay import CheckpointPredictor
+    return get_player(train=True), CheckpointPredictor(Model(), config['LOG_DIR'])
+
+def quantize_model(load, replay_dir, calib_size, output):
+    """ export an int8 Q-value graph of a checkpoint, calibrated on states of its replay memory,
+        and report how it compares with the float model on as many other states """
+    import quantize
+    pred = OfflinePredictor(PredictConfig(
+        model=Model(),
+        session_init=get_model_loader(load),
+        input_names=['state'],
+        output_names=['Qvalue']))
+    float_graph = quantize.freeze_graph(pred.sess, ['Qvalue'])
+    mem = AugmentReplayMemory(MEMORY_SIZE, IMAGE_SIZE if OBS_CHANNELS == 1 else IMAGE_SIZE + (OBS_CHANNELS,),
+                              FRAME_HISTORY, 3 if MULTI_TASK else 1, MEMORY_DIR, NR_ENV,
+                              get_player(train=True).get_symbolic_renderer() if SYMBOLIC_REPLAY else None)
+    logger.info("Loading calibration states from {} ...".format(replay_dir))
+    mem.load_snapshot(replay_dir)
+    states = quantize.sample_replay_states(mem, 2 * calib_size, np.random.RandomState(0))
+    int8_graph = quantize.quantize_graph(float_graph, states[:calib_size])
+    quantize.save_graph(int8_graph, output)
+    logger.info("Wrote the int8 graph to {}".format(output))
+    return quantize.parity_report(quantize.FrozenPredictor(float_graph), quantize.FrozenPredictor(int8_graph),
+                                  states[calib_size:])
+
+def get_expreplay(predictor_io_names, init_memory_size=None):
+    if LEARNER is not None:
+        import distributed
+        return distributed.RemoteExpReplay(
+            address=distributed.parse_address(LEARNER),
+            num_actions=NUM_ACTIONS,
+            state_shape=IMAGE_SIZE if OBS_CHANNELS == 1 else IMAGE_SIZE + (OBS_CHANNELS,),
+            batch_size=BATCH_SIZE,
+            memory_size=MEMORY_SIZE,
+            init_memory_size=init_memory_size or INIT_MEMORY_SIZE,
+            init_exploration=1.0,
+            update_frequency=UPDATE_FREQ,
+            history_len=FRAME_HISTORY,
+            num_agents=(3 if MULTI_TASK else 1),
+            chunk_size=ACTOR_CHUNK,
+            weight_period=WEIGHT_PERIOD,
+            authkey=distributed.read_authkey(AUTHKEY_FILE),
+            nr_sampler=NR_SAMPLER,
+            prefetch=PREFETCH
+        )
+    if NR_ACTOR > 0:
+        from shared_expreplay import SharedExpReplay
+        config = {k: v for k, v in globals().items() if k.isupper()}
+        config['LOG_DIR'] = logger.LOG_DIR
+        return SharedExpReplay(
+            get_actor_fn=functools.partial(get_actor, config),
+            nr_actor=NR_ACTOR,
+            num_actions=NUM_ACTIONS,
+            state_shape=IMAGE_SIZE if OBS_CHANNELS == 1 else IMAGE_SIZE + (OBS_CHANNELS,),
+            batch_size=BATCH_SIZE,
+            memory_size=MEMORY_SIZE,
+            init_memory_size=init_memory_size or INIT_MEMORY_SIZE,
+            init_exploration=1.0,
+            update_frequency=UPDATE_FREQ,
+            history_len=FRAME_HISTORY,
+            num_agents=(3 if MULTI_TASK else 1),
+            chunk_size=ACTOR_CHUNK,
+            symbolic_renderer=get_player(train=True).get_symbolic_renderer() if SYMBOLIC_REPLAY else None,
+            nr_sampler=NR_SAMPLER,
+            prefetch=PREFETCH
+        )
+    player = get_player(train=True, nr_env=NR_ENV if NR_ENV > 1 else None)
+    return AugmentExpReplay(
+        predictor_io_names=predictor_io_names,
+        player=player,
+        state_shape=IMAGE_SIZE if OBS_CHANNELS == 1 else IMAGE_SIZE + (OBS_CHANNELS,),
+        batch_size=BATCH_SIZE,
+        memory_size=MEMORY_SIZE,
+        init_memory_size=init_memory_size or INIT_MEMORY_SIZE,
+        init_exploration=1.0,
+        update_frequency=UPDATE_FREQ,
+        history_len=FRAME_HISTORY,
+        h_size=RNN_HIDDEN,
+        num_agents=(3 if MULTI_TASK else 1),
+        memory_dir=MEMORY_DIR,
+        predictor_broker=PREDICTOR_BROKER,
+        prioritized=PRIORITIZED,
+        alpha=PRIO_ALPHA,
+        symbolic_renderer=player.get_symbolic_renderer() if SYMBOLIC_REPLAY else None,
+        nr_sampler=NR_SAMPLER,
+        prefetch=PREFETCH,
+        rnn_state_size=RNN_STATE_SIZE
+    )
 
 def get_config():
     if TASK == 'play':
@@ -156,23 +374,14 @@ def get_config():
             predictor_io_names=(['state'], ['Qvalue', 'Pivalue-0', 'Pivalue-1', 'Pivalue-2'])
         else:
             predictor_io_names=(['state'], ['Qvalue', 'Pivalue-0'])
+    elif RNN_STATE_SIZE:
+        # the simulator advances the recurrent state one frame per action
+        predictor_io_names=(['frame', 'rnn_state_in'], ['step_Qvalue', 'rnn_state_out'])
     else:
         predictor_io_names=(['state'], ['Qvalue'])
 
     M = Model()
-    expreplay = AugmentExpReplay(
-        predictor_io_names=predictor_io_names,
-        player=get_player(train=True),
-        state_shape=IMAGE_SIZE,
-        batch_size=BATCH_SIZE,
-        memory_size=MEMORY_SIZE,
-        init_memory_size=INIT_MEMORY_SIZE,
-        init_exploration=1.0,
-        update_frequency=UPDATE_FREQ,
-        history_len=FRAME_HISTORY,
-        h_size=RNN_HIDDEN,
-        num_agents=(3 if MULTI_TASK else 1)
-    )
+    expreplay = get_expreplay(predictor_io_names)
 
     lr_schedule = []
     for p in LR_SCHED.split(','):
@@ -184,10 +393,16 @@ def get_config():
         ep, eps = p.split(':')
         eps_schedule.append((int(ep), float(eps)))
 
+    beta_schedule = []
+    for p in BETA_SCHED.split(','):
+        ep, beta = p.split(':')
+        beta_schedule.append((int(ep), float(beta)))
+
     return TrainConfig(
         dataflow=expreplay,
         callbacks=[
             ModelSaver(),
+            ReplayMemorySaver(expreplay),
             PeriodicTrigger(
                 RunOp(DQNModel.update_target_param, verbose=True),
                 every_k_steps=UPDATE_TARGET_STEP // UPDATE_FREQ),    # update target network every 10k steps
@@ -198,8 +413,19 @@ def get_config():
                 ObjAttrParam(expreplay, 'exploration'),
                 eps_schedule,   # 1->0.1 in the first million steps
                 interp='linear'),
+            ScheduledHyperParamSetter(
+                ObjAttrParam(expreplay, 'beta'),
+                beta_schedule,
+                interp='linear'),
             HumanHyperParamSetter('learning_rate'),
-        ],
+        ] + ([] if not EVAL_PERIOD else [
+            # on the predictor of the simulator, through the same PREDICTOR_BROKER
+            PeriodicTrigger(
+                Evaluator(EVAL_EPISODE, *predictor_io_names, get_player_fn=get_player,
+                          predictor_broker=PREDICTOR_BROKER, rnn_state_size=RNN_STATE_SIZE,
+                          obs_channels=OBS_CHANNELS),
+                every_k_epochs=EVAL_PERIOD),
+        ]),
         model=M,
         steps_per_epoch=STEPS_PER_EPOCH,
         max_epoch=10000,
@@ -214,7 +440,7 @@ if __name__ == '__main__':
     parser.add_argument('--load', help='load model')
     parser.add_argument('--log', help='train log dir', default='train_log')
     parser.add_argument('--task', help='task to perform',
-                        choices=['play', 'eval', 'train'], default='train')
+                        choices=['play', 'eval', 'train', 'bench', 'quantize', 'actor'], default='train')
     parser.add_argument('--algo', help='algorithm for computing Q-value',
                         choices=['DQN', 'Double', 'Dueling'], default='DQN')
     parser.add_argument('--mode', help='specify ai mode in env', type=str, default=None)
@@ -222,13 +448,51 @@ if __name__ == '__main__':
                         choices=['coop-only', 'opponent-only', 'all'], default='all')
     parser.add_argument('--mt', help='use 2v2 env', action='store_true', default=False)
     parser.add_argument('--skip', help='act repeat', type=int, default=2)
-    parser.add_argument('--hist_len', help='hist len', type=int, default=12)
+    parser.add_argument('--hist_len', help='hist len (default: 12, N + 1 with --burn_in=N)', type=int, default=None)
     parser.add_argument('--batch_size', help='batch size', type=int, default=32)
     parser.add_argument('--lr', help='init lr value', type=float, default=1e-3)
     parser.add_argument('--rnn', help='use rnn (DRPIQN)', type=str, default=False)
+    parser.add_argument('--burn_in', help='with --rnn, keep the recurrent state in the replay memory and warm it up over this many frames', type=int, default=None)
     parser.add_argument('--lr_sched', help='lr schedule', type=str, default='600:4e-4,1000:2e-4')
     parser.add_argument('--eps_sched', help='eps decay schedule', type=str, default='100:0.1,3200:0.01')
+    parser.add_argument('--share_features', help='evaluate the online network on state and next_state together (Double)', action='store_true', default=False)
     parser.add_argument('--reg', help='reg', action='store_true', default=False)
+    parser.add_argument('--prioritized', help='use prioritized experience replay', action='store_true', default=False)
+    parser.add_argument('--prio_alpha', help='priority exponent of prioritized replay', type=float, default=0.6)
+    parser.add_argument('--beta_sched', help='importance-sampling exponent schedule of prioritized replay', type=str, default='0:0.4,3200:1.0')
+    parser.add_argument('--obs', help='observation type', choices=['pixel', 'grid'], default='pixel')
+    parser.add_argument('--renderer', help='how to draw pixel observations', choices=['pygame', 'fast'], default='pygame')
+    parser.add_argument('--mem_size', help='replay memory size', type=float, default=MEMORY_SIZE)
+    parser.add_argument('--replay_state', help='what the replay memory stores', choices=['frame', 'symbolic'], default='frame')
+    parser.add_argument('--mem_dir', help='keep the replay memory in memory-mapped files under this dir', type=str, default=None)
+    parser.add_argument('--nr_env', help='number of simulator processes in training', type=int, default=1)
+    parser.add_argument('--nr_actor', help='number of actor processes appending to a shared replay memory (0 to disable)', type=int, default=0)
+    parser.add_argument('--actor_chunk', help='number of transitions an actor reserves in the shared memory at once', type=int, default=ACTOR_CHUNK)
+    parser.add_argument('--learner', help='host:port or Unix socket path the learner listens on for --task=actor processes', type=str, default=None)
+    parser.add_argument('--actor_id', help='index of this actor among --nr_actor in --task=actor, which sets its epsilon', type=int, default=0)
+    parser.add_argument('--authkey_file', help='file with the secret shared by --learner and its actors (default: $DPIQN_AUTHKEY)', type=str, default=None)
+    parser.add_argument('--weight_period', help='number of training steps between two weight broadcasts to remote actors', type=int, default=WEIGHT_PERIOD)
+    parser.add_argument('--actor_int8', help='actors act with an int8 copy of each checkpoint', action='store_true', default=False)
+    parser.add_argument('--nr_sampler', help='number of threads assembling training batches in the background (0 to disable)', type=int, default=NR_SAMPLER)
+    parser.add_argument('--prefetch', help='number of training batches kept ready by the sampler threads', type=int, default=PREFETCH)
+    parser.add_argument('--eval_period', help='number of epochs between two evaluations of {} episodes in training (0 to disable)'.format(EVAL_EPISODE), type=int, default=EVAL_PERIOD)
+    parser.add_argument('--nr_eval', help='number of episodes to evaluate', type=int, default=100000)
+    parser.add_argument('--eval_nr_env', help='number of environments evaluated in lockstep (default: number of cores)', type=int, default=None)
+    parser.add_argument('--eval_tol', help='stop the evaluation once the confidence interval of the mean score is within +-eval_tol', type=float, default=None)
+    parser.add_argument('--eval_time', help='stop the evaluation after this many seconds', type=float, default=None)
+    parser.add_argument('--eval_conf', help='confidence level of the evaluation interval', type=float, choices=[0.9, 0.95, 0.99], default=0.95)
+    parser.add_argument('--bench_out', help='write the benchmark results as JSON to this file', type=str, default=None)
+    parser.add_argument('--bench_baseline', help='benchmark results to compare with', type=str, default=None)
+    parser.add_argument('--bench_tol', help='relative slowdown against the baseline reported as a regression', type=float, default=0.1)
+    parser.add_argument('--pred_batch', help='batch the predictor calls of the --eval_period threads up to this size (0 to disable)', type=int, default=0)
+    parser.add_argument('--pred_wait', help='max time in ms to wait for a predictor batch to fill', type=float, default=2)
+    parser.add_argument('--int8', help='int8 graph written by --task=quantize and used by play/eval', type=str, default=None)
+    parser.add_argument('--calib_replay', help='replay snapshot to calibrate on (default: replay/ next to --load)', type=str, default=None)
+    parser.add_argument('--calib_size', help='number of states to calibrate on, and to compare with the float model', type=int, default=1024)
+    parser.add_argument('--profile_hotpath', help='log per-stage timings of the simulator loop every epoch', action='store_true', default=False)
+    parser.add_argument('--profile_sample', help='keep every n-th timing for the percentiles', type=int, default=1)
+    parser.add_argument('--reset_pool', help='restart training episodes from this many initial states taken at start, instead of resetting the game', type=int, default=0)
+    parser.add_argument('--startup_report', help='log the time spent in imports, argument parsing, loading the predictor and creating the first player', action='store_true', default=False)
     args = parser.parse_args()
 
     if args.gpu:
@@ -236,19 +500,63 @@ if __name__ == '__main__':
     METHOD = args.algo
 
     ACTION_REPEAT = AI_SKIP = args.skip
-    FRAME_HISTORY = args.hist_len
+    FRAME_HISTORY = args.hist_len if args.hist_len is not None else 12
     BATCH_SIZE = args.batch_size
     LR = args.lr
     MULTI_TASK = args.mt
     MULTI_TASK_MODE = args.mt_mode
     USE_RNN = args.rnn
+    if args.burn_in is not None:
+        assert USE_RNN, "--burn_in needs --rnn"
+        assert args.hist_len is None, "--burn_in=N sets the history length to N + 1, don't pass --hist_len"
+        RNN_BURN_IN = args.burn_in
+        head_size = 2 * RNN_HIDDEN if RNN_CELL == 'lstm' else RNN_HIDDEN
+        RNN_STATE_SIZE = 2 * head_size
+        # the stored state replaces the context of a long history
+        FRAME_HISTORY = RNN_BURN_IN + RNN_STEP
+        logger.info("Keeping the recurrent state in the replay memory, history length {}".format(FRAME_HISTORY))
     LR_SCHED = args.lr_sched
     EPS_SCHED = args.eps_sched
+    PRIORITIZED = args.prioritized
+    PRIO_ALPHA = args.prio_alpha
+    BETA_SCHED = args.beta_sched
     MODE = args.mode
     REG = args.reg
+    SHARE_FEATURES = args.share_features
+    assert not (SHARE_FEATURES and METHOD != 'Double'), "--share_features only applies to --algo=Double"
     train_logdir = args.log
     TASK = args.task
+    MEMORY_SIZE = args.mem_size
+    MEMORY_DIR = args.mem_dir
+    SYMBOLIC_REPLAY = args.replay_state == 'symbolic'
+    NR_ENV = args.nr_env
+    NR_ACTOR = args.nr_actor
+    ACTOR_CHUNK = args.actor_chunk
+    ACTOR_INT8 = args.actor_int8
+    assert not (NR_ACTOR and (PRIORITIZED or NR_ENV > 1)), \
+        "Actor processes don't support prioritized replay or --nr_env"
+    assert not (NR_ACTOR and RNN_STATE_SIZE), "Actor processes don't keep the recurrent state"
+    assert not (args.int8 and RNN_STATE_SIZE and args.task in ['play', 'eval']), \
+        "The int8 graph unrolls the history from the zero state, not the recurrent state of --burn_in"
+    if args.task == 'train':
+        LEARNER = args.learner
+    WEIGHT_PERIOD = args.weight_period
+    AUTHKEY_FILE = args.authkey_file
+    assert not (LEARNER and (NR_ACTOR or PRIORITIZED or NR_ENV > 1 or RNN_STATE_SIZE or SYMBOLIC_REPLAY)), \
+        "Remote actors don't support --nr_actor, prioritized or symbolic replay, --nr_env or --burn_in"
+    NR_SAMPLER = args.nr_sampler
+    PREFETCH = args.prefetch
+    EVAL_PERIOD = args.eval_period
+    if args.pred_batch > 0:
+        PREDICTOR_BROKER = dict(max_batch=args.pred_batch, max_wait=args.pred_wait / 1000.0)
     FIELD = 'large' if args.mt else 'small'
+    OBS_TYPE = args.obs
+    assert not (SYMBOLIC_REPLAY and OBS_TYPE == 'grid'), "The grid observation is stored as is"
+    RENDERER = args.renderer
+    if OBS_TYPE == 'grid':
+        grid_shape = SoccerPlayer.get_state_shape(OBS_TYPE, field=FIELD)
+        IMAGE_SIZE = grid_shape[:2]
+        OBS_CHANNELS = grid_shape[2]
 
     if MULTI_TASK:
         scenario = 'MT-%s' % MULTI_TASK_MODE
@@ -260,26 +568,92 @@ if __name__ == '__main__':
     else:
         MODEL_NAME = '%s-%s-PI' % (scenario, args.algo)
 
-    # set num_actions
-    NUM_ACTIONS = SoccerPlayer().get_action_space().num_actions()
-
-    if args.task != 'train':
-        assert args.load is not None
-        cfg = PredictConfig(
+    NUM_ACTIONS = SoccerPlayer.NUM_ACTIONS
+    STARTUP_REPORT = args.startup_report
+    RESET_POOL = args.reset_pool
+    hotpath.STARTUP.mark('arguments')
+
+    if args.task == 'bench':
+        import json
+        import benchmark
+        if not args.gpu:
+            # measure the predictor on CPU, as in the simulators
+            os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        results = {}
+        results.update(benchmark.bench_env(ACTION_REPEAT))
+        results.update(benchmark.bench_ai())
+        results.update(benchmark.bench_render(ACTION_REPEAT))
+        results.update(benchmark.bench_replay(history_len=FRAME_HISTORY, batch_size=BATCH_SIZE,
+                                              num_agents=3 if MULTI_TASK else 1, storage_dir=MEMORY_DIR))
+        results.update(benchmark.bench_predictor(Model()))
+        results.update(benchmark.bench_learner(Model(), get_expreplay((['state'], ['Qvalue']), 10000)))
+        regressions = []
+        if args.bench_baseline:
+            with open(args.bench_baseline) as f:
+                regressions = benchmark.compare_baseline(results, json.load(f), args.bench_tol)
+        benchmark.write_results(results, args.bench_out)
+        if regressions:
+            logger.error("{} regression(s) against {}: {}".format(
+                len(regressions), args.bench_baseline, ', '.join(regressions)))
+            sys.exit(1)
+    elif args.task == 'actor':
+        import distributed
+        assert args.learner is not None
+        # the learner keeps the GPUs
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+        predfunc = OfflinePredictor(PredictConfig(
             model=Model(),
-            session_init=get_model_loader(args.load),
             input_names=['state'],
-            output_names=['Qvalue'])
+            output_names=['Qvalue']))
+        distributed.run_actor(distributed.parse_address(args.learner), get_player(train=True), predfunc,
+                              FRAME_HISTORY, args.actor_id, max(args.nr_actor, 1),
+                              authkey=distributed.read_authkey(AUTHKEY_FILE))
+    elif args.task == 'quantize':
+        assert args.load is not None
+        quantize_model(args.load, args.calib_replay or os.path.join(os.path.dirname(args.load), 'replay'),
+                       args.calib_size, args.int8 or args.load + '-int8.pb')
+    elif args.task != 'train':
+        if args.int8:
+            import quantize
+            predfunc = quantize.FrozenPredictor(args.int8)
+        elif RNN_STATE_SIZE:
+            # one frame at a time from the carried state, as in training
+            assert args.load is not None
+            predfunc = common.StepPredictor(OfflinePredictor(PredictConfig(
+                model=Model(),
+                session_init=get_model_loader(args.load),
+                input_names=['frame', 'rnn_state_in'],
+                output_names=['step_Qvalue', 'rnn_state_out'])), RNN_STATE_SIZE, OBS_CHANNELS)
+        else:
+            assert args.load is not None
+            predfunc = OfflinePredictor(PredictConfig(
+                model=Model(),
+                session_init=get_model_loader(args.load),
+                input_names=['state'],
+                output_names=['Qvalue']))
+        hotpath.STARTUP.mark('predictor')
         if args.task == 'play':
-            play_model(cfg, get_player(viz=1))
+            play_model(predfunc, get_player(viz=1))
         elif args.task == 'eval':
-            eval_model_multithread(cfg, EVAL_EPISODE, get_player)
+            eval_model_multithread(predfunc, args.nr_eval, get_player, FRAME_HISTORY, args.eval_nr_env,
+                                   args.eval_tol, args.eval_time, args.eval_conf)
     else:
         logger.set_logger_dir(
             os.path.join(train_logdir, '{}-skip-{}-hist-{}-batch-{}-lr-{}-{}-eps-{}-reg-{}-{}'.format(
-                MODEL_NAME, args.skip, args.hist_len, args.batch_size, args.lr,
+                MODEL_NAME, args.skip, FRAME_HISTORY, args.batch_size, args.lr,
                 args.lr_sched, args.eps_sched, REG, os.path.basename('soccer').split('.')[0])))
+        if args.profile_hotpath:
+            hotpath.enable(args.profile_sample)
         config = get_config()
         if args.load:
             config.session_init = SaverRestore(args.load)
+            replay_dir = os.path.join(os.path.dirname(args.load), 'replay')
+            if os.path.isdir(replay_dir):
+                # ModelSaver names the checkpoints model-<global step>
+                step = re.search(r'model-(\d+)', os.path.basename(args.load))
+                logger.info("Restoring replay memory from {} ...".format(replay_dir))
+                try:
+                    config.dataflow.mem.load_snapshot(replay_dir, int(step.group(1)) if step else None)
+                except ValueError as e:
+                    logger.warn("{}, populating the replay memory again.".format(e))
         QueueInputTrainer(config).train()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import multiprocessing as mp
+
+from tensorpack.RL.envbase import RLEnvironment, DiscreteActionSpace
+
+from soccer_env import SoccerPlayer
+
+__all__ = ['VecSoccerPlayer']
+
+
+def _worker_main(idx, pipe, obs_buf, obs_shape, symbolic, player_kwargs):
+    player = SoccerPlayer(**player_kwargs)
+    obs = np.frombuffer(obs_buf, dtype='uint8').reshape((-1,) + obs_shape)[idx]
+    get_state = player.symbolic_state if symbolic else player.current_state
+    obs[...] = get_state()
+    pipe.send(player.get_action_space().num_actions())
+    while True:
+        cmd, arg = pipe.recv()
+        if cmd == 'action':
+            r, isOver = player.action(arg)
+            obs[...] = get_state()
+            scores = player.stats['score']
+            player.reset_stat()
+            pipe.send((r, isOver, player.get_internal_state()['agent_actions'], scores))
+        elif cmd == 'restart':
+            player.restart_episode()
+            obs[...] = get_state()
+            pipe.send(None)
+        elif cmd == 'renderer':
+            pipe.send(player.get_symbolic_renderer())
+        elif cmd == 'close':
+            pipe.close()
+            return
+
+
+class VecSoccerPlayer(RLEnvironment):
+    """
+    Run `n` :class:`SoccerPlayer` in worker processes and step them together.
+    The workers write their observations into one shared-memory array, so only
+    actions, rewards and flags go through the pipes.
+    Each player restarts by itself when its episode ends.
+    """
+
+    def __init__(self, n, symbolic=False, **kwargs):
+        """
+        Args:
+            n (int): number of players.
+            symbolic (bool): share the symbolic states of the players instead
+                of their observations, see :meth:`SoccerPlayer.symbolic_state`.
+            kwargs: arguments of :class:`SoccerPlayer`.
+        """
+        super(VecSoccerPlayer, self).__init__()
+        assert not kwargs.get('viz'), "VecSoccerPlayer doesn't support viz"
+        self.num_envs = n
+        self.symbolic = symbolic
+        if symbolic:
+            obs_shape = SoccerPlayer.get_symbolic_shape(**kwargs)
+        else:
+            obs_shape = SoccerPlayer.get_state_shape(**kwargs)
+
+        # spawn instead of fork, the parent process may already hold a tf session
+        ctx = mp.get_context('spawn')
+        obs_buf = ctx.RawArray('B', int(n * np.prod(obs_shape)))
+        self._obs = np.frombuffer(obs_buf, dtype='uint8').reshape((n,) + obs_shape)
+        self._pipes = []
+        self._procs = []
+        for i in range(n):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=_worker_main, args=(i, child, obs_buf, obs_shape, symbolic, kwargs))
+            proc.daemon = True
+            proc.start()
+            self._pipes.append(parent)
+            self._procs.append(proc)
+        self.num_actions = [p.recv() for p in self._pipes][0]
+        self.last_info = {}
+
+    def current_state(self):
+        """
+        Returns:
+            a (n,) + STATE_SIZE uint8 array, which is overwritten by the next :meth:`action`.
+        """
+        assert not self.symbolic
+        return self._obs
+
+    def symbolic_state(self):
+        """ like :meth:`current_state`, for a player with `symbolic=True` """
+        assert self.symbolic
+        return self._obs
+
+    def get_symbolic_renderer(self):
+        self._pipes[0].send(('renderer', None))
+        return self._pipes[0].recv()
+
+    def action(self, act):
+        """
+        Args:
+            act: an action index for each player.
+        Returns:
+            (reward, isOver): two arrays of length n.
+        """
+        for p, a in zip(self._pipes, act):
+            p.send(('action', int(a)))
+        ret = [p.recv() for p in self._pipes]
+        reward = np.asarray([r[0] for r in ret], dtype='float32')
+        isOver = np.asarray([r[1] for r in ret], dtype='bool')
+        self.last_info['agent_actions'] = np.asarray([r[2] for r in ret])
+        for r in ret:
+            self.stats['score'].extend(r[3])
+        return reward, isOver
+
+    def restart_episode(self):
+        for p in self._pipes:
+            p.send(('restart', None))
+        for p in self._pipes:
+            p.recv()
+
+    def get_action_space(self):
+        return DiscreteActionSpace(self.num_actions)
+
+    def get_internal_state(self):
+        return self.last_info
+
+    def close(self):
+        for p in self._pipes:
+            p.send(('close', None))
+        for proc in self._procs:
+            proc.join()